@@ -1,6 +1,7 @@
 # /app.py
 
 import os
+import threading
 import time
 import traceback
 
@@ -9,14 +10,22 @@ import numpy as np
 from flask import Flask, Response, render_template, request
 from PIL import Image, ImageDraw, ImageFont
 
+from src.system.async_auth import AsyncAuthenticator
+from src.system.broadcast import FrameBroadcaster
 from src.system.camera import Camera, SimulatedCamera
 from src.system.data_manager import DataManager
+from src.system.decision import NEED_MORE, SequentialDecider
 from src.system.face_processor import FaceProcessor
+from src.system.match_server import MatchClient
+from src.system.mjpeg import MJPEGEncoder
 from src.system.services import AuthenticationService
+from src.system.tracker import FaceTracker
 from src.utils.logger import setup_logger
 
 # --- アプリケーション設定 ---
 USE_REAL_CAMERA = True  # デバイスカメラの有無
+# 照合サーバーのソケット (指定された場合はギャラリーを読み込まずにサーバーへ照合を依頼する)
+MATCH_SERVER_SOCKET = os.environ.get("MATCH_SERVER_SOCKET")
 
 app = Flask(__name__)
 logger = setup_logger(__name__)
@@ -25,7 +34,15 @@ logger = setup_logger(__name__)
 # アプリケーション起動時に一度だけ、各サービスをインスタンス化
 data_manager = DataManager()
 face_processor = FaceProcessor()
-auth_service = AuthenticationService(data_manager, face_processor, tolerance=0.55)
+if MATCH_SERVER_SOCKET:
+    auth_service = MatchClient(MATCH_SERVER_SOCKET, face_processor=face_processor)
+else:
+    auth_service = AuthenticationService(data_manager, face_processor, tolerance=0.55)
+# 複数フレームの照合結果から人物ごとに認証を判定する
+face_tracker = FaceTracker()
+decider = SequentialDecider(tolerance=auth_service.tolerance)
+# 照合はストリームのスレッドから切り離して実行する
+async_authenticator = AsyncAuthenticator(auth_service, timeout=2.0)
 
 # カメラの初期化
 try:
@@ -41,6 +58,11 @@ except Exception as e:
     )
     exit()
 
+# 処理ループは1つだけ動かし、生成したフレームを全ての視聴者に配信する
+frame_broadcaster = FrameBroadcaster()
+frame_producer_lock = threading.Lock()
+frame_producer_thread = None
+
 logger.info("Flask application and services initialized.")
 
 
@@ -64,6 +86,11 @@ if not os.path.exists(FONT_PATH):
         },
     )
     FONT_PATH = ""
+# 配信する映像の幅とJPEGの画質 (解析は元の解像度で行う)
+PREVIEW_WIDTH, JPEG_QUALITY = 640, 70
+mjpeg_encoder = MJPEGEncoder(preview_width=PREVIEW_WIDTH, quality=JPEG_QUALITY)
+# 認証結果の画面を表示し続ける秒数と、その間に再送するフレームレート
+RESULT_HOLD_SECONDS, RESULT_HOLD_FPS = 3.0, 5.0
 
 
 # --- ヘルパー関数 ---
@@ -137,6 +164,29 @@ def draw_japanese_text(image, text, position, font_path, font_size, color):
 
 
 # --- Webカメラストリーミング ---
+def hold_result(part, seconds):
+    """
+    エンコード済みの結果の画面を、保持期間中に一定の間隔で再送する
+
+    保持中もカメラのフレームは読み捨て、保持が終わった時に古いフレームが残らないようにする
+    """
+    end_time = time.monotonic() + seconds
+    next_send = time.monotonic()
+    while True:
+        now = time.monotonic()
+        if now >= end_time:
+            return
+        if now >= next_send:
+            yield part
+            next_send = now + 1.0 / RESULT_HOLD_FPS
+        read_started = time.monotonic()
+        camera.get_frame()
+        # 実カメラは読み込み自体がフレーム間隔だけ待つため、すぐに戻った場合だけ待つ
+        if time.monotonic() - read_started < 0.01:
+            wait = min(next_send, end_time) - time.monotonic()
+            time.sleep(min(0.03, max(0.0, wait)))
+
+
 def generate_frames():
     """
     カメラからフレームを取得し、認証処理を行い、ストリーミングする
@@ -149,6 +199,9 @@ def generate_frames():
             continue
 
         detected_faces = face_processor.detect_and_encode_faces(frame)
+        track_ids = face_tracker.update([f["location"] for f in detected_faces])
+        decider.prune(face_tracker.active_track_ids)
+        async_authenticator.prune(face_tracker.active_track_ids)
         default_color = (128, 128, 128)
         gx, gy, gw, gh = GUIDE_BOX_RECT
         cv2.rectangle(frame, (gx, gy), (gx + gw, gy + gh), default_color, 3)
@@ -157,77 +210,81 @@ def generate_frames():
             # 顔が検出されなかった場合
             pass
         else:
-            largest_face = max(
-                detected_faces, key=lambda f: get_face_properties(f["location"])[1]
+            largest_index = max(
+                range(len(detected_faces)),
+                key=lambda i: get_face_properties(detected_faces[i]["location"])[1],
             )
+            largest_face = detected_faces[largest_index]
+            track_id = track_ids[largest_index]
             face_box_coords, face_area = get_face_properties(largest_face["location"])
             left, top, w, h = face_box_coords
             distance, size_ratio = calculate_face_metrics(face_box_coords, face_area)
             # 認証処理事前チェック（顔の位置と大きさを確認）
             if distance <= POSITION_THRESHOLD and size_ratio >= SIZE_THRESHOLD:
-                logger.info(
-                    "Face detected and ready for authentication.",
-                    extra={
-                        "distance": distance,
-                        "size_ratio": size_ratio,
-                    },
-                )
-                # 認証処理の前に先に対象フレームを返しておく
-                auth_color = (255, 255, 255)
-                auth_message = "認証中..."
-                processing_frame = frame.copy()
-                cv2.rectangle(
-                    processing_frame, (left, top), (left + w, top + h), auth_color, 3
-                )
-                processing_frame = draw_japanese_text(
-                    processing_frame,
-                    auth_message,
-                    (left, top - 40),
-                    FONT_PATH,
-                    30,
-                    auth_color,
-                )
-                _, buffer = cv2.imencode(".jpg", processing_frame)
-                yield (
-                    b"--frame\r\n"
-                    b"Content-Type: image/jpeg\r\n\r\n" + buffer.tobytes() + b"\r\n"
-                )
-                # 認証処理
-                logger.info("Starting face authentication.")
-                auth_result = auth_service.authenticate_face(largest_face)
-                logger.info(
-                    "Face authentication completed.",
-                    extra={
-                        "user_name": auth_result[0]["name"],
-                    },
-                )
-                name = auth_result[0]["name"]
-
-                result_color = (0, 255, 0) if name != "Unknown" else (0, 0, 255)
-                result_frame = frame.copy()
-                cv2.rectangle(
-                    result_frame, (left, top), (left + w, top + h), result_color, 3
-                )
-                result_frame = draw_japanese_text(
-                    result_frame,
-                    f"結果: {name}",
-                    (left, top - 40),
-                    FONT_PATH,
-                    30,
-                    result_color,
-                )
+                # 照合はストリームのスレッドを止めないよう別スレッドで実行し、
+                # 完了した結果を1フレーム分の証拠として人物ごとの判定に加える
+                auth_result = async_authenticator.poll(track_id)
+                decision = None
+                if auth_result is not None:
+                    decision = decider.update(track_id, auth_result[0])
+                if decision is None or decision["decision"] == NEED_MORE:
+                    if not async_authenticator.is_pending(track_id):
+                        logger.info(
+                            "Face detected and ready for authentication.",
+                            extra={
+                                "distance": distance,
+                                "size_ratio": size_ratio,
+                            },
+                        )
+                        async_authenticator.submit(track_id, largest_face, top_k=2)
+                    # 判定が確定するまでは、ライブ映像に照合中の表示を重ねて配信を続ける
+                    auth_color = (255, 255, 255)
+                    cv2.rectangle(
+                        frame, (left, top), (left + w, top + h), auth_color, 3
+                    )
+                    frame = draw_japanese_text(
+                        frame,
+                        "認証中...",
+                        (left, top - 40),
+                        FONT_PATH,
+                        30,
+                        auth_color,
+                    )
+                else:
+                    logger.info(
+                        "Face authentication completed.",
+                        extra={
+                            "user_name": decision["name"],
+                            "frames": decision["frames"],
+                        },
+                    )
+                    name = decision["name"]
 
-                end_time = time.time() + 3
-                while time.time() < end_time:
-                    _, buffer = cv2.imencode(".jpg", result_frame)
-                    yield (
-                        b"--frame\r\n"
-                        b"Content-Type: image/jpeg\r\n\r\n" + buffer.tobytes() + b"\r\n"
+                    result_color = (0, 255, 0) if name != "Unknown" else (0, 0, 255)
+                    result_frame = frame.copy()
+                    cv2.rectangle(
+                        result_frame, (left, top), (left + w, top + h), result_color, 3
+                    )
+                    result_frame = draw_japanese_text(
+                        result_frame,
+                        f"結果: {name}",
+                        (left, top - 40),
+                        FONT_PATH,
+                        30,
+                        result_color,
                     )
-                continue
+
+                    # 結果の画面は1回だけエンコードし、保持期間中は同じバイト列を再送する
+                    part = mjpeg_encoder.encode(result_frame)
+                    if part is not None:
+                        yield from hold_result(part, RESULT_HOLD_SECONDS)
+                    decider.reset(track_id)
+                    continue
 
             else:
                 # 認証処理事前チェックに引っかからなかった場合フィードバックを描画
+                # 枠から外れた人物の実行中の照合は取り消す
+                async_authenticator.cancel(track_id)
                 feedback_color = (0, 255, 255)
                 feedback_message = (
                     "顔を枠の中央に"
@@ -246,11 +303,30 @@ def generate_frames():
                     feedback_color,
                 )
 
-        _, buffer = cv2.imencode(".jpg", frame)
-        yield (
-            b"--frame\r\n"
-            b"Content-Type: image/jpeg\r\n\r\n" + buffer.tobytes() + b"\r\n"
-        )
+        part = mjpeg_encoder.encode(frame)
+        if part is not None:
+            yield part
+
+
+def run_frame_producer():
+    """
+    generate_framesを1つだけ実行し、生成したフレームを配信する
+    """
+    for part in generate_frames():
+        frame_broadcaster.publish(part)
+
+
+def ensure_frame_producer():
+    """
+    処理ループのスレッドが動いていなければ開始する
+    """
+    global frame_producer_thread
+    with frame_producer_lock:
+        if frame_producer_thread is None or not frame_producer_thread.is_alive():
+            frame_producer_thread = threading.Thread(
+                target=run_frame_producer, name="frame-producer", daemon=True
+            )
+            frame_producer_thread.start()
 
 
 @app.route("/")
@@ -266,9 +342,13 @@ def index():
 def video_feed():
     """
     Webカメラストリーミングを開始する
+
+    視聴者ごとに処理は行わず、共通の処理ループが生成した最新のフレームを受け取る
     """
+    ensure_frame_producer()
     return Response(
-        generate_frames(), mimetype="multipart/x-mixed-replace; boundary=frame"
+        frame_broadcaster.subscribe(),
+        mimetype="multipart/x-mixed-replace; boundary=frame",
     )
 
 
@@ -0,0 +1,337 @@
+import tempfile
+from contextlib import asynccontextmanager
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import UploadFile
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+from starlette.templating import Jinja2Templates
+
+from src.system.app_context import (
+    CLIENT_OVERLAYS,
+    MAX_BATCH_UPLOAD_BYTES,
+    REGISTRATION_PASSWORD,
+    TAR_CONTENT_TYPES,
+    USE_REAL_CAMERA,
+    AppContext,
+)
+from src.system.async_broadcast import AsyncFrameFanout
+from src.system.batch_auth import iter_tar_images
+from src.system.snapshot import is_not_modified
+from src.utils.logger import setup_logger
+from src.utils.metrics import CONTENT_TYPE, REGISTRY
+
+# Flask版(test_app.py)と同じAppContextでサービスと状態を構築するasyncio版のエントリーポイント
+# (Flaskには依存しない)
+# 取得・解析・描画はStreamPipelineのスレッドで実行し、イベントループは配信と
+# APIの応答だけを行う。時間のかかる登録処理はスレッドプールで実行する
+logger = setup_logger(__name__)
+context = AppContext(use_real_camera=USE_REAL_CAMERA)
+app_state = context.app_state
+stream_pipeline = context.stream_pipeline
+snapshot_service = context.snapshot_service
+
+templates = Jinja2Templates(directory="templates")
+frame_fanout = AsyncFrameFanout(stream_pipeline.broadcaster)
+event_fanout = AsyncFrameFanout(stream_pipeline.events)
+
+# パスワードや名前だけを送るフォームの本体の上限
+MAX_FORM_BYTES = 64 * 1024
+# アップロードされたtarをメモリに置く上限 (超えた分は一時ファイルに書き出す)
+UPLOAD_SPOOL_BYTES = 8 * 1024 * 1024
+
+
+class RequestTooLarge(Exception):
+    """リクエスト本体が上限を超えた"""
+
+
+def limit_body(request: Request, max_bytes: int) -> Request:
+    """
+    本体をmax_bytesまでしか受け取らないRequestを返す
+
+    Content-Lengthで超えることが分かる場合は本体を読む前に、そうでない場合は
+    受信した量が上限を超えた時点でRequestTooLargeを送出する
+
+    Args:
+        request (Request): 元のリクエスト
+        max_bytes (int): 本体の最大バイト数
+
+    Returns:
+        Request: 本体の受信量を数えるRequest
+    """
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > max_bytes:
+        raise RequestTooLarge()
+
+    received = 0
+
+    async def receive():
+        nonlocal received
+        message = await request.receive()
+        if message["type"] == "http.request":
+            received += len(message.get("body", b""))
+            if received > max_bytes:
+                raise RequestTooLarge()
+        return message
+
+    return Request(request.scope, receive)
+
+
+async def spool_body(request: Request, max_bytes: int):
+    """
+    リクエスト本体を一時ファイルに受信する (小さい間はメモリに置く)
+
+    Returns:
+        SpooledTemporaryFile: 先頭に戻した一時ファイル (使い終わったら閉じる)
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+    try:
+        async for chunk in limit_body(request, max_bytes).stream():
+            spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+async def request_too_large(request: Request, exc: RequestTooLarge):
+    return JSONResponse(
+        {"status": "error", "message": "リクエストが大きすぎます。"}, status_code=413
+    )
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """起動時に処理パイプラインと配信を開始し、終了時に停止する"""
+    stream_pipeline.start()
+    frame_fanout.start()
+    event_fanout.start()
+    try:
+        yield
+    finally:
+        stream_pipeline.broadcaster.close()
+        stream_pipeline.events.close()
+        stream_pipeline.stop()
+
+
+# --- APIエンドポイント ---
+async def index(request: Request):
+    return templates.TemplateResponse(
+        request, "index.html", {"client_overlays": CLIENT_OVERLAYS}
+    )
+
+
+async def video_feed(request: Request):
+    return StreamingResponse(
+        frame_fanout.subscribe(),
+        media_type="multipart/x-mixed-replace; boundary=frame",
+    )
+
+
+async def snapshot(request: Request):
+    """配信中の最新フレームを静止画で返す (?width=160|320|640 で縮小版)"""
+    width = request.query_params.get("width")
+    try:
+        width = int(width) if width is not None else None
+        if width is not None and width not in snapshot_service.widths:
+            raise ValueError
+    except ValueError:
+        return JSONResponse(
+            {"status": "error", "message": "Unsupported width."}, status_code=400
+        )
+
+    # 縮小版を作る場合はJPEGのデコードを含むため、イベントループの外で実行する
+    image = await run_in_threadpool(snapshot_service.get, width)
+    if image is None:
+        return Response(status_code=503, headers={"Retry-After": "1"})
+
+    headers = {
+        "ETag": image["etag"],
+        "Last-Modified": image["last_modified"],
+        "Cache-Control": "no-cache",
+    }
+    if is_not_modified(
+        image,
+        request.headers.get("if-none-match"),
+        request.headers.get("if-modified-since"),
+    ):
+        return Response(status_code=304, headers=headers)
+    return Response(image["body"], media_type="image/jpeg", headers=headers)
+
+
+async def events(request: Request):
+    """解析結果(モード, 顔の枠, 名前, トラックID)をServer-Sent Eventsで配信する"""
+    return StreamingResponse(
+        event_fanout.subscribe(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+async def check_password(request: Request):
+    """パスワードを検証する"""
+    form = await limit_body(request, MAX_FORM_BYTES).form()
+    if form.get("password") == REGISTRATION_PASSWORD:
+        return JSONResponse({"status": "ok"})
+    return JSONResponse(
+        {"status": "error", "message": "パスワードが違います。"}, status_code=401
+    )
+
+
+async def start_registration(request: Request):
+    """登録モードを開始する"""
+    context.change_mode("REGISTRATION_SEARCHING")
+    return JSONResponse({"status": "ok"})
+
+
+async def recapture(request: Request):
+    """キャプチャしたフレームを破棄し、再撮影モードに戻す"""
+    context.change_mode("REGISTRATION_SEARCHING", discard_capture=True)
+    return JSONResponse({"status": "ok"})
+
+
+async def cancel_registration(request: Request):
+    """登録をキャンセルし、認証モードに戻る"""
+    context.change_mode("AUTHENTICATING", discard_capture=True)
+    return JSONResponse({"status": "ok"})
+
+
+async def status(request: Request):
+    """フロントエンドに現在のアプリケーション状態を返す"""
+    return JSONResponse(context.get_status())
+
+
+async def metrics(request: Request):
+    """各ステージの処理時間, 破棄したフレーム数, キューの長さ, ギャラリーの大きさを返す"""
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
+async def batch_response(request: Request, auth_service=None):
+    """
+    リクエストの画像を認証し、結果をNDJSONで返すレスポンスを作る
+
+    multipart/form-dataの"images"フィールド、またはtar (gzip圧縮も可) のリクエスト本体を
+    受け付ける
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type in TAR_CONTENT_TYPES:
+        # tarfileは同期的に読むため、本体を一時ファイルに受信してから読み出す
+        upload = await spool_body(request, MAX_BATCH_UPLOAD_BYTES)
+        images = iter_tar_images(upload)
+        close_upload = upload.close
+    else:
+        # 各ファイルはStarletteが一時ファイルに受信するため、画像は処理する時に1枚ずつ読む
+        form = await limit_body(request, MAX_BATCH_UPLOAD_BYTES).form()
+        # 同じ名前のテキストのフィールドはファイルではないため無視する
+        files = [f for f in form.getlist("images") if isinstance(f, UploadFile)]
+        if not files:
+            await form.close()
+            return JSONResponse(
+                {"status": "error", "message": "画像がありません。"}, status_code=400
+            )
+        images = ((f.filename, f.file.read()) for f in files)
+        close_upload = form.close
+
+    # 同期的なジェネレータはStreamingResponseがスレッドプールで回すため、
+    # 検出と照合の完了を待つ間もイベントループは止まらない
+    return StreamingResponse(
+        context.batch_result_lines(images, auth_service),
+        media_type="application/x-ndjson",
+        background=BackgroundTask(close_upload),
+    )
+
+
+async def authenticate_batch(request: Request):
+    """
+    アップロードされた複数の画像を認証する
+
+    multipart/form-dataの"images"フィールド、またはtar (gzip圧縮も可) のリクエスト本体を
+    受け付け、画像ごとの結果を完了した順にNDJSONで返す
+    """
+    return await batch_response(request)
+
+
+async def tenants(request: Request):
+    """テナントの一覧と、読み込み済みのテナントのメモリ使用量を返す"""
+    stats = await run_in_threadpool(context.tenant_stats)
+    if stats is None:
+        return JSONResponse(
+            {"status": "error", "message": "テナントは無効です。"}, status_code=404
+        )
+    return JSONResponse(stats)
+
+
+async def authenticate_tenant_batch(request: Request):
+    """
+    アップロードされた複数の画像を、テナントのギャラリーと照合する
+
+    リクエストとレスポンスの形式は/authenticate_batchと同じ
+    """
+    try:
+        # 初めて使うテナントはギャラリーの読み込みを含むため、イベントループの外で実行する
+        auth_service = await run_in_threadpool(
+            context.tenant_service, request.path_params["tenant_id"]
+        )
+    except ValueError:
+        return JSONResponse(
+            {"status": "error", "message": "テナントIDが不正です。"}, status_code=400
+        )
+    except KeyError:
+        return JSONResponse(
+            {"status": "error", "message": "テナントがありません。"}, status_code=404
+        )
+    return await batch_response(request, auth_service)
+
+
+async def submit_registration(request: Request):
+    """ユーザー名を受け取り、登録を実行する"""
+    form = await limit_body(request, MAX_FORM_BYTES).form()
+    user_name = form.get("name")
+    if not user_name or app_state.captured_frame is None:
+        return JSONResponse(
+            {
+                "status": "error",
+                "message": "名前またはキャプチャされたフレームがありません。",
+            },
+            status_code=400,
+        )
+
+    # エンコーディングの再構築はCPUを使うため、イベントループを止めないようにする
+    await run_in_threadpool(context.register_captured_user, user_name)
+    logger.info(f"User registered: {user_name}")
+    return JSONResponse({"status": "ok", "message": f"{user_name}さんを登録しました。"})
+
+
+app = Starlette(
+    routes=[
+        Route("/", index),
+        Route("/video_feed", video_feed, name="video_feed"),
+        Route("/snapshot.jpg", snapshot),
+        Route("/events", events),
+        Route("/check_password", check_password, methods=["POST"]),
+        Route("/start_registration", start_registration, methods=["POST"]),
+        Route("/recapture", recapture, methods=["POST"]),
+        Route("/cancel_registration", cancel_registration, methods=["POST"]),
+        Route("/status", status),
+        Route("/metrics", metrics),
+        Route("/authenticate_batch", authenticate_batch, methods=["POST"]),
+        Route("/tenants", tenants),
+        Route(
+            "/tenants/{tenant_id}/authenticate_batch",
+            authenticate_tenant_batch,
+            methods=["POST"],
+        ),
+        Route("/submit_registration", submit_registration, methods=["POST"]),
+    ],
+    lifespan=lifespan,
+    exception_handlers={RequestTooLarge: request_too_large},
+)
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=8080)
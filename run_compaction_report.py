@@ -0,0 +1,105 @@
+# /run_compaction_report.py
+
+import os
+import time
+
+import cv2
+import numpy as np
+
+import face_recognition
+
+from src.system.data_manager import DataManager
+from src.system.face_processor import FaceProcessor
+from src.system.services import EncodingService
+
+# テスト用の画像ディレクトリ（3人＊10imgs）と認証用のテスト画像
+DATASET_DIR = "test_user_imgs"
+TEST_DIR = "test_auth_imgs"
+TOLERANCE = 0.55
+PROTOTYPE_COUNTS = [1, 2, 3, 5]
+
+
+def load_test_probes(face_processor: FaceProcessor) -> list:
+    """
+    テスト画像から顔エンコーディングと正解ラベルを読み込む
+
+    test_auth_imgs/true 以下は登録済みユーザー、false 以下は未登録者として扱う
+
+    Returns:
+        list: (エンコーディング, 登録済みかどうか) のタプルのリスト
+    """
+    probes = []
+    for label in ("true", "false"):
+        label_dir = os.path.join(TEST_DIR, label)
+        if not os.path.isdir(label_dir):
+            continue
+        for filename in sorted(os.listdir(label_dir)):
+            if not filename.lower().endswith((".pgm", ".jpg", ".png")):
+                continue
+            image = cv2.imread(os.path.join(label_dir, filename))
+            if image is None:
+                continue
+            encodings = face_processor.extract_encodings(image)
+            if len(encodings) == 1:
+                probes.append((encodings[0], label == "true"))
+    return probes
+
+
+def evaluate(encodings: list, probes: list) -> dict:
+    """
+    ギャラリーに対してテスト画像を照合し、精度と照合時間を計測する
+    """
+    correct = 0
+    start = time.perf_counter()
+    for probe, is_enrolled in probes:
+        distances = face_recognition.face_distance(encodings, probe)
+        matched = len(distances) > 0 and np.min(distances) <= TOLERANCE
+        correct += int(matched == is_enrolled)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "rows": len(encodings),
+        "bytes": sum(e.nbytes for e in encodings),
+        "accuracy": correct / len(probes) if probes else 0.0,
+        "match_ms": elapsed * 1000 / max(len(probes), 1),
+    }
+
+
+def main():
+    # ギャラリー圧縮による精度・メモリ・照合時間の変化をレポートする
+    print("--- Starting Gallery Compaction Report ---")
+
+    data_manager = DataManager(dataset_path=DATASET_DIR)
+    face_processor = FaceProcessor()
+    encoding_service = EncodingService(
+        data_manager=data_manager, face_processor=face_processor
+    )
+
+    encodings, user_ids = encoding_service.collect_encodings()
+    if not encodings:
+        print("Error: No encodings were generated from the dataset.")
+        return
+
+    probes = load_test_probes(face_processor)
+    print(f"Gallery: {len(encodings)} encodings, {len(set(user_ids))} users")
+    print(f"Test set: {len(probes)} probes from '{TEST_DIR}'")
+
+    rows = [("full", evaluate(encodings, probes))]
+    for k in PROTOTYPE_COUNTS:
+        compacted, _ = encoding_service.compact_encodings(
+            encodings, user_ids, prototypes_per_user=k
+        )
+        rows.append((f"k={k}", evaluate(compacted, probes)))
+
+    print(f"\n{'gallery':<8}{'rows':>6}{'bytes':>9}{'accuracy':>10}{'ms/probe':>10}")
+    for name, result in rows:
+        print(
+            f"{name:<8}{result['rows']:>6}{result['bytes']:>9}"
+            f"{result['accuracy']:>10.3f}{result['match_ms']:>10.3f}"
+        )
+
+    print("\nGallery Compaction Report Finished.")
+
+
+if __name__ == "__main__":
+    main()
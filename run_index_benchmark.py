@@ -0,0 +1,97 @@
+# /run_index_benchmark.py
+
+import time
+
+import numpy as np
+
+from src.system.gallery import Gallery
+from src.system.index import ExactIndex, IVFIndex, ShardedIndex
+
+# ベンチマークするギャラリーの行数と、IVFで照合するリスト数
+GALLERY_SIZES = [1000, 10000, 100000, 200000]
+N_PROBES = [1, 4, 16, 64]
+# 分割して並列に照合するシャード数
+N_SHARDS = [2, 4, 8]
+NUM_QUERIES = 200
+SEED = 0
+
+
+def make_synthetic_gallery(num_rows: int, rng: np.random.Generator) -> Gallery:
+    """
+    顔エンコーディングに似た分布を持つ合成ギャラリーを作成する
+
+    各ユーザーの中心をランダムに作り、その周りに2件ずつエンコーディングを置く
+    """
+    num_users = max(1, num_rows // 2)
+    centers = rng.normal(0.0, 0.1, size=(num_users, 128)).astype(np.float32)
+    user_index = np.arange(num_rows) % num_users
+    matrix = centers[user_index] + rng.normal(0.0, 0.02, size=(num_rows, 128))
+    return Gallery(matrix, user_index, [str(i) for i in range(num_users)])
+
+
+def measure(index, queries: np.ndarray) -> tuple:
+    """
+    1クエリずつ探索して、結果の行番号と1クエリあたりの平均時間(ms)を返す
+    """
+    rows = np.empty(len(queries), dtype=np.int64)
+    start = time.perf_counter()
+    for i, query in enumerate(queries):
+        _, top_rows = index.search(query, k=1)
+        rows[i] = top_rows[0, 0]
+    elapsed = time.perf_counter() - start
+    return rows, elapsed * 1000 / len(queries)
+
+
+def main():
+    # ギャラリーの規模ごとに、厳密探索・シャード分割・IVFの再現率と遅延を比較する
+    print("--- Starting Index Benchmark ---")
+    rng = np.random.default_rng(SEED)
+
+    print(
+        f"{'rows':>8}{'backend':>10}{'n_probe':>9}"
+        f"{'build_s':>9}{'recall@1':>10}{'ms/query':>10}"
+    )
+    for num_rows in GALLERY_SIZES:
+        gallery = make_synthetic_gallery(num_rows, rng)
+
+        # クエリは登録済みのエンコーディングに少しノイズを加えたもの
+        picked = rng.choice(num_rows, NUM_QUERIES, replace=False)
+        queries = gallery.matrix[picked] + rng.normal(
+            0.0, 0.02, size=(NUM_QUERIES, 128)
+        ).astype(np.float32)
+
+        exact = ExactIndex(gallery)
+        truth, exact_ms = measure(exact, queries)
+        print(
+            f"{num_rows:>8}{'exact':>10}{'-':>9}"
+            f"{0.0:>9.2f}{1.0:>10.3f}{exact_ms:>10.3f}"
+        )
+
+        for n_shards in N_SHARDS:
+            start = time.perf_counter()
+            sharded = ShardedIndex(gallery, n_shards=n_shards, min_shard_rows=0)
+            build_seconds = time.perf_counter() - start
+            rows, sharded_ms = measure(sharded, queries)
+            recall = float(np.mean(rows == truth))
+            print(
+                f"{num_rows:>8}{f'shard{n_shards}':>10}{'-':>9}"
+                f"{build_seconds:>9.2f}{recall:>10.3f}{sharded_ms:>10.3f}"
+            )
+
+        start = time.perf_counter()
+        ivf = IVFIndex(gallery, seed=SEED)
+        build_seconds = time.perf_counter() - start
+        for n_probe in N_PROBES:
+            ivf.n_probe = n_probe
+            rows, ivf_ms = measure(ivf, queries)
+            recall = float(np.mean(rows == truth))
+            print(
+                f"{num_rows:>8}{'ivf':>10}{n_probe:>9}"
+                f"{build_seconds:>9.2f}{recall:>10.3f}{ivf_ms:>10.3f}"
+            )
+
+    print("\nIndex Benchmark Finished.")
+
+
+if __name__ == "__main__":
+    main()
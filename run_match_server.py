@@ -0,0 +1,35 @@
+# /run_match_server.py
+
+import os
+
+from src.system.data_manager import DataManager
+from src.system.face_processor import FaceProcessor
+from src.system.match_server import DEFAULT_SOCKET_PATH, MatchServer
+from src.system.services import AuthenticationService
+
+# 待ち受けるソケットのパス (カメラ側のプロセスにも同じパスを設定する)
+SOCKET_PATH = os.environ.get("MATCH_SERVER_SOCKET", DEFAULT_SOCKET_PATH)
+
+
+def main():
+    # ギャラリーを1つのプロセスで保持し、同じホストの各カメラプロセスに照合を提供する
+    print("--- Starting Match Server ---")
+
+    data_manager = DataManager()
+    face_processor = FaceProcessor()
+    auth_service = AuthenticationService(
+        data_manager=data_manager, face_processor=face_processor, tolerance=0.55
+    )
+
+    server = MatchServer(auth_service, socket_path=SOCKET_PATH)
+    print(f"Listening on: {SOCKET_PATH} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nMatch server stopped by user (Ctrl+C).")
+
+    print("Match Server Finished.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+# /run_publish_gallery.py
+
+import os
+
+from src.system.data_manager import DataManager
+from src.system.gallery import Gallery
+from src.system.shared_gallery import DEFAULT_MANIFEST_PATH, SharedGalleryStore
+
+# ワーカー側にも同じマニフェストのパスを設定する
+MANIFEST_PATH = os.environ.get("SHARED_GALLERY_MANIFEST", DEFAULT_MANIFEST_PATH)
+
+
+def main():
+    # encodings.pickleを共有メモリに公開し、各ワーカープロセスからアタッチできるようにする
+    # ワーカーの起動前に一度実行し、エンコーディングを再構築した後にも実行する
+    print("--- Starting Shared Gallery Publish ---")
+
+    data_manager = DataManager()
+    encoding_data = data_manager.load_encodings()
+    if not encoding_data:
+        print("Error: Could not load encodings. Please build them first.")
+        return
+
+    gallery = Gallery.from_encodings(
+        encoding_data.get("encodings", []), encoding_data.get("user_ids", [])
+    )
+    store = SharedGalleryStore(manifest_path=MANIFEST_PATH)
+    version = store.publish(gallery)
+
+    print(f"Published {len(gallery)} encodings as version {version}.")
+    print(f"Manifest: {MANIFEST_PATH}")
+    print("Shared Gallery Publish Finished.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+import json
+import os
+import traceback
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+import numpy as np
+
+from ..utils.logger import setup_logger
+from ..utils.tracing import configure_tracing
+from .async_auth import AsyncAuthenticator
+from .batch_auth import BatchAuthenticator
+from .camera import Camera, SimulatedCamera
+from .data_manager import DataManager
+from .face_processor import FaceProcessor
+from .gallery import Gallery
+from .gallery_registry import GalleryRegistry
+from .match_server import MatchClient
+from .mjpeg import MJPEGEncoder
+from .pipeline import StreamPipeline
+from .renderer import FrameRenderer
+from .services import AuthenticationService, EncodingService, RegistrationService
+from .shared_gallery import SharedGalleryStore
+from .snapshot import SnapshotService
+from .stream_processor import StreamProcessor
+
+# --- アプリケーション設定 ---
+USE_REAL_CAMERA = True
+REGISTRATION_PASSWORD = "704lIlac"  # 登録モードに入るためのパスワード
+# 照合サーバーのソケット (指定された場合はギャラリーを読み込まずにサーバーへ照合を依頼する)
+MATCH_SERVER_SOCKET = os.environ.get("MATCH_SERVER_SOCKET")
+# 共有ギャラリーのマニフェスト (指定された場合は各ワーカーが共有メモリのギャラリーを参照する)
+SHARED_GALLERY_MANIFEST = os.environ.get("SHARED_GALLERY_MANIFEST")
+# フレームごとのトレースの出力先 (指定された場合のみ、一部のフレームの各ステージを記録する)
+TRACE_PATH = os.environ.get("FACE_AUTH_TRACE")
+TRACE_SAMPLE_RATE = float(os.environ.get("FACE_AUTH_TRACE_SAMPLE_RATE", "0.05"))
+# テナント(拠点)ごとのギャラリーを格納するディレクトリ
+# (指定された場合のみ、/tenants/<テナントID>/authenticate_batch でテナントのギャラリーと照合する)
+TENANTS_ROOT = os.environ.get("FACE_AUTH_TENANTS_ROOT")
+# 同時にメモリに読み込むテナントのギャラリーの合計サイズの上限
+TENANTS_MEMORY_BUDGET_BYTES = int(
+    os.environ.get("FACE_AUTH_TENANTS_MEMORY_BUDGET", str(512 * 1024 * 1024))
+)
+
+# --- UIとロジックに関する定数 ---
+FRAME_WIDTH, FRAME_HEIGHT = 1280, 720
+GUIDE_BOX_WIDTH, GUIDE_BOX_HEIGHT = 350, 450
+GUIDE_BOX_RECT = (
+    (FRAME_WIDTH - GUIDE_BOX_WIDTH) // 2,
+    (FRAME_HEIGHT - GUIDE_BOX_HEIGHT) // 2,
+    GUIDE_BOX_WIDTH,
+    GUIDE_BOX_HEIGHT,
+)
+POSITION_THRESHOLD, SIZE_THRESHOLD = 50, 0.5
+FONT_PATH = "ipaexg.ttf"
+# 配信する映像の幅, JPEGの画質, 上限フレームレート (解析は元の解像度で行う)
+PREVIEW_WIDTH, JPEG_QUALITY, PREVIEW_MAX_FPS = 640, 70, 15
+# 顔の枠と名前をブラウザで描画する (映像には描画せず、解析結果は/eventsで配信する)
+CLIENT_OVERLAYS = True
+# バッチ認証APIで顔検出を行うスレッド数 (配信の解析用に1コアを残す)
+BATCH_AUTH_WORKERS = max(1, (os.cpu_count() or 1) - 1)
+# バッチ認証APIでtarとして受け付けるContent-Type
+TAR_CONTENT_TYPES = ("application/x-tar", "application/gzip", "application/x-gzip")
+# バッチ認証APIで受け付けるリクエスト本体の上限
+MAX_BATCH_UPLOAD_BYTES = 512 * 1024 * 1024
+
+
+# --- ヘルパー関数 ---
+def get_box_center(box):
+    """
+    矩形の中心を計算する
+    """
+    x, y, w, h = box
+    return x + w // 2, y + h // 2
+
+
+def get_box_area(box):
+    """
+    矩形の面積を計算する
+    """
+    _, _, w, h = box
+    return w * h
+
+
+def get_face_properties(location):
+    """
+    顔の位置とサイズを計算する
+    """
+    top, right, bottom, left = location
+    w = right - left
+    h = bottom - top
+    area = w * h
+    return (left, top, w, h), area
+
+
+def calculate_face_metrics(face_box, face_area):
+    """
+    顔の位置と大きさを計算し、その指標を返す
+    """
+    guide_center = get_box_center(GUIDE_BOX_RECT)
+    face_center = get_box_center(face_box)
+
+    distance = np.linalg.norm(np.array(guide_center) - np.array(face_center))
+    size_ratio = face_area / get_box_area(GUIDE_BOX_RECT)
+
+    return distance, size_ratio
+
+
+class AppState:
+    """
+    アプリケーションの状態 (モードとキャプチャしたフレーム)
+    """
+
+    def __init__(self):
+        self.mode = "AUTHENTICATING"
+        self.captured_frame = None
+        self.captured_location = None
+        self.captured_encoding = None
+        self.last_auth_result = {}
+
+
+class AppContext:
+    """
+    Webアプリケーションのサービスと状態をまとめて構築するクラス
+
+    Flask版(test_app.py)とASGI版(asgi_app.py)のエントリーポイントは、それぞれこのクラスの
+    インスタンスを1つ作り、同じサービスと状態の操作をエンドポイントから呼び出す
+    (Webフレームワークには依存しない)
+    """
+
+    def __init__(self, use_real_camera: bool = USE_REAL_CAMERA):
+        """
+        AppContextのコンストラクタ
+
+        サービス, カメラ, 処理パイプラインを初期化する (処理パイプラインは最初の視聴者が
+        接続した時、またはstream_pipeline.start()で開始する)
+
+        Args:
+            use_real_camera (bool): Trueの場合は実際のカメラ、Falseの場合は
+                                    シミュレーションのカメラを使う
+
+        Raises:
+            Exception: カメラを初期化できない場合
+        """
+        self.logger = setup_logger(__name__)
+
+        if TRACE_PATH:
+            configure_tracing(TRACE_PATH, sample_rate=TRACE_SAMPLE_RATE)
+            self.logger.info(
+                "Frame tracing enabled.",
+                extra={"trace_path": TRACE_PATH, "sample_rate": TRACE_SAMPLE_RATE},
+            )
+
+        self.app_state = AppState()
+
+        # --- サービスの初期化 ---
+        self.data_manager = DataManager()
+        self.face_processor = FaceProcessor()
+        self.shared_gallery = (
+            SharedGalleryStore(SHARED_GALLERY_MANIFEST)
+            if SHARED_GALLERY_MANIFEST
+            else None
+        )
+        if MATCH_SERVER_SOCKET:
+            self.auth_service = MatchClient(
+                MATCH_SERVER_SOCKET, face_processor=self.face_processor
+            )
+        else:
+            self.auth_service = AuthenticationService(
+                self.data_manager,
+                self.face_processor,
+                tolerance=0.55,
+                shared_gallery=self.shared_gallery,
+            )
+        self.registration_service = RegistrationService(
+            self.data_manager, self.face_processor
+        )
+        self.encoding_service = EncodingService(self.data_manager, self.face_processor)
+        self.gallery_registry = (
+            GalleryRegistry(
+                TENANTS_ROOT,
+                self.face_processor,
+                memory_budget_bytes=TENANTS_MEMORY_BUDGET_BYTES,
+                service_params={"tolerance": 0.55},
+            )
+            if TENANTS_ROOT
+            else None
+        )
+
+        # カメラの初期化
+        try:
+            self.camera = Camera() if use_real_camera else SimulatedCamera()
+        except Exception as e:
+            self.logger.error(
+                f"Error initializing camera: {e}",
+                extra={
+                    "error": str(e),
+                    "traceback": traceback.format_exc(),
+                },
+            )
+            raise
+
+        font_path = FONT_PATH
+        if not os.path.exists(font_path):
+            self.logger.warning(
+                "Warning: Font file not found. "
+                "Japanese text may not display correctly.",
+                extra={
+                    "font_path": font_path,
+                },
+            )
+            font_path = ""
+
+        # --- ビデオストリーミングのメインロジック ---
+        # 取得・解析・描画を別スレッドで処理し、映像はカメラのフレームレートで配信する
+        self.stream_processor = StreamProcessor(
+            camera=self.camera,
+            face_processor=self.face_processor,
+            auth_service=self.auth_service,
+            renderer=FrameRenderer(font_path),
+            app_state=self.app_state,
+            config={
+                "GUIDE_BOX_RECT": GUIDE_BOX_RECT,
+                "POSITION_THRESHOLD": POSITION_THRESHOLD,
+                "SIZE_THRESHOLD": SIZE_THRESHOLD,
+                "get_face_properties": get_face_properties,
+                "calculate_face_metrics": calculate_face_metrics,
+            },
+            encoder=MJPEGEncoder(
+                preview_width=PREVIEW_WIDTH,
+                quality=JPEG_QUALITY,
+                max_fps=PREVIEW_MAX_FPS,
+            ),
+            authenticator=AsyncAuthenticator(self.auth_service, timeout=2.0),
+        )
+        self.stream_pipeline = StreamPipeline(
+            self.stream_processor, server_overlays=not CLIENT_OVERLAYS
+        )
+        self.snapshot_service = SnapshotService(self.stream_pipeline.broadcaster)
+        self.batch_authenticator = BatchAuthenticator(
+            self.face_processor, self.auth_service, max_workers=BATCH_AUTH_WORKERS
+        )
+
+    # --- 状態の操作 ---
+    def change_mode(self, mode: str, discard_capture: bool = False):
+        """
+        アプリケーションのモードを変更する (必要であればキャプチャしたフレームを破棄する)
+
+        Args:
+            mode (str): 新しいモード
+            discard_capture (bool): Trueの場合、キャプチャしたフレームを破棄する
+        """
+        app_state = self.app_state
+        app_state.mode = mode
+        if discard_capture:
+            app_state.captured_frame = None
+            app_state.captured_location = None
+            app_state.captured_encoding = None
+        self.logger.info(f"Mode changed to {mode}")
+
+    def get_status(self) -> Dict:
+        """
+        フロントエンドに返すアプリケーションの状態
+
+        Returns:
+            Dict: モード, キャプチャの有無, 処理パイプラインの動作点
+        """
+        return {
+            "mode": self.app_state.mode,
+            "isFrameCaptured": self.app_state.captured_frame is not None,
+            "pipeline": self.stream_pipeline.operating_point(),
+        }
+
+    def register_captured_user(self, user_name: str):
+        """
+        キャプチャしたフレームでユーザーを登録し、認証に使うギャラリーを更新する
+
+        エンコーディングの再構築を含むため時間がかかる
+
+        Args:
+            user_name (str): 登録するユーザーの名前
+        """
+        app_state = self.app_state
+        self.registration_service.register_new_user(
+            name=user_name,
+            images=[app_state.captured_frame],
+            face_locations=[app_state.captured_location],
+            face_encodings=(
+                None
+                if app_state.captured_encoding is None
+                else [app_state.captured_encoding]
+            ),
+        )
+        self.encoding_service.build_encodings_from_dataset()
+        if self.shared_gallery is not None and not MATCH_SERVER_SOCKET:
+            # 新しいバージョンを公開すると、全ワーカーがアタッチし直す
+            encoding_data = self.data_manager.load_encodings() or {}
+            self.shared_gallery.publish(
+                Gallery.from_encodings(
+                    encoding_data.get("encodings", []),
+                    encoding_data.get("user_ids", []),
+                )
+            )
+        else:
+            self.auth_service.reload_knowledge()
+
+        self.change_mode("AUTHENTICATING", discard_capture=True)  # 認証モードに戻る
+
+    def tenant_service(self, tenant_id: str) -> AuthenticationService:
+        """
+        テナントのギャラリーを持つ認証サービスを返す (読み込まれていなければ読み込む)
+
+        Args:
+            tenant_id (str): テナント(拠点)のID
+
+        Returns:
+            AuthenticationService: テナントの認証サービス
+
+        Raises:
+            ValueError: テナントIDに使えない文字が含まれる場合
+            KeyError: テナントが有効でない(TENANTS_ROOTが未設定)か、存在しない場合
+        """
+        if self.gallery_registry is None:
+            raise KeyError(tenant_id)
+        return self.gallery_registry.get(tenant_id)
+
+    def tenant_stats(self) -> Optional[Dict]:
+        """
+        テナントの一覧と、読み込み済みのテナントのメモリ使用量を返す
+
+        Returns:
+            Optional[Dict]: テナントの情報 (テナントが有効でない場合はNone)
+        """
+        if self.gallery_registry is None:
+            return None
+        return {
+            "tenants": self.gallery_registry.list_tenants(),
+            **self.gallery_registry.stats(),
+        }
+
+    def batch_result_lines(
+        self, images: Iterable[Tuple[str, bytes]], auth_service=None
+    ) -> Iterator[bytes]:
+        """
+        バッチ認証の結果を、完了した画像から1行ずつJSON (NDJSON) で返すジェネレータ
+
+        Args:
+            images (Iterable[Tuple[str, bytes]]): (ファイル名, 画像のバイト列) の列
+            auth_service (AuthenticationService): 照合に使う認証サービス
+                                                  (Noneの場合は配信と同じギャラリー)
+
+        Returns:
+            Iterator[bytes]: 画像ごとの結果のJSONの行
+        """
+        for result in self.batch_authenticator.authenticate(images, auth_service):
+            yield json.dumps(result, ensure_ascii=False).encode("utf-8") + b"\n"
@@ -0,0 +1,177 @@
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Set
+
+from ..utils import tracing
+from ..utils.logger import setup_logger
+
+
+class AsyncAuthenticator:
+    """
+    顔の照合をストリームのスレッドから切り離して実行するクラス
+
+    照合はスレッドプールに投入してFutureを受け取り、ストリーム側は照合の完了を
+    待たずに次のフレームの処理を続ける。トラック(人物)ごとに実行中の照合は1つまでとし、
+    timeout秒を超えても開始されない照合や、人物が映らなくなったトラックの照合は取り消す
+
+    実行を開始した照合は途中で止められないため、取り消す代わりに結果を破棄し、
+    完了するまでは同じトラックの照合を再投入しない (止まった照合の後ろに
+    同じトラックの照合が積み重なっていかないようにする)
+    """
+
+    def __init__(self, auth_service, max_workers: int = 1, timeout: float = 2.0):
+        """
+        AsyncAuthenticatorのコンストラクタ
+
+        Args:
+            auth_service (AuthenticationService): 照合を行う認証サービス
+            max_workers (int): 照合を実行するスレッド数
+            timeout (float): 1回の照合を待つ最大秒数
+        """
+        self.logger = setup_logger(__name__)
+        self.auth_service = auth_service
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="auth-worker"
+        )
+        # トラックID -> (Future, 投入時刻)
+        self._pending: Dict[int, tuple] = {}
+        # 実行中にtimeout秒を超えたトラックID (警告を1回だけ出すため)
+        self._overdue: Set[int] = set()
+        # トラックID -> 取り消したが実行中のため止められなかった照合のFuture
+        self._abandoned: Dict[int, Future] = {}
+
+    def submit(self, track_id: int, face_data: Dict, top_k: int = 2) -> Future:
+        """
+        トラックの顔の照合を投入する
+        (実行中の照合や、取り消したがまだ実行中の照合がある場合はそれを返す)
+
+        Args:
+            track_id (int): FaceTrackerが割り当てたトラックID
+            face_data (Dict): "location"と"encoding"を含む顔データ
+            top_k (int): authenticate_faceに渡す上位候補の人数
+
+        Returns:
+            Future: authenticate_faceの結果を返すFuture
+        """
+        pending = self._pending.get(track_id)
+        if pending is not None:
+            return pending[0]
+        if self._is_abandoned_running(track_id):
+            return self._abandoned[track_id]
+        future = self._executor.submit(
+            self._authenticate, tracing.current_frame(), face_data, top_k
+        )
+        self._pending[track_id] = (future, time.monotonic())
+        return future
+
+    def _authenticate(self, frame_id: Optional[int], face_data: Dict, top_k: int):
+        # 照合のスパンを、照合を依頼したフレームのトレースに含める
+        tracing.bind_frame(frame_id)
+        try:
+            return self.auth_service.authenticate_face(face_data, top_k)
+        finally:
+            tracing.bind_frame(None)
+
+    def is_pending(self, track_id: int) -> bool:
+        """
+        トラックの照合が実行中(結果を未取得)かを返す
+
+        取り消したが実行中のため止められなかった照合がある場合もTrueを返す
+        (完了するまでは再投入しない)
+        """
+        return track_id in self._pending or self._is_abandoned_running(track_id)
+
+    def _is_abandoned_running(self, track_id: int) -> bool:
+        future = self._abandoned.get(track_id)
+        if future is None:
+            return False
+        if future.done():
+            del self._abandoned[track_id]
+            return False
+        return True
+
+    def poll(self, track_id: int) -> Optional[List[Dict]]:
+        """
+        トラックの照合が完了していれば結果を返す
+
+        完了していない場合、照合が失敗した場合、タイムアウトで取り消した場合はNoneを返す
+        (失敗・取り消しの場合は実行中の照合がなくなるため、次のフレームで再投入できる)
+
+        タイムアウトで取り消すのは、timeout秒を超えても実行が始まっていない照合だけで、
+        実行中の照合は警告を出して完了を待ち続ける
+
+        Returns:
+            Optional[List[Dict]]: authenticate_faceの結果
+        """
+        pending = self._pending.get(track_id)
+        if pending is None:
+            return None
+        future, submitted_at = pending
+
+        if not future.done():
+            if time.monotonic() - submitted_at > self.timeout:
+                if future.cancel():
+                    # 実行待ちのまま時間切れになった照合は取り消し、次のフレームで再投入する
+                    del self._pending[track_id]
+                    self.logger.warning(
+                        "Authentication timed out in queue.",
+                        extra={"track_id": track_id, "timeout": self.timeout},
+                    )
+                elif track_id not in self._overdue:
+                    self._overdue.add(track_id)
+                    self.logger.warning(
+                        "Authentication is taking longer than the timeout.",
+                        extra={"track_id": track_id, "timeout": self.timeout},
+                    )
+            return None
+
+        del self._pending[track_id]
+        self._overdue.discard(track_id)
+        try:
+            return future.result()
+        except Exception as e:
+            self.logger.error(
+                "Authentication failed.",
+                extra={
+                    "track_id": track_id,
+                    "error": str(e),
+                    "traceback": traceback.format_exc(),
+                },
+            )
+            return None
+
+    def cancel(self, track_id: int):
+        """
+        トラックの照合を取り消す
+
+        実行中の場合は止められないため結果を破棄し、完了するまで同じトラックの照合を
+        再投入しないように記録する
+        """
+        self._overdue.discard(track_id)
+        pending = self._pending.pop(track_id, None)
+        if pending is not None and not pending[0].cancel() and not pending[0].done():
+            self._abandoned[track_id] = pending[0]
+
+    def prune(self, active_track_ids: Iterable[int]):
+        """
+        追跡が終わったトラックの照合を取り消す
+        """
+        active = set(active_track_ids)
+        for track_id in list(self._pending):
+            if track_id not in active:
+                self.cancel(track_id)
+        # 終わったトラックは再投入されないため、止められなかった照合の記録は不要になる
+        for track_id in list(self._abandoned):
+            if track_id not in active or self._abandoned[track_id].done():
+                del self._abandoned[track_id]
+
+    def shutdown(self):
+        """
+        実行待ちの照合を取り消してスレッドプールを終了する
+        """
+        for track_id in list(self._pending):
+            self.cancel(track_id)
+        self._abandoned.clear()
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,77 @@
+import asyncio
+import threading
+from typing import AsyncIterator, Optional, Set
+
+from ..utils.logger import setup_logger
+from .broadcast import FrameBroadcaster
+
+
+class AsyncFrameFanout:
+    """
+    FrameBroadcasterのフレームをasyncioのイベントループ上の視聴者に配信するクラス
+
+    FrameBroadcasterを購読するスレッドは1つだけで、受け取ったフレームは
+    視聴者ごとの容量1のasyncio.Queueに入れる (古いフレームは捨てる)
+    視聴者はスレッドを持たないため、待機中や受信の遅い接続が増えてもスレッドは増えない
+    """
+
+    def __init__(self, broadcaster: FrameBroadcaster):
+        """
+        AsyncFrameFanoutのコンストラクタ
+
+        Args:
+            broadcaster (FrameBroadcaster): 処理ループがフレームを公開するインスタンス
+        """
+        self.logger = setup_logger(__name__)
+        self.broadcaster = broadcaster
+        self._queues: Set[asyncio.Queue] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def subscriber_count(self) -> int:
+        """
+        現在の視聴者数
+        """
+        return len(self._queues)
+
+    def start(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        """
+        FrameBroadcasterの購読を開始する (イベントループ上から呼び出す)
+        """
+        if self._thread is not None:
+            return
+        self._loop = loop or asyncio.get_running_loop()
+        self._thread = threading.Thread(
+            target=self._pump, name="async-fanout", daemon=True
+        )
+        self._thread.start()
+
+    def _pump(self):
+        for frame in self.broadcaster.subscribe():
+            self._loop.call_soon_threadsafe(self._publish, frame)
+
+    def _publish(self, frame: bytes):
+        # イベントループのスレッドで実行されるため、キューの操作にロックは不要
+        for queue in self._queues:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(frame)
+
+    async def subscribe(self) -> AsyncIterator[bytes]:
+        """
+        新しいフレームが公開されるたびにそれを返す非同期ジェネレータ
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+        self._queues.add(queue)
+        self.logger.info(
+            "Async viewer subscribed.", extra={"subscribers": len(self._queues)}
+        )
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._queues.discard(queue)
+            self.logger.info(
+                "Async viewer unsubscribed.", extra={"subscribers": len(self._queues)}
+            )
@@ -0,0 +1,244 @@
+import math
+import os
+import tarfile
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import IO, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from ..utils.logger import setup_logger
+from ..utils.metrics import REGISTRY, stage_timer
+
+# バッチ認証の対象とする画像の拡張子 (test_run_authenticate.pyと同じ形式 + .jpeg)
+IMAGE_EXTENSIONS = (".pgm", ".jpg", ".jpeg", ".png")
+
+BATCH_IMAGES = REGISTRY.counter(
+    "face_auth_batch_images_total",
+    "Images processed by the batch authentication API.",
+    ("result",),
+)
+
+
+def iter_tar_images(stream: IO[bytes]) -> Iterator[Tuple[str, bytes]]:
+    """
+    tarのストリームから画像ファイルを順に読み出す
+
+    ストリームとして読むため、アーカイブ全体を受信する前に最初の画像から処理を始められる
+
+    Args:
+        stream (IO[bytes]): tar (gzipなどの圧縮も可) のバイトストリーム
+
+    Returns:
+        Iterator[Tuple[str, bytes]]: (ファイル名, 画像のバイト列) のイテレータ
+    """
+    with tarfile.open(fileobj=stream, mode="r|*") as archive:
+        for member in archive:
+            if not member.isfile() or not member.name.lower().endswith(
+                IMAGE_EXTENSIONS
+            ):
+                continue
+            f = archive.extractfile(member)
+            if f is not None:
+                yield member.name, f.read()
+
+
+def _to_milliseconds(timings: Dict[str, float]) -> Dict[str, float]:
+    return {stage: round(seconds * 1000, 3) for stage, seconds in timings.items()}
+
+
+class BatchAuthenticator:
+    """
+    アップロードされた複数の画像をまとめて認証するクラス
+
+    画像のデコードは画像ごとにスレッドプールで並列に行い、完了した画像の顔はまとめて
+    1回のmatch_batchで照合する。顔検出とエンコーディングの抽出はdlibのモデルが
+    スレッドセーフではないため、FaceProcessorのロックで配信パイプラインとも共有して
+    1枚ずつ実行する。結果は入力の順番ではなく、照合が完了した画像から順に返す
+    """
+
+    def __init__(
+        self,
+        face_processor,
+        auth_service,
+        max_workers: Optional[int] = None,
+        max_pending: Optional[int] = None,
+    ):
+        """
+        BatchAuthenticatorのコンストラクタ
+
+        Args:
+            face_processor (FaceProcessor): 顔検出とエンコーディングの抽出を行うインスタンス
+            auth_service (AuthenticationService): 照合を行う認証サービス
+                                                  (MatchClientも可)
+            max_workers (Optional[int]): 画像のデコードと顔検出を行うスレッド数
+                                         (顔検出とエンコーディングは1枚ずつ実行する)
+                                         Noneの場合はCPUのコア数
+            max_pending (Optional[int]): 1リクエストで同時に処理する画像の最大数
+                                         (読み込んだ画像を保持するメモリの上限)
+                                         Noneの場合はスレッド数の2倍
+        """
+        self.logger = setup_logger(__name__)
+        self.face_processor = face_processor
+        self.auth_service = auth_service
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.max_workers * 2
+        # 全てのリクエストでスレッドを共有し、同時に複数のリクエストが来ても
+        # CPUのコア数を超えてデコードを実行しないようにする
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="batch-auth"
+        )
+
+    def authenticate(
+        self, images: Iterable[Tuple[str, bytes]], auth_service=None
+    ) -> Iterator[Dict]:
+        """
+        画像を順に読み込みながら認証し、完了した画像から結果を返すジェネレータ
+
+        Args:
+            images (Iterable[Tuple[str, bytes]]): (ファイル名, 画像のバイト列) の列
+            auth_service (AuthenticationService): 照合に使う認証サービス
+                                                  (テナントごとのギャラリーなど)
+                                                  Noneの場合はコンストラクタで指定したもの
+
+        Returns:
+            Iterator[Dict]: 画像ごとの結果
+                            例: {"index": 0, "filename": "1.pgm",
+                                 "faces": [{"box": [t, r, b, l], "name": "...",
+                                            "userId": "...", "distance": 0.42}],
+                                 "timingsMs": {"decode": 1.2, "detection": 35.0, ...},
+                                 "batchSize": 3}
+                            画像が読み込めなかった場合は"faces"の代わりに"error"を含む
+                            (入力自体が途中で読めなくなった場合は"error"だけの結果を返す)
+        """
+        auth_service = auth_service or self.auth_service
+        images = iter(enumerate(images))
+        pending = set()
+        exhausted = False
+        try:
+            while True:
+                # 同時に処理する画像の数を保ちながら、次の画像を投入する
+                while not exhausted and len(pending) < self.max_pending:
+                    try:
+                        item = next(images, None)
+                    except Exception as e:
+                        # 壊れたtarなど、入力の途中で読めなくなった場合は
+                        # 読み込めた画像の結果だけを返す
+                        self.logger.error(
+                            f"Error reading uploaded images: {e}",
+                            extra={
+                                "error": str(e),
+                                "traceback": traceback.format_exc(),
+                            },
+                        )
+                        yield {"error": "Failed to read uploaded images."}
+                        item = None
+                    if item is None:
+                        exhausted = True
+                        break
+                    index, (filename, data) = item
+                    pending.add(
+                        self._executor.submit(self._prepare, index, filename, data)
+                    )
+                if not pending:
+                    break
+
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from self._match(
+                    [future.result() for future in done], auth_service
+                )
+        finally:
+            # クライアントが切断した場合、まだ開始していない画像の処理は取り消す
+            for future in pending:
+                future.cancel()
+
+    def _prepare(self, index: int, filename: str, data: bytes) -> Dict:
+        """
+        1枚の画像をデコードし、顔の位置とエンコーディングを抽出する (スレッドプールで実行)
+
+        デコードは並列に実行し、顔検出とエンコーディングはFaceProcessorのロックを待つ
+        """
+        result = {"index": index, "filename": filename}
+        timings = {}
+        try:
+            with stage_timer("decode", timings):
+                image = cv2.imdecode(
+                    np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR
+                )
+            if image is None:
+                result["error"] = "Failed to decode image."
+            else:
+                result["faces"] = self.face_processor.detect_and_encode_faces(
+                    image, timings=timings, source="batch"
+                )
+        except Exception as e:
+            self.logger.error(
+                f"Error processing uploaded image: {e}",
+                extra={
+                    "image_filename": filename,
+                    "error": str(e),
+                    "traceback": traceback.format_exc(),
+                },
+            )
+            result["error"] = "Failed to process image."
+        result["timings"] = timings
+        return result
+
+    def _match(self, prepared: List[Dict], auth_service) -> List[Dict]:
+        """
+        完了した画像の全ての顔をまとめて照合し、レスポンスの形式にする
+        """
+        faces = [face for item in prepared for face in item.get("faces", [])]
+        # 顔をまとめて照合した画像の数
+        batch_size = sum(1 for item in prepared if item.get("faces"))
+        matching_seconds = 0.0
+        matches = []
+        match_error = None
+        if faces:
+            started_at = time.perf_counter()
+            try:
+                matches = auth_service.match_batch([f["encoding"] for f in faces])
+            except Exception as e:
+                # 照合サーバーの障害などで照合できない場合も、ストリームは止めずに各画像の
+                # エラーとして返す
+                self.logger.error(
+                    f"Error matching uploaded images: {e}",
+                    extra={"error": str(e), "traceback": traceback.format_exc()},
+                )
+                match_error = "Failed to match faces."
+            matching_seconds = time.perf_counter() - started_at
+        matches = iter(matches)
+
+        results = []
+        for item in prepared:
+            result = {"index": item["index"], "filename": item["filename"]}
+            timings = item["timings"]
+            if match_error is not None and item.get("faces"):
+                item["error"] = match_error
+            if "error" in item:
+                result["error"] = item["error"]
+                BATCH_IMAGES.inc(result="error")
+            else:
+                result["faces"] = []
+                for face in item["faces"]:
+                    match = next(matches)
+                    distance = match["distance"]
+                    result["faces"].append(
+                        {
+                            "box": [int(v) for v in face["location"]],
+                            "name": match["name"],
+                            "userId": match["user_id"],
+                            # 登録者がいない場合の距離(inf)はJSONで表せないためnullにする
+                            "distance": distance if math.isfinite(distance) else None,
+                        }
+                    )
+                if item["faces"]:
+                    # 照合は完了した画像の顔をまとめて1回で行うため、その時間を共有する
+                    timings["matching"] = matching_seconds
+                    result["batchSize"] = batch_size
+                BATCH_IMAGES.inc(result="ok")
+            result["timingsMs"] = _to_milliseconds(timings)
+            results.append(result)
+        return results
@@ -0,0 +1,94 @@
+import threading
+import time
+from typing import Iterator, Optional, Tuple
+
+from ..utils.logger import setup_logger
+
+
+class FrameBroadcaster:
+    """
+    1つの処理ループが生成したフレームを、任意の数の視聴者に配信するクラス
+
+    保持するのは最新のフレーム1枚だけで、各視聴者は自分が最後に受け取った番号より
+    新しいフレームを待って受け取る。受信の遅い視聴者は途中のフレームを飛ばすだけで、
+    処理ループや他の視聴者を待たせることはない
+    """
+
+    def __init__(self):
+        self.logger = setup_logger(__name__)
+        self._condition = threading.Condition()
+        self._frame: Optional[bytes] = None
+        self._sequence = 0
+        self._published_at: Optional[float] = None
+        self._subscriber_count = 0
+        self._closed = False
+
+    @property
+    def subscriber_count(self) -> int:
+        """
+        現在の視聴者数
+        """
+        return self._subscriber_count
+
+    def publish(self, frame: bytes):
+        """
+        新しいフレームを公開し、待っている視聴者を起こす
+
+        Args:
+            frame (bytes): 配信するデータ (multipartの1パートなど)
+        """
+        with self._condition:
+            self._frame = frame
+            self._sequence += 1
+            self._published_at = time.time()
+            self._condition.notify_all()
+
+    def latest(self) -> Tuple[int, Optional[bytes], Optional[float]]:
+        """
+        最新のフレームの番号, フレーム, 公開した時刻(UNIX時間)を返す
+        (まだ公開されていない場合、フレームと時刻はNone)
+        """
+        with self._condition:
+            return self._sequence, self._frame, self._published_at
+
+    def subscribe(self, timeout: float = 1.0) -> Iterator[bytes]:
+        """
+        新しいフレームが公開されるたびにそれを返すジェネレータ
+
+        Args:
+            timeout (float): フレームを待つ間隔(秒), closeの確認に使う
+        """
+        with self._condition:
+            self._subscriber_count += 1
+            count = self._subscriber_count
+        self.logger.info("Viewer subscribed.", extra={"subscribers": count})
+
+        last_sequence = 0
+        try:
+            while True:
+                with self._condition:
+                    self._condition.wait_for(
+                        lambda: self._closed or self._sequence != last_sequence,
+                        timeout,
+                    )
+                    if self._closed:
+                        return
+                    if self._sequence == last_sequence:
+                        continue
+                    last_sequence = self._sequence
+                    frame = self._frame
+                # 送信中はロックを持たないため、遅い視聴者が他を待たせることはない
+                yield frame
+        finally:
+            with self._condition:
+                self._subscriber_count -= 1
+                count = self._subscriber_count
+            self.logger.info("Viewer unsubscribed.", extra={"subscribers": count})
+
+    def close(self):
+        """
+        配信を終了し、全ての視聴者のジェネレータを終わらせる
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
@@ -6,6 +6,11 @@ import cv2
 import numpy as np
 
 from ..utils.logger import setup_logger
+from ..utils.metrics import REGISTRY, stage_timer
+
+CAPTURE_FAILURES = REGISTRY.counter(
+    "face_auth_capture_failures_total", "Frames the camera failed to deliver."
+)
 
 
 class Camera:
@@ -54,8 +59,10 @@ class Camera:
         Returns:
             Optional[np.ndarray]: 成功した場合はキャプチャしたフレーム, 失敗した場合はNone
         """
-        success, frame = self.cap.read()
+        with stage_timer("capture"):
+            success, frame = self.cap.read()
         if not success:
+            CAPTURE_FAILURES.inc()
             self.logger.warning("Failed to capture frame from camera.")
             return None
         self.logger.debug("Captured frame from camera.")
@@ -119,8 +126,10 @@ class SimulatedCamera:
         """
         random_image_file = random.choice(self.image_files)
         frame_path = os.path.join(self.image_dir, random_image_file)
-        frame = cv2.imread(frame_path)
+        with stage_timer("capture"):
+            frame = cv2.imread(frame_path)
         if frame is None:
+            CAPTURE_FAILURES.inc()
             self.logger.warning(
                 "Failed to read simulated frame",
                 extra={"frame_path": frame_path},
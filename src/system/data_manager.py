@@ -2,13 +2,17 @@ import json
 import os
 import pickle
 import traceback
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
 import cv2
 import numpy as np
 
 from ..utils.logger import setup_logger
 
+# 顔位置キャッシュのファイル名 (dataset/ユーザーID/faces.json)
+FACE_CACHE_FILENAME = "faces.json"
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".pgm")
+
 
 class DataManager:
     """
@@ -96,13 +100,29 @@ class DataManager:
                 },
             )
 
-    def save_images_for_user(self, user_id: str, images: List[np.ndarray]) -> List[str]:
+    def save_images_for_user(
+        self,
+        user_id: str,
+        images: List[np.ndarray],
+        face_locations: Optional[List[Tuple[int, int, int, int]]] = None,
+        detector_settings: Optional[Dict] = None,
+        face_encodings: Optional[List[Optional[np.ndarray]]] = None,
+    ) -> List[str]:
         """
         指定されたユーザーの顔画像を保存する
 
+        登録時に検出済みの顔位置が渡された場合は、再構築時に顔検出を省略できるよう
+        顔位置キャッシュも合わせて保存する
+
         Args:
             user_id (str): ユーザーの一意な識別子
             images (List[np.ndarray]): OpenCVのndarray形式の画像のリスト
+            face_locations (Optional[List[Tuple[int, int, int, int]]]):
+                各画像の顔の位置 (top, right, bottom, left)
+            detector_settings (Optional[Dict]): 顔位置を検出した際の検出器の設定
+            face_encodings (Optional[List[Optional[np.ndarray]]]):
+                各画像の顔のエンコーディング
+                指定された場合はキャッシュに含め、再構築時のエンコードも省略できる
 
         Returns:
             List[str]: 画像が保存されたファイルパスのリスト
@@ -118,8 +138,90 @@ class DataManager:
             saved_paths.append(img_path)
 
         self.logger.info(f"Saved {len(saved_paths)} images for user_id: {user_id}")
+
+        if face_locations is not None and detector_settings is not None:
+            faces = {}
+            encodings = face_encodings or [None] * len(saved_paths)
+            for img_path, location, encoding in zip(
+                saved_paths, face_locations, encodings
+            ):
+                if location is None:
+                    continue
+                entry = {
+                    "signature": self.get_image_signature(img_path),
+                    "locations": [list(location)],
+                }
+                if encoding is not None:
+                    entry["encodings"] = [np.asarray(encoding).tolist()]
+                faces[os.path.basename(img_path)] = entry
+            self.save_face_cache(
+                user_id, {"detector": detector_settings, "faces": faces}
+            )
+
         return saved_paths
 
+    def get_image_signature(self, image_path: str) -> List[int]:
+        """
+        画像ファイルが変更されていないかを判定するための署名を返す
+
+        Args:
+            image_path (str): 画像ファイルのパス
+
+        Returns:
+            List[int]: ファイルサイズと更新時刻(ns)のリスト
+        """
+        stat = os.stat(image_path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def load_face_cache(self, user_id: str) -> Dict:
+        """
+        指定されたユーザーの顔位置キャッシュを読み込む
+
+        Args:
+            user_id (str): ユーザーの一意な識別子
+
+        Returns:
+            Dict: 'detector'と'faces'を含む辞書, 存在しない場合は空の辞書
+        """
+        cache_path = os.path.join(self.dataset_path, user_id, FACE_CACHE_FILENAME)
+        if not os.path.exists(cache_path):
+            return {}
+
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            self.logger.warning(
+                "Failed to read face cache. It will be rebuilt.",
+                extra={
+                    "cache_path": cache_path,
+                    "error": str(e),
+                },
+            )
+            return {}
+
+    def save_face_cache(self, user_id: str, cache: Dict):
+        """
+        指定されたユーザーの顔位置キャッシュを保存する
+
+        Args:
+            user_id (str): ユーザーの一意な識別子
+            cache (Dict): 'detector'と'faces'を含む辞書
+        """
+        cache_path = os.path.join(self.dataset_path, user_id, FACE_CACHE_FILENAME)
+        try:
+            with open(cache_path, "w", encoding="utf-8") as f:
+                json.dump(cache, f, indent=2)
+        except Exception as e:
+            self.logger.error(
+                "Failed to write face cache",
+                extra={
+                    "cache_path": cache_path,
+                    "error": str(e),
+                    "traceback": traceback.format_exc(),
+                },
+            )
+
     def save_encodings(self, encodings: List[np.ndarray], user_ids: List[str]):
         """
         顔のエンコーディングをユーザーIDと紐付けて保存する
@@ -130,8 +232,12 @@ class DataManager:
         """
         data = {"encodings": encodings, "user_ids": user_ids}
         try:
-            with open(self.encodings_path, "wb") as f:
+            # 読み込み中のプロセスが書きかけのファイルを読まないよう、
+            # 一時ファイルに書き出してから置き換える
+            tmp_path = f"{self.encodings_path}.tmp"
+            with open(tmp_path, "wb") as f:
                 f.write(pickle.dumps(data))
+            os.replace(tmp_path, self.encodings_path)
             self.logger.info(
                 f"Saved {len(encodings)} encodings",
                 extra={"encodings_path": self.encodings_path},
@@ -188,7 +294,11 @@ class DataManager:
         if not os.path.isdir(user_dir):
             return []
 
-        return [os.path.join(user_dir, fname) for fname in os.listdir(user_dir)]
+        return [
+            os.path.join(user_dir, fname)
+            for fname in sorted(os.listdir(user_dir))
+            if fname.lower().endswith(IMAGE_EXTENSIONS)
+        ]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,253 @@
+import math
+import time
+from collections import Counter
+from typing import Dict, Iterable, List, Optional
+
+from ..utils.logger import setup_logger
+
+# 判定結果
+ACCEPT = "accept"
+REJECT = "reject"
+NEED_MORE = "need_more"
+
+
+class EvidenceAccumulator:
+    """
+    1人分の複数フレームの照合結果を蓄積し、逐次的に判定するクラス
+
+    1フレームの距離には一定のばらつき(noise_std)があるとみなし、
+    平均距離の信頼区間が閾値の片側に収まった時点で判定を確定する
+    明確なケースは1フレームで、境界付近のケースは数フレームで確定し、
+    max_framesに達した場合は平均距離で判定する
+    """
+
+    def __init__(
+        self,
+        tolerance: float,
+        noise_std: float = 0.04,
+        confidence_z: float = 2.0,
+        min_margin: float = 0.05,
+        max_frames: int = 5,
+    ):
+        """
+        EvidenceAccumulatorのコンストラクタ
+
+        Args:
+            tolerance (float): 顔の類似度の閾値
+            noise_std (float): 1フレームあたりの距離のばらつき(標準偏差)の想定値
+            confidence_z (float): 信頼区間の幅 (標準偏差の何倍か)
+            min_margin (float): 受理に必要な1位と2位の平均距離差
+            max_frames (int): 判定に使う最大フレーム数
+        """
+        self.tolerance = tolerance
+        self.noise_std = noise_std
+        self.confidence_z = confidence_z
+        self.min_margin = min_margin
+        self.max_frames = max_frames
+
+        self.best_distances: List[float] = []
+        self.margins: List[float] = []
+        self.user_distances: Dict[str, List[float]] = {}
+        self.names: Dict[str, str] = {}
+        self.votes: Counter = Counter()
+
+    @property
+    def frame_count(self) -> int:
+        return len(self.best_distances)
+
+    def update(self, auth_result: Dict) -> Dict:
+        """
+        1フレーム分の照合結果を追加し、現時点の判定を返す
+
+        Args:
+            auth_result (Dict): authenticate_face(top_k=2以上)の結果の辞書
+                                "candidates"と"margin"を含む
+
+        Returns:
+            Dict: 判定結果の辞書
+                  例: {"decision": "accept", "user_id": "...", "name": "...",
+                       "distance": 0.41, "frames": 2}
+        """
+        candidates = auth_result.get("candidates", [])
+        if not candidates:
+            self.best_distances.append(math.inf)
+            self.margins.append(math.inf)
+        else:
+            self.best_distances.append(candidates[0]["distance"])
+            self.margins.append(auth_result.get("margin", math.inf))
+            self.votes[candidates[0]["user_id"]] += 1
+            for candidate in candidates:
+                self.user_distances.setdefault(candidate["user_id"], []).append(
+                    candidate["distance"]
+                )
+                self.names[candidate["user_id"]] = candidate["name"]
+
+        return self._decide()
+
+    def _decide(self) -> Dict:
+        """
+        蓄積した照合結果から判定を行う
+        """
+        n = self.frame_count
+        half_width = self.confidence_z * self.noise_std / math.sqrt(n)
+        mean_best = sum(self.best_distances) / n
+
+        # 最良距離の平均ですら閾値を明確に超えている場合は拒否
+        if mean_best - half_width > self.tolerance:
+            return self._result(REJECT, None, mean_best)
+
+        if not self.votes:
+            return self._result(
+                NEED_MORE if n < self.max_frames else REJECT, None, mean_best
+            )
+
+        # 最も多く1位になったユーザー (同数の場合は平均距離の小さい方)
+        leader = min(
+            self.votes,
+            key=lambda user_id: (-self.votes[user_id], self._mean_distance(user_id)),
+        )
+        leader_distance = self._mean_distance(leader)
+        finite_margins = [m for m in self.margins if math.isfinite(m)]
+        mean_margin = (
+            sum(finite_margins) / len(finite_margins) if finite_margins else math.inf
+        )
+
+        consistent = self.votes[leader] == n
+        if (
+            consistent
+            and leader_distance + half_width <= self.tolerance
+            and mean_margin >= self.min_margin
+        ):
+            return self._result(ACCEPT, leader, leader_distance)
+
+        if n < self.max_frames:
+            return self._result(NEED_MORE, leader, leader_distance)
+
+        # フレーム数の上限に達した場合は平均距離と多数決で判定する
+        if (
+            self.votes[leader] * 2 > n
+            and leader_distance <= self.tolerance
+            and mean_margin >= self.min_margin
+        ):
+            return self._result(ACCEPT, leader, leader_distance)
+        return self._result(REJECT, None, mean_best)
+
+    def _mean_distance(self, user_id: str) -> float:
+        distances = self.user_distances.get(user_id, [])
+        return sum(distances) / len(distances) if distances else math.inf
+
+    def _result(self, decision: str, user_id: Optional[str], distance: float) -> Dict:
+        name = "Unknown"
+        if decision == ACCEPT and user_id is not None:
+            name = self.names.get(user_id, "Unknown")
+        return {
+            "decision": decision,
+            "user_id": user_id if decision == ACCEPT else None,
+            "name": name,
+            "distance": distance,
+            "frames": self.frame_count,
+        }
+
+
+class SequentialDecider:
+    """
+    カメラの前の人物(トラック)ごとにEvidenceAccumulatorを管理するクラス
+
+    確定した判定はdecision_ttl秒の間保持し、その間は同じ人物の照合を省略できる
+    """
+
+    def __init__(
+        self,
+        tolerance: float,
+        noise_std: float = 0.04,
+        confidence_z: float = 2.0,
+        min_margin: float = 0.05,
+        max_frames: int = 5,
+        decision_ttl: float = 3.0,
+    ):
+        """
+        SequentialDeciderのコンストラクタ
+
+        Args:
+            tolerance (float): 顔の類似度の閾値
+            noise_std (float): 1フレームあたりの距離のばらつきの想定値
+            confidence_z (float): 信頼区間の幅 (標準偏差の何倍か)
+            min_margin (float): 受理に必要な1位と2位の平均距離差
+            max_frames (int): 判定に使う最大フレーム数
+            decision_ttl (float): 確定した判定を保持する秒数
+        """
+        self.logger = setup_logger(__name__)
+        self.accumulator_params = {
+            "tolerance": tolerance,
+            "noise_std": noise_std,
+            "confidence_z": confidence_z,
+            "min_margin": min_margin,
+            "max_frames": max_frames,
+        }
+        self.decision_ttl = decision_ttl
+        self._accumulators: Dict[int, EvidenceAccumulator] = {}
+        self._decisions: Dict[int, Dict] = {}
+
+    def get_decision(self, track_id: int) -> Optional[Dict]:
+        """
+        トラックの確定済みの判定を返す (保持期間を過ぎた場合はNone)
+        """
+        decision = self._decisions.get(track_id)
+        if decision is None:
+            return None
+        if time.monotonic() - decision["decided_at"] > self.decision_ttl:
+            self.reset(track_id)
+            return None
+        return decision
+
+    def update(self, track_id: int, auth_result: Dict) -> Dict:
+        """
+        トラックに1フレーム分の照合結果を追加し、判定を返す
+
+        Args:
+            track_id (int): FaceTrackerが割り当てたトラックID
+            auth_result (Dict): authenticate_face(top_k=2以上)の結果の辞書
+
+        Returns:
+            Dict: 判定結果の辞書 ("decision"がaccept/reject/need_moreのいずれか)
+        """
+        accumulator = self._accumulators.get(track_id)
+        if accumulator is None:
+            accumulator = EvidenceAccumulator(**self.accumulator_params)
+            self._accumulators[track_id] = accumulator
+
+        result = accumulator.update(auth_result)
+        if result["decision"] != NEED_MORE:
+            result["decided_at"] = time.monotonic()
+            self._decisions[track_id] = result
+            del self._accumulators[track_id]
+            self.logger.info(
+                "Authentication decided.",
+                extra={
+                    "track_id": track_id,
+                    "decision": result["decision"],
+                    "user_name": result["name"],
+                    "frames": result["frames"],
+                },
+            )
+        return result
+
+    def reset(self, track_id: Optional[int] = None):
+        """
+        トラックの蓄積と判定を破棄する (track_idがNoneの場合は全て)
+        """
+        if track_id is None:
+            self._accumulators.clear()
+            self._decisions.clear()
+            return
+        self._accumulators.pop(track_id, None)
+        self._decisions.pop(track_id, None)
+
+    def prune(self, active_track_ids: Iterable[int]):
+        """
+        追跡が終わったトラックの蓄積と判定を破棄する
+        """
+        active = set(active_track_ids)
+        for track_id in list(self._accumulators) + list(self._decisions):
+            if track_id not in active:
+                self.reset(track_id)
@@ -1,4 +1,5 @@
-from typing import Dict, List
+import threading
+from typing import Dict, List, Optional, Tuple
 
 import cv2
 import numpy as np
@@ -6,6 +7,20 @@ import numpy as np
 import face_recognition
 
 from ..utils.logger import setup_logger
+from ..utils.metrics import REGISTRY, stage_timer
+
+# 検出した呼び出し元 ("stream": 配信のフレーム, "enrollment": ギャラリーの再構築,
+# "batch": アップロードされた画像) ごとの検出数
+FACES_DETECTED = REGISTRY.counter(
+    "face_auth_faces_detected_total",
+    "Faces detected, by the source of the image.",
+    ("source",),
+)
+
+# face_recognitionの検出器・特徴点の推定器・エンコーダ(dlib)はモジュール全体で共有され、
+# スレッドセーフではないため、全てのFaceProcessorでこのロックを取ってから呼び出す
+# (配信パイプラインの解析スレッドとバッチ認証のスレッドが同時に呼び出しても壊れないようにする)
+_MODEL_LOCK = threading.Lock()
 
 
 class FaceProcessor:
@@ -13,12 +28,43 @@ class FaceProcessor:
     顔検出、エンコードなどの画像処理を行うクラス
     """
 
-    def __init__(self):
+    def __init__(self, detection_model: str = "hog", upsample_times: int = 1):
         """
         FaceProcessorのコンストラクタ
+
+        Args:
+            detection_model (str): face_recognitionの顔検出モデル ("hog" or "cnn")
+            upsample_times (int): 顔検出時に画像をアップサンプルする回数
         """
+        self.detection_model = detection_model
+        self.upsample_times = upsample_times
         self.logger = setup_logger(__name__)
-        self.logger.info("FaceProcessor initialized.")
+        self.logger.info(
+            "FaceProcessor initialized.",
+            extra={"detector_settings": self.detector_settings},
+        )
+
+    @property
+    def detector_settings(self) -> Dict:
+        """
+        顔検出の設定を返す
+
+        保存済みの顔位置を再利用できるかどうかの判定に使う
+
+        Returns:
+            Dict: 検出モデルとアップサンプル回数を含む辞書
+        """
+        return {"model": self.detection_model, "upsample": self.upsample_times}
+
+    def _locate_faces(self, rgb_image: np.ndarray) -> List[Tuple[int, int, int, int]]:
+        """
+        RGB画像から全ての顔の位置を検出する (_MODEL_LOCKを取ってから呼び出す)
+        """
+        return face_recognition.face_locations(
+            rgb_image,
+            number_of_times_to_upsample=self.upsample_times,
+            model=self.detection_model,
+        )
 
     def extract_encodings(self, image: np.ndarray) -> List[np.ndarray]:
         """
@@ -34,33 +80,65 @@ class FaceProcessor:
         # face_recognitionで処理するために、画像をBGRからRGBに変換
         rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
-        # 画像から全ての顔の位置を検出
-        face_locations = face_recognition.face_locations(rgb_image, model="hog")
-        if not face_locations:
-            self.logger.warning("No faces found in the provided image.")
-            return []
+        with _MODEL_LOCK:
+            # 画像から全ての顔の位置を検出
+            face_locations = self._locate_faces(rgb_image)
+            if not face_locations:
+                self.logger.warning("No faces found in the provided image.")
+                return []
 
-        # 検出された顔からエンコーディングを抽出
-        encodings = face_recognition.face_encodings(rgb_image, face_locations)
+            # 検出された顔からエンコーディングを抽出
+            encodings = face_recognition.face_encodings(rgb_image, face_locations)
         self.logger.info(f"Found {len(encodings)} face(s) in the image.")
 
         return encodings
 
-    def detect_and_encode_faces(self, frame: np.ndarray) -> List[Dict]:
+    def detect_and_encode_faces(
+        self,
+        frame: np.ndarray,
+        detection_scale: float = 1.0,
+        timings: Optional[Dict[str, float]] = None,
+        source: str = "stream",
+    ) -> List[Dict]:
         """
         フレームから全ての顔を検出し、位置とエンコーディングを抽出する
 
         Args:
             frame (np.ndarray): カメラから取得したフレーム (BGR形式)
+            detection_scale (float): 顔検出に使う画像の縮小率 (1.0の場合は縮小しない)
+                                     検出だけを縮小画像で行い、位置を元の解像度に戻してから
+                                     元のフレームでエンコーディングを抽出する
+            timings (Optional[Dict[str, float]]): 指定された場合、ステージごとの処理時間(秒)を
+                                                  追加する
+            source (str): 検出数のメトリクスのラベルに使う呼び出し元
+                          ("stream", "enrollment", "batch")
 
         Returns:
             List[Dict]: 検出された各顔の情報を含む辞書のリスト
                         例: [{"location": (top, right, bottom, left), "encoding": [...]}]
         """
-        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-        locations = face_recognition.face_locations(rgb_frame)
-        encodings = face_recognition.face_encodings(rgb_frame, locations)
+        with stage_timer("color_conversion", timings):
+            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+        # ロックの待ち時間は検出とエンコーディングの処理時間に含めない
+        with _MODEL_LOCK:
+            with stage_timer("detection", timings):
+                if detection_scale < 1.0:
+                    small_frame = cv2.resize(
+                        rgb_frame,
+                        None,
+                        fx=detection_scale,
+                        fy=detection_scale,
+                        interpolation=cv2.INTER_AREA,
+                    )
+                    locations = self._scale_locations(
+                        self._locate_faces(small_frame), detection_scale, frame.shape
+                    )
+                else:
+                    locations = self._locate_faces(rgb_frame)
+            with stage_timer("encoding", timings):
+                encodings = face_recognition.face_encodings(rgb_frame, locations)
+        FACES_DETECTED.inc(len(locations), source=source)
 
         results = []
         for loc, enc in zip(locations, encodings):
@@ -70,3 +148,40 @@ class FaceProcessor:
             self.logger.info(f"Detected and encoded {len(results)} faces.")
 
         return results
+
+    @staticmethod
+    def _scale_locations(
+        locations: List[Tuple[int, int, int, int]], scale: float, shape: Tuple
+    ) -> List[Tuple[int, int, int, int]]:
+        """
+        縮小画像上の顔の位置を元の解像度の位置に戻す (画像の範囲内に収める)
+        """
+        height, width = shape[:2]
+        scaled = []
+        for top, right, bottom, left in locations:
+            scaled.append(
+                (
+                    max(0, int(round(top / scale))),
+                    min(width, int(round(right / scale))),
+                    min(height, int(round(bottom / scale))),
+                    max(0, int(round(left / scale))),
+                )
+            )
+        return scaled
+
+    def encode_faces(
+        self, image: np.ndarray, locations: List[Tuple[int, int, int, int]]
+    ) -> List[np.ndarray]:
+        """
+        既知の顔位置からエンコーディングだけを抽出する (顔検出は行わない)
+
+        Args:
+            image (np.ndarray): 対象の画像 (BGR形式)
+            locations (List[Tuple[int, int, int, int]]): 顔の位置 (top, right, bottom, left)
+
+        Returns:
+            List[np.ndarray]: 各顔位置に対応するエンコーディングのリスト
+        """
+        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        with _MODEL_LOCK:
+            return face_recognition.face_encodings(rgb_image, locations)
@@ -0,0 +1,227 @@
+from typing import Any, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+# face_recognitionのエンコーディングの次元数
+ENCODING_DIM = 128
+
+
+class Gallery:
+    """
+    登録済みの顔エンコーディングを照合用の行列として保持するクラス
+
+    エンコーディングはfloat32の(N, 128)行列にまとめ、各行のノルムの2乗を事前に計算しておく
+    ユーザーIDは整数ラベルとして保持し、ラベルからユーザーIDへの対応表を別に持つ
+    """
+
+    def __init__(
+        self,
+        matrix: np.ndarray,
+        labels: np.ndarray,
+        user_ids: List[str],
+        squared_norms: Optional[np.ndarray] = None,
+        buffer_owner: Any = None,
+    ):
+        """
+        Galleryのコンストラクタ
+
+        Args:
+            matrix (np.ndarray): (N, 128)のエンコーディング行列
+            labels (np.ndarray): 各行のユーザーを表す(N,)の整数ラベル
+            user_ids (List[str]): ラベルからユーザーIDへの対応表
+            squared_norms (Optional[np.ndarray]): 計算済みの各行のノルムの2乗
+            buffer_owner (Any): 配列が共有メモリ等のビューの場合、そのバッファの所有者
+                                Galleryが使われている間、参照を保持して解放を防ぐ
+        """
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        self.labels = np.ascontiguousarray(labels, dtype=np.int32)
+        self.user_ids = list(user_ids)
+        if squared_norms is None:
+            squared_norms = np.einsum("ij,ij->i", self.matrix, self.matrix)
+        self.squared_norms = np.ascontiguousarray(squared_norms, dtype=np.float32)
+        self.buffer_owner = buffer_owner
+        self.max_rows_per_user = (
+            int(np.bincount(self.labels).max()) if len(self.labels) else 0
+        )
+
+    @classmethod
+    def from_encodings(
+        cls, encodings: Sequence[np.ndarray], user_ids: Sequence[str]
+    ) -> "Gallery":
+        """
+        エンコーディングとユーザーIDのリストからGalleryを構築する
+
+        Args:
+            encodings (Sequence[np.ndarray]): 128次元の顔エンコーディングのリスト
+            user_ids (Sequence[str]): 各エンコーディングに対応するユーザーIDのリスト
+
+        Returns:
+            Gallery: 構築されたGallery
+        """
+        matrix = np.empty((len(encodings), ENCODING_DIM), dtype=np.float32)
+        labels = np.empty(len(encodings), dtype=np.int32)
+        label_of = {}
+        for row, (encoding, user_id) in enumerate(zip(encodings, user_ids)):
+            matrix[row] = encoding
+            labels[row] = label_of.setdefault(user_id, len(label_of))
+        return cls(matrix, labels, list(label_of))
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+    @property
+    def num_users(self) -> int:
+        """
+        ギャラリーに含まれるユーザー数
+        """
+        return len(self.user_ids)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        ギャラリーが保持する配列の合計バイト数
+        """
+        return self.matrix.nbytes + self.squared_norms.nbytes + self.labels.nbytes
+
+    def distances(self, queries: np.ndarray) -> np.ndarray:
+        """
+        クエリとギャラリー全行とのユークリッド距離を計算する
+
+        |q - g|^2 = |q|^2 + |g|^2 - 2 q・g
+
+        Args:
+            queries (np.ndarray): (M, 128)のクエリ行列
+
+        Returns:
+            np.ndarray: (M, N)の距離行列
+        """
+        return pairwise_distances(queries, self.matrix, self.squared_norms)
+
+
+class GallerySnapshot(NamedTuple):
+    """
+    照合に必要なデータをまとめた不変のスナップショット
+
+    ギャラリー、探索インデックス、ユーザー名の対応表は常にこの単位で差し替えるため、
+    照合中に一部だけが新しいデータに置き換わることはない
+    """
+
+    gallery: Gallery
+    index: Any
+    user_id_to_name_map: Mapping[str, str]
+    version: int
+
+
+def pairwise_distances(
+    queries: np.ndarray, matrix: np.ndarray, squared_norms: np.ndarray
+) -> np.ndarray:
+    """
+    クエリと行列の各行とのユークリッド距離を1回の行列積で計算する
+
+    Args:
+        queries (np.ndarray): (M, 128)のクエリ行列
+        matrix (np.ndarray): (N, 128)の行列
+        squared_norms (np.ndarray): matrixの各行のノルムの2乗
+
+    Returns:
+        np.ndarray: (M, N)の距離行列
+    """
+    queries = as_query_matrix(queries)
+    squared = (
+        np.einsum("ij,ij->i", queries, queries)[:, np.newaxis]
+        + squared_norms[np.newaxis, :]
+        - 2.0 * (queries @ matrix.T)
+    )
+    # 丸め誤差で負になった値を0に丸めてから平方根を取る
+    np.maximum(squared, 0.0, out=squared)
+    return np.sqrt(squared, out=squared)
+
+
+def as_query_matrix(encodings: Sequence[np.ndarray]) -> np.ndarray:
+    """
+    エンコーディングのリストまたは行列を(M, 128)のfloat32行列に変換する
+    """
+    queries = np.asarray(encodings, dtype=np.float32)
+    return queries.reshape(-1, ENCODING_DIM)
+
+
+def top_k_smallest(
+    distances: np.ndarray, rows: np.ndarray, k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (M, C)の距離行列から、各クエリの距離が小さい順にk件を取り出す
+
+    Args:
+        distances (np.ndarray): (M, C)の距離行列
+        rows (np.ndarray): 各列に対応する番号 (ギャラリーの行番号など)
+        k (int): 取り出す件数
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (M, k)の距離と番号
+                                       候補がk件に満たない分は距離inf, 番号-1で埋める
+    """
+    n_queries, n_candidates = distances.shape
+    top_distances = np.full((n_queries, k), np.inf, dtype=np.float32)
+    top_rows = np.full((n_queries, k), -1, dtype=np.int64)
+    kk = min(k, n_candidates)
+    if kk == 0:
+        return top_distances, top_rows
+
+    if kk == 1:
+        columns = np.argmin(distances, axis=1)[:, np.newaxis]
+    else:
+        columns = np.argpartition(distances, kk - 1, axis=1)[:, :kk]
+        partial = np.take_along_axis(distances, columns, axis=1)
+        columns = np.take_along_axis(columns, np.argsort(partial, axis=1), axis=1)
+
+    top_distances[:, :kk] = np.take_along_axis(distances, columns, axis=1)
+    top_rows[:, :kk] = rows[columns]
+    return top_distances, top_rows
+
+
+def group_min(
+    distances: np.ndarray, labels: np.ndarray, num_labels: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    距離行列をラベルごとに集約し、各ラベルの最小距離を求める
+
+    取り出された候補に含まれるラベルだけを集約するため、計算量とメモリは
+    候補の数にだけ比例し、ラベルの種類数(ギャラリーの人数)には依存しない
+
+    Args:
+        distances (np.ndarray): (M, C)の距離行列
+        labels (np.ndarray): 各要素のラベル, (C,)または(M, C)
+                             負のラベルとnum_labels以上のラベルは集約対象外として無視する
+        num_labels (int): ラベルの種類数
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (M, C)のラベルごとの最小距離とそのラベル
+                                       各クエリで距離の小さい順に並べ、
+                                       ラベルがC種類に満たない分は距離inf, ラベル-1で埋める
+    """
+    n_queries, n_candidates = distances.shape
+    grouped_distances = np.full((n_queries, n_candidates), np.inf, dtype=np.float32)
+    grouped_labels = np.full((n_queries, n_candidates), -1, dtype=np.int64)
+
+    labels = np.broadcast_to(labels, distances.shape).reshape(-1).astype(np.int64)
+    query_ids = np.repeat(np.arange(n_queries, dtype=np.int64), n_candidates)
+    valid = (labels >= 0) & (labels < num_labels)
+    if not valid.any():
+        return grouped_distances, grouped_labels
+
+    # (クエリ, ラベル) の組ごとに最小距離を求める
+    keys = query_ids[valid] * num_labels + labels[valid]
+    values = distances.reshape(-1)[valid]
+    order = np.argsort(keys, kind="stable")
+    unique_keys, starts = np.unique(keys[order], return_index=True)
+    min_distances = np.minimum.reduceat(values[order], starts)
+    group_queries = unique_keys // num_labels
+
+    # クエリごとに距離の小さい順に並べて、各クエリの先頭から詰める
+    order = np.lexsort((min_distances, group_queries))
+    group_queries = group_queries[order]
+    counts = np.bincount(group_queries, minlength=n_queries)
+    positions = np.arange(len(order)) - np.repeat(np.cumsum(counts) - counts, counts)
+    grouped_distances[group_queries, positions] = min_distances[order]
+    grouped_labels[group_queries, positions] = unique_keys[order] % num_labels
+    return grouped_distances, grouped_labels
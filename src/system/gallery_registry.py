@@ -0,0 +1,211 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from ..utils.logger import setup_logger
+from .data_manager import DataManager
+from .face_processor import FaceProcessor
+from .services import AuthenticationService
+
+# テナントIDとして使える文字 (ディレクトリ名になるため区切り文字などは使えない)
+TENANT_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+class GalleryRegistry:
+    """
+    テナント(拠点)ごとのAuthenticationServiceを管理するクラス
+
+    各テナントは root_path/テナントID/ に dataset, metadata.json, encodings.pickle を持つ
+    ギャラリーは初めて使われた時に読み込み、合計サイズがmemory_budget_bytesを
+    超えた場合は最も長く使われていないテナントから破棄する
+    (破棄したテナントのサービスはcloseし、共有ギャラリーの監視スレッドも止める)
+    """
+
+    def __init__(
+        self,
+        root_path: str = "tenants",
+        face_processor: Optional[FaceProcessor] = None,
+        memory_budget_bytes: int = 512 * 1024 * 1024,
+        service_params: Optional[Dict] = None,
+    ):
+        """
+        GalleryRegistryのコンストラクタ
+
+        Args:
+            root_path (str): テナントごとのディレクトリを格納するディレクトリへのパス
+            face_processor (Optional[FaceProcessor]): 全テナントで共有する顔処理
+            memory_budget_bytes (int): 読み込んだギャラリーとインデックスの合計サイズの上限
+            service_params (Optional[Dict]): AuthenticationServiceに渡すパラメータ
+                                             例: {"tolerance": 0.55}
+        """
+        self.logger = setup_logger(__name__)
+        self.root_path = root_path
+        self.face_processor = face_processor or FaceProcessor()
+        self.memory_budget_bytes = memory_budget_bytes
+        self.service_params = service_params or {}
+
+        self._lock = threading.Lock()
+        # テナントID -> AuthenticationService (末尾ほど最近使われたもの)
+        self._services: "OrderedDict[str, AuthenticationService]" = OrderedDict()
+        # 同じテナントを複数のスレッドが同時に読み込まないためのテナントごとのロック
+        # (読み込み中のテナントの分だけ保持し、読み込みが終わったら成否に関わらず削除する)
+        self._loading_locks: Dict[str, threading.Lock] = {}
+        self.logger.info(
+            "GalleryRegistry initialized.",
+            extra={
+                "root_path": root_path,
+                "memory_budget_bytes": memory_budget_bytes,
+            },
+        )
+
+    def list_tenants(self) -> List[str]:
+        """
+        root_pathにあるテナントIDの一覧を返す (読み込まれていないものも含む)
+        """
+        if not os.path.isdir(self.root_path):
+            return []
+        return sorted(
+            name
+            for name in os.listdir(self.root_path)
+            if TENANT_ID_PATTERN.match(name)
+            and os.path.isdir(os.path.join(self.root_path, name))
+        )
+
+    def get(self, tenant_id: str) -> AuthenticationService:
+        """
+        テナントのAuthenticationServiceを返す (読み込まれていなければ読み込む)
+
+        Args:
+            tenant_id (str): テナント(拠点)のID
+
+        Returns:
+            AuthenticationService: テナントのギャラリーを保持する認証サービス
+
+        Raises:
+            ValueError: テナントIDに使えない文字が含まれる場合
+            KeyError: テナントのディレクトリが存在しない場合
+        """
+        with self._lock:
+            service = self._services.get(tenant_id)
+            if service is not None:
+                self._services.move_to_end(tenant_id)
+                return service
+
+        # 不正なIDや存在しないテナントでは、ロックを作る前に例外を送出する
+        path = self._tenant_path(tenant_id)
+        with self._lock:
+            loading_lock = self._loading_locks.setdefault(tenant_id, threading.Lock())
+
+        with loading_lock:
+            try:
+                # 待っている間に他のスレッドが読み込んでいればそれを使う
+                with self._lock:
+                    service = self._services.get(tenant_id)
+                    if service is not None:
+                        self._services.move_to_end(tenant_id)
+                        return service
+
+                service = self._load(tenant_id, path)
+                with self._lock:
+                    self._services[tenant_id] = service
+                    self._evict(keep=tenant_id)
+            finally:
+                # 待っているスレッドは取得済みのロックを使うため、ここで削除してよい
+                # (以降のスレッドは読み込み済みのサービスを見つけるか、新しいロックで読み込む)
+                with self._lock:
+                    if self._loading_locks.get(tenant_id) is loading_lock:
+                        del self._loading_locks[tenant_id]
+        return service
+
+    def evict(self, tenant_id: str) -> bool:
+        """
+        テナントのギャラリーをメモリから破棄する
+
+        Returns:
+            bool: 読み込まれていたテナントを破棄した場合True
+        """
+        with self._lock:
+            service = self._services.pop(tenant_id, None)
+        if service is None:
+            return False
+        service.close()
+        return True
+
+    def reload(self, tenant_id: str, wait: bool = False):
+        """
+        読み込み済みのテナントのギャラリーを読み込み直す (未読み込みの場合は何もしない)
+        """
+        with self._lock:
+            service = self._services.get(tenant_id)
+        if service is not None:
+            service.reload_knowledge(wait=wait)
+
+    def stats(self) -> Dict:
+        """
+        読み込み済みのテナントとメモリ使用量を返す
+        """
+        with self._lock:
+            loaded = {
+                tenant_id: self._footprint(service)
+                for tenant_id, service in self._services.items()
+            }
+        return {
+            "loaded_tenants": loaded,
+            "total_bytes": sum(loaded.values()),
+            "memory_budget_bytes": self.memory_budget_bytes,
+        }
+
+    def _tenant_path(self, tenant_id: str) -> str:
+        if not TENANT_ID_PATTERN.match(tenant_id or ""):
+            raise ValueError(f"Invalid tenant id: {tenant_id!r}")
+        path = os.path.join(self.root_path, tenant_id)
+        if not os.path.isdir(path):
+            raise KeyError(tenant_id)
+        return path
+
+    def _load(self, tenant_id: str, path: str) -> AuthenticationService:
+        """
+        テナントのDataManagerとAuthenticationServiceを作成する
+        """
+        data_manager = DataManager(
+            dataset_path=os.path.join(path, "dataset"),
+            metadata_path=os.path.join(path, "metadata.json"),
+            encodings_path=os.path.join(path, "encodings.pickle"),
+        )
+        service = AuthenticationService(
+            data_manager,
+            self.face_processor,
+            tenant_id=tenant_id,
+            **self.service_params,
+        )
+        self.logger.info(
+            "Loaded tenant gallery.",
+            extra={"tenant_id": tenant_id, "bytes": self._footprint(service)},
+        )
+        return service
+
+    def _evict(self, keep: str):
+        """
+        合計サイズが上限を下回るまで、最も長く使われていないテナントを破棄する
+        (_lockを取得した状態で呼び出す)
+        """
+        total = sum(self._footprint(service) for service in self._services.values())
+        while total > self.memory_budget_bytes and len(self._services) > 1:
+            tenant_id = next(iter(self._services))
+            if tenant_id == keep:
+                break
+            service = self._services.pop(tenant_id)
+            service.close()
+            total -= self._footprint(service)
+            self.logger.info(
+                "Evicted tenant gallery.",
+                extra={"tenant_id": tenant_id, "total_bytes": total},
+            )
+
+    @staticmethod
+    def _footprint(service: AuthenticationService) -> int:
+        # ギャラリーと、インデックスが別に持つ配列の合計サイズ
+        snapshot = service.snapshot
+        return snapshot.gallery.nbytes + getattr(snapshot.index, "nbytes", 0)
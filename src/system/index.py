@@ -0,0 +1,389 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from ..utils.logger import setup_logger
+from .gallery import Gallery, as_query_matrix, pairwise_distances, top_k_smallest
+
+
+class ExactIndex:
+    """
+    ギャラリー全件との距離を計算する厳密な近傍探索インデックス
+    """
+
+    def __init__(self, gallery: Gallery):
+        """
+        ExactIndexのコンストラクタ
+
+        Args:
+            gallery (Gallery): 探索対象のギャラリー
+        """
+        self.gallery = gallery
+
+    def search(self, queries: np.ndarray, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        各クエリに最も近いk行を探索する
+
+        Args:
+            queries (np.ndarray): (M, 128)のクエリ行列
+            k (int): 返す近傍の数
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: 距離の昇順に並んだ(M, k)の距離と行番号
+                                           候補がk件に満たない分は距離inf, 行番号-1で埋める
+        """
+        distances = self.gallery.distances(queries)
+        return top_k_smallest(distances, np.arange(len(self.gallery)), k)
+
+
+class IVFIndex:
+    """
+    k-meansの粗量子化器による転置リスト(IVF)を使った近似近傍探索インデックス
+
+    ギャラリーの各行を最も近いセントロイドのリストに振り分けておき、
+    探索時はクエリに近いn_probe個のリストだけを厳密に照合する
+    返す距離は真のユークリッド距離なので、認証の閾値の意味は変わらない
+    n_probeを大きくするほど再現率が上がり、探索は遅くなる
+    """
+
+    def __init__(
+        self,
+        gallery: Gallery,
+        n_lists: Optional[int] = None,
+        n_probe: int = 8,
+        n_iterations: int = 10,
+        max_training_rows: int = 50000,
+        seed: int = 0,
+    ):
+        """
+        IVFIndexのコンストラクタ
+
+        Args:
+            gallery (Gallery): 探索対象のギャラリー
+            n_lists (Optional[int]): 転置リストの数, Noneの場合は行数の平方根
+            n_probe (int): 探索時に照合するリストの数
+            n_iterations (int): k-meansの反復回数
+            max_training_rows (int): k-meansの学習に使う最大行数
+            seed (int): 乱数シード
+        """
+        self.logger = setup_logger(__name__)
+        self.gallery = gallery
+        self.n_probe = n_probe
+
+        n_rows = len(gallery)
+        if n_lists is None:
+            n_lists = int(np.sqrt(n_rows))
+        self.n_lists = max(1, min(n_lists, n_rows))
+
+        rng = np.random.default_rng(seed)
+        self.centroids = self._train_centroids(
+            gallery.matrix, n_iterations, max_training_rows, rng
+        )
+        self.centroid_norms = np.einsum("ij,ij->i", self.centroids, self.centroids)
+
+        # 各行をリストに割り当て、リストごとに連続した領域に並べ替える
+        assignment = self._assign(gallery.matrix)
+        self.order = np.argsort(assignment, kind="stable").astype(np.int64)
+        counts = np.bincount(assignment, minlength=self.n_lists)
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.list_matrix = gallery.matrix[self.order]
+        self.list_norms = gallery.squared_norms[self.order]
+
+        self.logger.info(
+            "IVFIndex built.",
+            extra={
+                "rows": n_rows,
+                "n_lists": self.n_lists,
+                "n_probe": self.n_probe,
+                "max_list_size": int(counts.max()) if n_rows else 0,
+            },
+        )
+
+    @property
+    def nbytes(self) -> int:
+        """
+        インデックスがギャラリーとは別に保持する配列の合計バイト数
+        """
+        return (
+            self.centroids.nbytes
+            + self.order.nbytes
+            + self.list_matrix.nbytes
+            + self.list_norms.nbytes
+        )
+
+    def _train_centroids(
+        self,
+        matrix: np.ndarray,
+        n_iterations: int,
+        max_training_rows: int,
+        rng: np.random.Generator,
+    ) -> np.ndarray:
+        """
+        k-means (Lloyd法) で粗量子化器のセントロイドを学習する
+        """
+        if len(matrix) == 0:
+            return np.zeros((1, matrix.shape[1]), dtype=np.float32)
+
+        if len(matrix) > max_training_rows:
+            matrix = matrix[rng.choice(len(matrix), max_training_rows, replace=False)]
+
+        centroids = matrix[rng.choice(len(matrix), self.n_lists, replace=False)].copy()
+        for _ in range(n_iterations):
+            norms = np.einsum("ij,ij->i", centroids, centroids)
+            assignment = np.argmin(pairwise_distances(matrix, centroids, norms), axis=1)
+            counts = np.bincount(assignment, minlength=self.n_lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, matrix)
+
+            # 空になったクラスタはランダムな行で初期化し直す
+            empty = counts == 0
+            centroids[~empty] = sums[~empty] / counts[~empty, np.newaxis]
+            if empty.any():
+                centroids[empty] = matrix[rng.choice(len(matrix), int(empty.sum()))]
+        return centroids
+
+    def _assign(self, matrix: np.ndarray) -> np.ndarray:
+        """
+        各行を最も近いセントロイドのリストに割り当てる
+        """
+        assignment = np.empty(len(matrix), dtype=np.int64)
+        # 巨大なギャラリーでも距離行列が大きくなりすぎないよう分割して計算する
+        for start in range(0, len(matrix), 65536):
+            chunk = matrix[start : start + 65536]
+            distances = pairwise_distances(chunk, self.centroids, self.centroid_norms)
+            assignment[start : start + len(chunk)] = np.argmin(distances, axis=1)
+        return assignment
+
+    def search(self, queries: np.ndarray, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        各クエリに近いリストだけを照合して、最も近いk行を探索する
+
+        Args:
+            queries (np.ndarray): (M, 128)のクエリ行列
+            k (int): 返す近傍の数
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: 距離の昇順に並んだ(M, k)の距離と行番号
+                                           候補がk件に満たない分は距離inf, 行番号-1で埋める
+        """
+        queries = as_query_matrix(queries)
+        n_probe = max(1, min(self.n_probe, self.n_lists))
+        coarse = pairwise_distances(queries, self.centroids, self.centroid_norms)
+        probed_lists = np.argpartition(coarse, n_probe - 1, axis=1)[:, :n_probe]
+
+        result_distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        result_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        for i, lists in enumerate(probed_lists):
+            positions = np.concatenate(
+                [np.arange(self.offsets[j], self.offsets[j + 1]) for j in lists]
+            )
+            if positions.size == 0:
+                continue
+            distances = pairwise_distances(
+                queries[i], self.list_matrix[positions], self.list_norms[positions]
+            )
+            top_distances, top_rows = top_k_smallest(
+                distances, self.order[positions], k
+            )
+            result_distances[i] = top_distances[0]
+            result_rows[i] = top_rows[0]
+        return result_distances, result_rows
+
+
+# 全てのShardedIndexで共有するシャード探索用のスレッドプール
+# (インデックスはスナップショットの再構築ごとに作り直されるため、インスタンスごとに
+#  プールを持つと古いインデックスのスレッドが残り続ける)
+_shard_executor: Optional[ThreadPoolExecutor] = None
+_shard_executor_lock = threading.Lock()
+# シャード探索用のスレッドであることを示すフラグ (スレッドプールの初期化時に設定する)
+_shard_thread = threading.local()
+
+
+def _mark_shard_thread():
+    _shard_thread.is_worker = True
+
+
+def _get_shard_executor() -> ThreadPoolExecutor:
+    """
+    シャード探索用のスレッドプールを返す (初回の呼び出し時にCPUコア数のスレッドで作成する)
+    """
+    global _shard_executor
+    with _shard_executor_lock:
+        if _shard_executor is None:
+            _shard_executor = ThreadPoolExecutor(
+                max_workers=os.cpu_count() or 1,
+                thread_name_prefix="gallery-shard",
+                initializer=_mark_shard_thread,
+            )
+        return _shard_executor
+
+
+# ShardedIndexで1シャードあたりに割り当てる最小の行数
+# これより少ない行に分割してもスレッドの受け渡しのコストが上回るため、
+# 行数がこの倍数に満たない場合はシャード数を減らす (1シャードならExactIndexと同じ)
+MIN_SHARD_ROWS = 100_000
+
+
+class ShardedIndex:
+    """
+    ギャラリーを複数のシャードに分割し、全シャードを並列に探索するインデックス
+
+    各シャードはギャラリーの連続した行のビュー(コピーなし)と、その上に構築した
+    インデックスを持つ。クエリは全シャードに同時に送られ(scatter)、各シャードの
+    上位k件を1つにまとめて全体の上位k件を求める(gather)
+    行列積はGILを解放するため、スレッドでもCPUコア数に応じて並列に処理される
+    シャードはスナップショットの再構築ごとに行数が均等になるよう作り直される
+
+    ExactIndexの行列積もBLASによってマルチスレッドで実行されるため、BLASのスレッド数を
+    制限しない(OPENBLAS_NUM_THREADS=1などを設定しない)場合はスレッドが
+    シャード数 x BLASのスレッド数に増えて競合し、分割しても速くならない
+    シングルコアの環境では、20万行でもExactIndexより1クエリあたり約0.7ms遅かった
+    そのため既定では1シャードあたりMIN_SHARD_ROWS行以上になる場合だけ分割する
+    閾値はrun_index_benchmark.pyで、対象の環境でExactIndexより速くなる行数に合わせる
+    """
+
+    def __init__(
+        self,
+        gallery: Gallery,
+        n_shards: Optional[int] = None,
+        shard_backend: str = "exact",
+        shard_params: Optional[Dict] = None,
+        min_shard_rows: int = MIN_SHARD_ROWS,
+    ):
+        """
+        ShardedIndexのコンストラクタ
+
+        Args:
+            gallery (Gallery): 探索対象のギャラリー
+            n_shards (Optional[int]): シャード数, Noneの場合はCPUコア数
+            shard_backend (str): 各シャードで使うインデックスのバックエンド名
+            shard_params (Optional[Dict]): 各シャードのインデックスのパラメータ
+            min_shard_rows (int): 1シャードあたりの最小の行数, 0の場合は制限しない
+        """
+        self.logger = setup_logger(__name__)
+        self.gallery = gallery
+
+        n_rows = len(gallery)
+        if n_shards is None:
+            n_shards = os.cpu_count() or 1
+        if min_shard_rows > 0:
+            n_shards = min(n_shards, n_rows // min_shard_rows)
+        self.n_shards = max(1, min(n_shards, n_rows))
+
+        # 行を均等な連続区間に分け、区間ごとにビューのGalleryとインデックスを作る
+        bounds = np.linspace(0, n_rows, self.n_shards + 1).astype(np.int64)
+        self.shard_offsets = bounds[:-1]
+        self.shards = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            shard_gallery = Gallery(
+                gallery.matrix[start:end],
+                gallery.labels[start:end],
+                gallery.user_ids,
+                squared_norms=gallery.squared_norms[start:end],
+                buffer_owner=gallery,
+            )
+            self.shards.append(build_index(shard_gallery, shard_backend, shard_params))
+
+        self.logger.info(
+            "ShardedIndex built.",
+            extra={
+                "rows": n_rows,
+                "n_shards": self.n_shards,
+                "shard_backend": shard_backend,
+            },
+        )
+
+    def search(self, queries: np.ndarray, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        全シャードを並列に探索し、結果をまとめて最も近いk行を返す
+
+        Args:
+            queries (np.ndarray): (M, 128)のクエリ行列
+            k (int): 返す近傍の数
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: 距離の昇順に並んだ(M, k)の距離と行番号
+                                           候補がk件に満たない分は距離inf, 行番号-1で埋める
+        """
+        queries = as_query_matrix(queries)
+        if len(self.shards) == 1:
+            return self.shards[0].search(queries, k)
+
+        if getattr(_shard_thread, "is_worker", False):
+            # シャードのスレッドから呼ばれた場合 (シャードのバックエンドがShardedIndexなど) は、
+            # 同じプールの空きを待つとプールが埋まってデッドロックするため、このスレッドで順に探索する
+            shard_results = [shard.search(queries, k) for shard in self.shards]
+        else:
+            shard_results = list(
+                _get_shard_executor().map(
+                    lambda shard: shard.search(queries, k), self.shards
+                )
+            )
+
+        # シャード内の行番号をギャラリー全体の行番号に戻してから結合する
+        distances = np.concatenate([result[0] for result in shard_results], axis=1)
+        rows = np.concatenate(
+            [
+                np.where(result[1] >= 0, result[1] + offset, -1)
+                for result, offset in zip(shard_results, self.shard_offsets)
+            ],
+            axis=1,
+        )
+        top_distances, columns = top_k_smallest(
+            distances, np.arange(distances.shape[1]), k
+        )
+        top_rows = np.where(
+            columns >= 0,
+            np.take_along_axis(rows, np.maximum(columns, 0), axis=1),
+            -1,
+        )
+        return top_distances, top_rows
+
+
+# 利用可能なインデックスの実装 (名前 -> クラス)
+INDEX_BACKENDS = {
+    "exact": ExactIndex,
+    "ivf": IVFIndex,
+    "sharded": ShardedIndex,
+}
+
+
+def build_index(
+    gallery: Gallery, backend: str = "exact", params: Optional[Dict] = None
+):
+    """
+    指定されたバックエンドでギャラリーの探索インデックスを構築する
+
+    Args:
+        gallery (Gallery): 探索対象のギャラリー
+        backend (str): INDEX_BACKENDSに登録されたバックエンド名
+        params (Optional[Dict]): バックエンドのコンストラクタに渡すパラメータ
+
+    Returns:
+        探索インデックス (search(queries, k)を持つオブジェクト)
+    """
+    if backend not in INDEX_BACKENDS:
+        raise ValueError(f"Unknown index backend: {backend}")
+    return INDEX_BACKENDS[backend](gallery, **(params or {}))
+
+
+def is_exact_backend(backend: str, params: Optional[Dict] = None) -> bool:
+    """
+    バックエンドが常に真の最近傍を返す(厳密な)探索かを判定する
+
+    Args:
+        backend (str): INDEX_BACKENDSに登録されたバックエンド名
+        params (Optional[Dict]): バックエンドのコンストラクタに渡すパラメータ
+
+    Returns:
+        bool: 厳密な探索の場合True (IVFや、IVFのシャードを使う場合はFalse)
+    """
+    params = params or {}
+    if backend == "sharded":
+        return is_exact_backend(
+            params.get("shard_backend", "exact"), params.get("shard_params")
+        )
+    return backend == "exact"
@@ -0,0 +1,137 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import numpy as np
+
+from .gallery import pairwise_distances
+
+
+class NegativeMatchCache:
+    """
+    最近「Unknown」と判定されたエンコーディングを保持するLRUキャッシュ
+
+    各エントリには、そのエンコーディングからギャラリーの最近傍までの距離d0を記録する
+    三角不等式より、クエリpとエントリuの距離が d0 - tolerance 未満であれば
+    pからギャラリーのどの行までの距離もtoleranceを超えるため、照合せずにUnknownと判定できる
+    エントリは照合時のスナップショットのバージョンに紐づき、バージョンが変わると全て破棄する
+    d0が真の最近傍距離であることが前提のため、厳密な探索インデックスでのみ使う
+    (近似インデックスでは最近傍を見落としたd0が大きすぎる値になり、照合できるはずの
+    クエリもttlの間Unknownと判定され続ける)
+    """
+
+    def __init__(self, tolerance: float, capacity: int = 128, ttl: float = 10.0):
+        """
+        NegativeMatchCacheのコンストラクタ
+
+        Args:
+            tolerance (float): 顔の類似度の閾値
+            capacity (int): 保持する最大エントリ数 (超えた場合は最も古く使われたものを破棄)
+            ttl (float): エントリの有効期間(秒)
+        """
+        self.tolerance = tolerance
+        self.capacity = capacity
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._version: Optional[int] = None
+        self._next_key = 0
+        # キー -> (エンコーディング, ノルムの2乗, ギャラリーの最近傍までの距離, 登録時刻)
+        self._entries: "OrderedDict[int, Tuple[np.ndarray, float, float, float]]" = (
+            OrderedDict()
+        )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def lookup(self, queries: np.ndarray, version: int) -> np.ndarray:
+        """
+        各クエリからギャラリーの最近傍までの距離の下限をキャッシュから求める
+
+        下限がtoleranceを超えるクエリは、ギャラリーと照合しなくてもUnknownと判定できる
+
+        Args:
+            queries (np.ndarray): (M, 128)のクエリ行列
+            version (int): 照合に使うスナップショットのバージョン
+
+        Returns:
+            np.ndarray: (M,)の距離の下限 (キャッシュから判定できないクエリは-inf)
+        """
+        lower_bounds = np.full(len(queries), -np.inf, dtype=np.float32)
+        with self._lock:
+            self._sync_version(version)
+            self._expire(time.monotonic())
+            if not self._entries:
+                self.misses += len(queries)
+                return lower_bounds
+
+            keys = list(self._entries)
+            entries = list(self._entries.values())
+            matrix = np.stack([entry[0] for entry in entries])
+            squared_norms = np.array([entry[1] for entry in entries], dtype=np.float32)
+            nearest = np.array([entry[2] for entry in entries], dtype=np.float32)
+
+            # 三角不等式: d(p, ギャラリー) >= d(u, ギャラリー) - d(p, u)
+            bounds = nearest - pairwise_distances(queries, matrix, squared_norms)
+            # 距離計算の丸め誤差の分だけ余裕を持たせて判定する
+            inside = bounds > self.tolerance + 1e-4
+            hit = inside.any(axis=1)
+            lower_bounds[hit] = bounds[hit].max(axis=1)
+            # ヒットしたエントリを最近使ったものとして末尾に移動する
+            for column in np.flatnonzero(inside.any(axis=0)):
+                self._entries.move_to_end(keys[column])
+
+            n_hits = int(hit.sum())
+            self.hits += n_hits
+            self.misses += len(queries) - n_hits
+        return lower_bounds
+
+    def add(self, encoding: np.ndarray, nearest_distance: float, version: int):
+        """
+        Unknownと判定されたエンコーディングを登録する
+
+        Args:
+            encoding (np.ndarray): 128次元の顔エンコーディング
+            nearest_distance (float): ギャラリーの最近傍までの距離
+            version (int): 照合に使ったスナップショットのバージョン
+        """
+        if not nearest_distance > self.tolerance:
+            return
+        encoding = np.asarray(encoding, dtype=np.float32)
+        squared_norm = float(np.dot(encoding, encoding))
+
+        with self._lock:
+            self._sync_version(version)
+            if self._version != version:
+                # 古いスナップショットでの照合結果は登録しない
+                return
+            self._entries[self._next_key] = (
+                encoding,
+                squared_norm,
+                float(nearest_distance),
+                time.monotonic(),
+            )
+            self._next_key += 1
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def _sync_version(self, version: int):
+        # より新しいスナップショットが公開されたらキャッシュを破棄する
+        if self._version is None or version > self._version:
+            self._entries.clear()
+            self._version = version
+
+    def _expire(self, now: float):
+        # 登録順に並んでいるとは限らないため全件を確認する (容量は小さい前提)
+        expired = [
+            key for key, entry in self._entries.items() if now - entry[3] > self.ttl
+        ]
+        for key in expired:
+            del self._entries[key]
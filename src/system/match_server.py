@@ -0,0 +1,381 @@
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+import traceback
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from ..utils.logger import setup_logger
+from .gallery import ENCODING_DIM, as_query_matrix
+
+# --- プロトコル定義 ---
+# リクエスト: ヘッダー(マジック, 命令, top_k, 予約, ベクトル数) + float32(リトルエンディアン)の
+#             128次元ベクトルを件数分そのまま並べたもの
+# レスポンス: ヘッダー(マジック, ステータス, 本文の長さ) + UTF-8のJSON本文
+MAGIC = b"FRM1"
+REQUEST_HEADER = struct.Struct("!4sBBHI")
+RESPONSE_HEADER = struct.Struct("!4sBI")
+VECTOR_DTYPE = np.dtype("<f4")
+VECTOR_BYTES = ENCODING_DIM * VECTOR_DTYPE.itemsize
+
+OP_MATCH = 1
+OP_RANK = 2
+OP_RELOAD = 3
+OP_INFO = 4
+OPS = (OP_MATCH, OP_RANK, OP_RELOAD, OP_INFO)
+
+# 1リクエストで受け付けるベクトル数の上限 (不正なヘッダーで巨大な領域を確保しないため)
+# クライアントはこれより多いベクトルを複数のリクエストに分けて送る
+MAX_QUERIES = 1024
+# ヘッダーのtop_kは1バイトのため、rank_usersで指定できる上限
+MAX_TOP_K = 255
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+DEFAULT_SOCKET_PATH = "/tmp/face_match.sock"
+
+
+def _recv_exact(sock: socket.socket, size: int) -> Optional[bytes]:
+    """
+    ソケットから指定バイト数を読み切る (接続が閉じられた場合はNone)
+    """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            return None
+        received += n
+    return bytes(buffer)
+
+
+class _MatchRequestHandler(socketserver.BaseRequestHandler):
+    """
+    1つのクライアント接続を処理するハンドラ (接続を保ったまま複数のリクエストを処理する)
+    """
+
+    def handle(self):
+        server = self.server.match_server
+        while True:
+            header = _recv_exact(self.request, REQUEST_HEADER.size)
+            if header is None:
+                return
+            magic, op, top_k, _, count = REQUEST_HEADER.unpack(header)
+            if magic != MAGIC:
+                server.logger.warning("Invalid request magic. Closing connection.")
+                return
+            if op not in OPS or count > MAX_QUERIES:
+                # 本文を読まずに応答するため、以降のリクエストの区切りが分からなくなる
+                # エラーを返してから接続を閉じる
+                server.logger.warning(
+                    "Rejected match request. Closing connection.",
+                    extra={"op": op, "count": count},
+                )
+                self._send(
+                    STATUS_ERROR,
+                    {"error": f"Invalid request (op={op}, count={count})"},
+                )
+                return
+
+            payload = _recv_exact(self.request, count * VECTOR_BYTES) if count else b""
+            if payload is None:
+                return
+            vectors = np.frombuffer(payload, dtype=VECTOR_DTYPE).reshape(
+                count, ENCODING_DIM
+            )
+
+            try:
+                body = server.dispatch(op, vectors, top_k)
+                status = STATUS_OK
+            except Exception as e:
+                server.logger.error(
+                    "Failed to process match request",
+                    extra={
+                        "op": op,
+                        "error": str(e),
+                        "traceback": traceback.format_exc(),
+                    },
+                )
+                body = {"error": str(e)}
+                status = STATUS_ERROR
+
+            self._send(status, body)
+
+    def _send(self, status: int, body: Dict):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.request.sendall(RESPONSE_HEADER.pack(MAGIC, status, len(data)) + data)
+
+
+class _ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class MatchServer:
+    """
+    ギャラリーを1か所で保持し、Unixドメインソケット経由で照合を提供するサーバー
+
+    同じホスト上の複数のカメラ/ストリームのプロセスがMatchClientから接続することで、
+    ギャラリーはこのプロセスのメモリに1つだけ載り、更新もこのプロセスで一度だけ行う
+    """
+
+    def __init__(self, auth_service, socket_path: str = DEFAULT_SOCKET_PATH):
+        """
+        MatchServerのコンストラクタ
+
+        Args:
+            auth_service (AuthenticationService): ギャラリーを保持する認証サービス
+            socket_path (str): 待ち受けるUnixドメインソケットのパス
+        """
+        self.logger = setup_logger(__name__)
+        self.auth_service = auth_service
+        self.socket_path = socket_path
+
+        # 前回の起動時に残ったソケットファイルを削除する
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self._server = _ThreadingUnixServer(socket_path, _MatchRequestHandler)
+        self._server.match_server = self
+        self.logger.info("MatchServer initialized.", extra={"socket_path": socket_path})
+
+    def dispatch(self, op: int, vectors: np.ndarray, top_k: int) -> Dict:
+        """
+        リクエストの命令に応じて認証サービスを呼び出す
+        """
+        if op == OP_MATCH:
+            return {"results": self.auth_service.match_batch(vectors)}
+        if op == OP_RANK:
+            return {"results": self.auth_service.rank_users(vectors, top_k=top_k)}
+        if op == OP_RELOAD:
+            self.auth_service.reload_knowledge(wait=True)
+            return self._info()
+        if op == OP_INFO:
+            return self._info()
+        raise ValueError(f"Unknown op: {op}")
+
+    def _info(self) -> Dict:
+        snapshot = self.auth_service.snapshot
+        return {
+            "version": snapshot.version,
+            "gallery_size": len(snapshot.gallery),
+            "user_count": snapshot.gallery.num_users,
+            "tolerance": self.auth_service.tolerance,
+        }
+
+    def serve_forever(self):
+        """
+        リクエストの待ち受けを開始する (shutdownが呼ばれるまで戻らない)
+        """
+        self.logger.info(
+            "MatchServer started.", extra={"socket_path": self.socket_path}
+        )
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            self.logger.info("MatchServer stopped.")
+
+    def shutdown(self):
+        """
+        待ち受けを停止する
+        """
+        self._server.shutdown()
+
+
+class MatchClient:
+    """
+    MatchServerに照合を依頼する軽量クライアント
+
+    AuthenticationServiceと同じauthenticate_face / match_batch / rank_users /
+    reload_knowledgeのインターフェースを持つ
+    """
+
+    def __init__(
+        self,
+        socket_path: str = DEFAULT_SOCKET_PATH,
+        face_processor=None,
+        timeout: float = 5.0,
+        reload_timeout: float = 300.0,
+    ):
+        """
+        MatchClientのコンストラクタ
+
+        Args:
+            socket_path (str): MatchServerのUnixドメインソケットのパス
+            face_processor (FaceProcessor): authenticate_frameで顔検出に使うインスタンス
+            timeout (float): 1リクエストあたりのタイムアウト秒数
+            reload_timeout (float): ギャラリーの再読み込みを待つタイムアウト秒数
+                                    (大きなギャラリーでは再構築に時間がかかるため別に指定する)
+        """
+        self.logger = setup_logger(__name__)
+        self.socket_path = socket_path
+        self.face_processor = face_processor
+        self.timeout = timeout
+        self.reload_timeout = reload_timeout
+        self._sock: Optional[socket.socket] = None
+        self._lock = threading.Lock()
+
+        info = self._request(OP_INFO)
+        self.tolerance = info["tolerance"]
+        self.logger.info(
+            "MatchClient connected.",
+            extra={"socket_path": socket_path, "gallery_size": info["gallery_size"]},
+        )
+
+    def _connect(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock
+
+    def _request(
+        self,
+        op: int,
+        encodings: Sequence[np.ndarray] = (),
+        top_k: int = 0,
+        timeout: Optional[float] = None,
+    ) -> Dict:
+        """
+        リクエストを送信してレスポンスのJSONを返す
+
+        接続できなかった場合と、保持していた接続が切れていて送信できなかった場合だけ
+        1回再接続して送り直す。送信後のタイムアウトなどはサーバーが処理済み(または処理中)の
+        可能性があるため再送しない。再読み込み(OP_RELOAD)は重複するとギャラリーの再構築が
+        繰り返されるため、どの場合も再送しない
+        """
+        vectors = as_query_matrix(encodings).astype(VECTOR_DTYPE, copy=False)
+        message = REQUEST_HEADER.pack(MAGIC, op, top_k, 0, len(vectors))
+        message += vectors.tobytes()
+
+        with self._lock:
+            for attempt in range(2):
+                sent = False
+                try:
+                    if self._sock is None:
+                        self._sock = self._connect()
+                    self._sock.settimeout(timeout or self.timeout)
+                    self._sock.sendall(message)
+                    sent = True
+                    header = _recv_exact(self._sock, RESPONSE_HEADER.size)
+                    if header is None:
+                        raise ConnectionError("Match server closed the connection.")
+                    magic, status, length = RESPONSE_HEADER.unpack(header)
+                    body = _recv_exact(self._sock, length)
+                    if magic != MAGIC or body is None:
+                        raise ConnectionError("Invalid response from match server.")
+                    break
+                except OSError as e:
+                    self.close()
+                    retryable = (
+                        attempt == 0
+                        and not sent
+                        and op != OP_RELOAD
+                        and isinstance(e, (ConnectionError, FileNotFoundError))
+                    )
+                    if not retryable:
+                        raise
+
+        data = json.loads(body.decode("utf-8"))
+        if status != STATUS_OK:
+            raise RuntimeError(data.get("error", "Match server error"))
+        return data
+
+    def _request_batches(
+        self, op: int, encodings: Sequence[np.ndarray], top_k: int = 0
+    ) -> List[Dict]:
+        """
+        エンコーディングをMAX_QUERIES件ずつのリクエストに分けて送り、結果をつなげて返す
+
+        Args:
+            op (int): 命令 (OP_MATCH or OP_RANK)
+            encodings (Sequence[np.ndarray]): 照合するエンコーディング
+            top_k (int): OP_RANKで返す候補の人数
+
+        Returns:
+            List[Dict]: 入力の順番に並んだ各エンコーディングの結果
+        """
+        if len(encodings) == 0:
+            return []
+        vectors = as_query_matrix(encodings)
+        results = []
+        for start in range(0, len(vectors), MAX_QUERIES):
+            chunk = vectors[start : start + MAX_QUERIES]
+            results.extend(self._request(op, chunk, top_k=top_k)["results"])
+        return results
+
+    def match_batch(self, encodings: Sequence[np.ndarray]) -> List[Dict]:
+        return self._request_batches(OP_MATCH, encodings)
+
+    def rank_users(self, encodings: Sequence[np.ndarray], top_k: int = 2) -> List[Dict]:
+        if not 1 <= top_k <= MAX_TOP_K:
+            raise ValueError(f"top_k must be between 1 and {MAX_TOP_K}, got {top_k}")
+        return self._request_batches(OP_RANK, encodings, top_k=top_k)
+
+    def authenticate_face(self, face_data: dict, top_k: Optional[int] = None) -> list:
+        """
+        単一の顔データを受け取り認証する (AuthenticationService.authenticate_faceと同じ結果)
+        """
+        if top_k is None:
+            match = self.match_batch([face_data["encoding"]])[0]
+            return [
+                {
+                    "name": match["name"],
+                    "box": face_data["location"],
+                    "distance": match["distance"],
+                }
+            ]
+
+        ranking = self.rank_users([face_data["encoding"]], top_k=top_k)[0]
+        candidates = ranking["candidates"]
+        name = "Unknown"
+        distance = float("inf")
+        if candidates:
+            distance = candidates[0]["distance"]
+            if distance <= self.tolerance:
+                name = candidates[0]["name"]
+        return [
+            {
+                "name": name,
+                "box": face_data["location"],
+                "distance": distance,
+                "candidates": candidates,
+                "margin": ranking["margin"],
+            }
+        ]
+
+    def authenticate_frame(self, frame: np.ndarray) -> List[Dict]:
+        """
+        フレーム内の全ての顔を検出し、まとめてサーバーで照合する
+        """
+        detected_faces = self.face_processor.detect_and_encode_faces(frame)
+        matches = self.match_batch([face["encoding"] for face in detected_faces])
+        return [
+            {"name": match["name"], "box": face_data["location"]}
+            for face_data, match in zip(detected_faces, matches)
+        ]
+
+    def reload_knowledge(self, wait: bool = False) -> Dict:
+        """
+        サーバー側でギャラリーを再読み込みさせる
+
+        サーバーは再読み込みが完了してから応答するため、waitに関わらず完了後に戻る
+        (待つ時間の上限はreload_timeout)
+        """
+        return self._request(OP_RELOAD, timeout=self.reload_timeout)
+
+    def close(self):
+        """
+        サーバーとの接続を閉じる
+        """
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            finally:
+                self._sock = None
@@ -0,0 +1,120 @@
+import threading
+import time
+from typing import Optional
+
+import cv2
+
+from ..utils.metrics import stage_timer
+
+# multipart/x-mixed-replaceの境界 (レスポンスのmimetypeのboundaryと一致させる)
+BOUNDARY = b"frame"
+
+
+class MJPEGEncoder:
+    """
+    配信用のフレームをJPEGにエンコードし、multipartの1パートにするクラス
+
+    解析に使う解像度とは別に配信用の解像度と画質を指定でき、上限フレームレートを
+    超えるフレームはエンコードせずに間引く。パートはJPEGのバッファを一度だけ
+    コピーして組み立てる
+    """
+
+    def __init__(
+        self,
+        preview_width: Optional[int] = None,
+        quality: int = 80,
+        max_fps: Optional[float] = None,
+    ):
+        """
+        MJPEGEncoderのコンストラクタ
+
+        Args:
+            preview_width (Optional[int]): 配信する映像の幅 (アスペクト比は保つ)
+                                           Noneの場合、またはフレームの方が小さい場合は縮小しない
+            quality (int): JPEGの画質 (0-100)
+            max_fps (Optional[float]): 配信の上限フレームレート, Noneの場合は制限しない
+        """
+        self.preview_width = preview_width
+        self.quality = quality
+        self.min_interval = 1.0 / max_fps if max_fps else 0.0
+        self._encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)]
+        self._lock = threading.Lock()
+        self._next_emit = 0.0
+
+    def should_emit(self, now: Optional[float] = None) -> bool:
+        """
+        上限フレームレートの範囲内で次のフレームを配信してよいかを判定する
+
+        Trueを返した場合、そのフレームを配信したものとして次の配信時刻を進める
+        """
+        if not self.min_interval:
+            return True
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if now < self._next_emit:
+                return False
+            # 予定通りなら一定間隔で次の時刻を進め、1間隔以上遅れた場合は遅れた分を
+            # 取り戻そうとして連続で配信しないよう、現在時刻から1間隔後にする
+            next_emit = self._next_emit + self.min_interval
+            if next_emit <= now:
+                next_emit = now + self.min_interval
+            self._next_emit = next_emit
+            return True
+
+    def resize(self, frame):
+        """
+        フレームを配信用の解像度に縮小する
+        """
+        height, width = frame.shape[:2]
+        if not self.preview_width or width <= self.preview_width:
+            return frame
+        scale = self.preview_width / width
+        return cv2.resize(
+            frame,
+            (self.preview_width, max(1, int(round(height * scale)))),
+            interpolation=cv2.INTER_AREA,
+        )
+
+    def encode_jpeg(self, frame):
+        """
+        フレームを配信用の解像度と画質でJPEGにエンコードする
+
+        Returns:
+            Optional[numpy.ndarray]: JPEGのバイト列を保持する配列, 失敗した場合はNone
+        """
+        with stage_timer("jpeg_encode"):
+            success, buffer = cv2.imencode(
+                ".jpg", self.resize(frame), self._encode_params
+            )
+        return buffer if success else None
+
+    def encode(self, frame) -> Optional[bytes]:
+        """
+        フレームをエンコードしてmultipartの1パートを返す (失敗した場合はNone)
+        """
+        buffer = self.encode_jpeg(frame)
+        if buffer is None:
+            return None
+        return build_part(buffer)
+
+
+def part_payload(part: bytes) -> bytes:
+    """
+    build_partで組み立てたパートからJPEG本体を取り出す
+    """
+    return part[part.index(b"\r\n\r\n") + 4 : -2]
+
+
+def build_part(buffer) -> bytes:
+    """
+    JPEGのバッファからmultipartの1パートを組み立てる
+
+    ヘッダー, JPEG本体, 末尾の改行をb"".joinで一度に連結し、途中のコピーを作らない
+    """
+    data = memoryview(buffer).cast("B")
+    header = (
+        b"--" + BOUNDARY + b"\r\n"
+        b"Content-Type: image/jpeg\r\n"
+        b"Content-Length: " + str(data.nbytes).encode("ascii") + b"\r\n\r\n"
+    )
+    return b"".join([header, data, b"\r\n"])
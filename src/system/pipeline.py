@@ -0,0 +1,517 @@
+import collections
+import threading
+import time
+import traceback
+import weakref
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from ..utils import tracing
+from ..utils.logger import setup_logger
+from ..utils.metrics import REGISTRY
+from .broadcast import FrameBroadcaster
+from .result_events import build_result_event
+from .scheduler import AdaptiveScheduler
+
+QUEUE_DEPTH = REGISTRY.gauge(
+    "face_auth_queue_depth", "Frames waiting in each pipeline queue.", ("queue",)
+)
+FRAMES_DROPPED = REGISTRY.counter(
+    "face_auth_frames_dropped_total",
+    "Frames dropped before reaching a stage.",
+    ("reason",),
+)
+SUBSCRIBERS = REGISTRY.gauge(
+    "face_auth_subscribers", "Connected viewers of each stream.", ("stream",)
+)
+
+
+class DropOldestQueue:
+    """
+    容量を超えた場合に最も古い要素を捨てる有界キュー
+
+    処理の遅い後段が前段を待たせないよう、putは決してブロックしない
+    """
+
+    def __init__(self, maxsize: int = 1):
+        """
+        DropOldestQueueのコンストラクタ
+
+        Args:
+            maxsize (int): 保持する最大要素数
+        """
+        self._items = collections.deque(maxlen=maxsize)
+        self._condition = threading.Condition()
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def put(self, item: Any):
+        """
+        要素を追加する (満杯の場合は最も古い要素を捨てる)
+        """
+        with self._condition:
+            if len(self._items) == self._items.maxlen:
+                self.dropped += 1
+            self._items.append(item)
+            self._condition.notify()
+
+    def clear(self):
+        """
+        保持している要素を全て捨てる (破棄数には数えない)
+        """
+        with self._condition:
+            self._items.clear()
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Any]:
+        """
+        最も古い要素を取り出す (timeout秒以内に要素が来なければNone)
+        """
+        with self._condition:
+            if not self._items and not self._condition.wait_for(
+                lambda: self._items, timeout
+            ):
+                return None
+            return self._items.popleft()
+
+
+class StreamPipeline:
+    """
+    取得・解析・描画を別々のスレッドで並列に処理するパイプライン
+
+    取得スレッドはカメラのフレームを解析キューと描画キューの両方に流す
+    解析スレッドは処理できる速さで最新のフレームを解析し、結果を更新する
+    描画スレッドは新しいフレームが届くたびに最新の解析結果を描画してJPEGにし、
+    FrameBroadcasterで全ての視聴者に配信する (視聴者が増えても処理は1つのまま)
+    キューは全て古い要素を捨てる有界キューなので、解析が遅くても映像は
+    カメラのフレームレートのまま流れ、遅延も溜まらない
+    解析の頻度と顔検出の縮小率はAdaptiveSchedulerが処理時間に応じて調整する
+    認証結果が確定すると、その画面を1回だけエンコードして保持期間中は同じバイト列を
+    ゆっくり再送し、その間はカメラの取得も解析も描画も行わない
+    登録用に静止している間も同様に、カメラの取得も止めてキャッシュした画面を再送する
+    解析結果は描画とは別に、モード・顔の枠・名前・トラックIDのJSONとして
+    Server-Sent Eventsで配信する (ブラウザ側で枠を描画する場合は映像に描画しない)
+    """
+
+    def __init__(
+        self,
+        processor,
+        analysis_queue_size: int = 1,
+        render_queue_size: int = 2,
+        max_result_age: float = 2.0,
+        capture_fps: float = 30.0,
+        scheduler: Optional[AdaptiveScheduler] = None,
+        result_hold_seconds: float = 3.0,
+        hold_fps: float = 5.0,
+        server_overlays: bool = True,
+    ):
+        """
+        StreamPipelineのコンストラクタ
+
+        Args:
+            processor (StreamProcessor): capture / analyze / render を提供するインスタンス
+            analysis_queue_size (int): 解析待ちのフレームを保持する数
+            render_queue_size (int): 描画待ちのフレームを保持する数
+            max_result_age (float): 解析結果を描画し続ける最大秒数
+                                    (解析が止まった場合に古い枠を表示し続けないため)
+            capture_fps (float): 取得の上限フレームレート
+                                 (静止画の表示中やシミュレートカメラで空回りしないため)
+            scheduler (Optional[AdaptiveScheduler]): 解析の頻度と顔検出の縮小率を
+                                                     調整するインスタンス
+            result_hold_seconds (float): 認証結果が確定した時、その結果の画面を
+                                         表示し続ける秒数 (0の場合は保持しない)
+            hold_fps (float): 結果の画面を保持している間に再送するフレームレート
+            server_overlays (bool): 解析結果を映像に描画するか
+                                    Falseの場合は枠も文字もない映像を配信し、
+                                    ブラウザがイベントの解析結果を描画する
+        """
+        self.logger = setup_logger(__name__)
+        self.processor = processor
+        self.max_result_age = max_result_age
+        self.capture_interval = 1.0 / capture_fps
+        self.scheduler = scheduler or AdaptiveScheduler()
+        self.result_hold_seconds = result_hold_seconds
+        self.hold_interval = 1.0 / hold_fps
+        self.server_overlays = server_overlays
+
+        self.analysis_queue = DropOldestQueue(analysis_queue_size)
+        self.render_queue = DropOldestQueue(render_queue_size)
+        # 描画済みのJPEGは全ての視聴者に同じものを配信する
+        self.broadcaster = FrameBroadcaster()
+        # 解析結果のイベントも同じ仕組みで全ての購読者に配信する
+        self.events = FrameBroadcaster()
+
+        # 最新の解析結果 (描画要素, 解析したフレームのモード, 解析完了時刻)
+        self._result_lock = threading.Lock()
+        self._latest_result: Optional[Dict] = None
+        # 結果の画面を保持している間の状態 (フレーム, 描画要素, 終了時刻, エンコード済みのパート)
+        self._hold: Optional[Dict] = None
+
+        self._start_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._threads: List[threading.Thread] = []
+        # 静止中に再送する解析結果のイベント (静止した時点の解析結果, イベント)
+        self._frozen_event: Optional[tuple] = None
+        # /metricsに登録したコールバック (メトリクス, ラベル, 関数)
+        self._metric_functions: List[Tuple[Any, Dict[str, str], Callable]] = []
+
+    def _register_metrics(self):
+        """
+        キューの長さや破棄数は各オブジェクトが数えている値をそのまま公開する
+        (/metricsの取得時にだけ読むため、ストリームの処理には負荷をかけない)
+
+        レジストリはモジュール全体で共有されるため、実行中のパイプラインだけを登録し、
+        停止時に登録を解除する。コールバックは弱参照で持ち、解除し忘れても
+        パイプラインのキューやフレームをレジストリが保持し続けないようにする
+        """
+        pipeline = weakref.ref(self)
+        self._metric_functions = [
+            (
+                QUEUE_DEPTH,
+                {"queue": "analysis"},
+                lambda: len(pipeline().analysis_queue),
+            ),
+            (QUEUE_DEPTH, {"queue": "render"}, lambda: len(pipeline().render_queue)),
+            (
+                FRAMES_DROPPED,
+                {"reason": "analysis_queue"},
+                lambda: pipeline().analysis_queue.dropped,
+            ),
+            (
+                FRAMES_DROPPED,
+                {"reason": "render_queue"},
+                lambda: pipeline().render_queue.dropped,
+            ),
+            (
+                FRAMES_DROPPED,
+                {"reason": "stale"},
+                lambda: pipeline().scheduler.dropped_stale,
+            ),
+            (
+                SUBSCRIBERS,
+                {"stream": "video"},
+                lambda: pipeline().broadcaster.subscriber_count,
+            ),
+            (
+                SUBSCRIBERS,
+                {"stream": "events"},
+                lambda: pipeline().events.subscriber_count,
+            ),
+        ]
+        for metric, labels, function in self._metric_functions:
+            metric.set_function(function, **labels)
+
+    def _unregister_metrics(self):
+        """
+        _register_metricsで登録したコールバックを解除する
+        (他のパイプラインが後から登録したものは残す)
+        """
+        for metric, labels, function in self._metric_functions:
+            metric.remove_function(function, **labels)
+        self._metric_functions = []
+
+    def start(self):
+        """
+        各ステージのスレッドを開始する (開始済みの場合は何もしない)
+        """
+        with self._start_lock:
+            if self._threads:
+                return
+            self._stop_event.clear()
+            self._register_metrics()
+            for name, target in (
+                ("pipeline-capture", self._capture_loop),
+                ("pipeline-analysis", self._analysis_loop),
+                ("pipeline-render", self._render_loop),
+            ):
+                thread = threading.Thread(target=target, name=name, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        self.logger.info("StreamPipeline started.")
+
+    def stop(self):
+        """
+        各ステージのスレッドを停止する
+        """
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join(timeout=2.0)
+        self._threads = []
+        self._unregister_metrics()
+        self.logger.info("StreamPipeline stopped.")
+
+    def generate(self):
+        """
+        描画済みのJPEGをmultipartの形式で返し続けるジェネレータ関数
+
+        視聴者ごとに呼び出してよい (各視聴者は最新のフレームを受け取る)
+        """
+        self.start()
+        yield from self.broadcaster.subscribe()
+
+    def event_stream(self):
+        """
+        解析結果をServer-Sent Eventsの形式で返し続けるジェネレータ関数
+
+        購読を始めると最新の解析結果から受け取る
+        """
+        self.start()
+        yield from self.events.subscribe()
+
+    def operating_point(self) -> Dict:
+        """
+        現在の動作点 (縮小率, 各ステージの処理時間, 解析頻度, 破棄したフレーム数) を返す
+        """
+        point = self.scheduler.operating_point()
+        point["dropped_frames"] = {
+            "analysis": self.analysis_queue.dropped,
+            "render": self.render_queue.dropped,
+        }
+        point["viewers"] = self.broadcaster.subscriber_count
+        point["event_subscribers"] = self.events.subscriber_count
+        return point
+
+    def latest_result(self) -> Optional[Dict]:
+        """
+        最新の解析結果を返す (まだ解析していない場合はNone)
+        """
+        with self._result_lock:
+            return self._latest_result
+
+    def _capture_loop(self):
+        next_capture = time.monotonic()
+        while not self._stop_event.is_set():
+            # 上限フレームレートを超えないよう次の取得時刻まで待つ
+            delay = next_capture - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_capture = max(next_capture, time.monotonic()) + self.capture_interval
+            # 登録用に静止している間は、カメラの読み取りもフレームのコピーも行わない
+            if self.processor.frozen_capture() is not None:
+                time.sleep(self.processor.frozen_interval)
+                continue
+            # 結果の画面を保持している間も、解析も描画もされないフレームは取得しない
+            hold = self._active_hold()
+            if hold is not None:
+                time.sleep(
+                    min(self.hold_interval, max(0.0, hold["until"] - time.monotonic()))
+                )
+                continue
+            # トレースを有効にした場合、フレームごとのIDを後段のスレッドに引き継ぐ
+            frame_id = tracing.start_frame()
+            started_at = time.monotonic()
+            try:
+                frame = self.processor.capture()
+            except Exception as e:
+                self.logger.error(
+                    "Capture stage failed.",
+                    extra={"error": str(e), "traceback": traceback.format_exc()},
+                )
+                frame = None
+            if frame is None:
+                time.sleep(0.1)
+                continue
+
+            # 解析側は描画側と別のフレームのコピーを使う (描画による上書きを避ける)
+            captured_at = time.monotonic()
+            self.scheduler.record("capture", captured_at - started_at)
+            self.analysis_queue.put((frame.copy(), captured_at, frame_id))
+            self.render_queue.put((frame, captured_at, frame_id))
+
+    def _analysis_loop(self):
+        while not self._stop_event.is_set():
+            frozen = self.processor.frozen_capture()
+            if frozen is not None:
+                self._send_frozen_event(frozen)
+                time.sleep(self.processor.frozen_interval)
+                continue
+            # 結果の画面を保持している間は解析しない
+            hold = self._active_hold()
+            if hold is not None:
+                time.sleep(min(0.1, max(0.0, hold["until"] - time.monotonic())))
+                continue
+            # 次の解析を始めてよい時刻まで待ってから、その時点で最新のフレームを取り出す
+            delay = self.scheduler.wait_time()
+            if delay > 0:
+                time.sleep(delay)
+            item = self.analysis_queue.get(timeout=0.5)
+            if item is None:
+                continue
+            frame, captured_at, frame_id = item
+            tracing.bind_frame(frame_id)
+            self._trace_queue_wait("analysis_queue_wait", captured_at)
+            # 遅れて解析しても結果が古くなるだけなので、古いフレームは捨てる
+            if self.scheduler.is_stale(captured_at):
+                continue
+
+            # 縮小率を使うのは認証時だけなので、登録時の処理時間で縮小率を変えないようにする
+            scaled = self.processor.app_state.mode == "AUTHENTICATING"
+            started_at = time.monotonic()
+            try:
+                overlays = self.processor.analyze(
+                    frame, detection_scale=self.scheduler.detection_scale
+                )
+            except Exception as e:
+                self.logger.error(
+                    "Analysis stage failed.",
+                    extra={"error": str(e), "traceback": traceback.format_exc()},
+                )
+                continue
+            finished_at = time.monotonic()
+            self.scheduler.record_analysis(started_at, finished_at, scaled=scaled)
+
+            # 解析によって登録モードが静止状態に変わる場合があるため、解析後のモードを記録する
+            mode = self.processor.app_state.mode
+            # 認証結果が確定したフレームは、一定時間そのまま表示し続ける
+            hold = self.result_hold_seconds > 0 and any(
+                overlay.get("hold") for overlay in overlays
+            )
+            event = build_result_event(
+                overlays,
+                mode,
+                (frame.shape[1], frame.shape[0]),
+                self.processor.app_state.captured_frame is not None,
+                hold_seconds=self.result_hold_seconds if hold else None,
+            )
+            with self._result_lock:
+                self._latest_result = {
+                    "overlays": overlays,
+                    "mode": mode,
+                    "captured_at": captured_at,
+                    "analyzed_at": finished_at,
+                }
+                if hold:
+                    self._hold = {
+                        "frame": frame,
+                        "overlays": overlays,
+                        "mode": mode,
+                        "until": finished_at + self.result_hold_seconds,
+                        "next_send": finished_at,
+                        "part": None,
+                    }
+            if hold:
+                # 保持の前に取得したフレームは、保持の終了後に表示しないよう捨てておき、
+                # フレームを待っている描画スレッドを起こしてすぐに結果の画面を送らせる
+                self.analysis_queue.clear()
+                self.render_queue.clear()
+                self.render_queue.put(None)
+            self.events.publish(event)
+
+    def _render_loop(self):
+        while not self._stop_event.is_set():
+            part = self.processor.frozen_part(self.server_overlays)
+            if part is not None:
+                self.broadcaster.publish(part)
+                time.sleep(self.processor.frozen_interval)
+                continue
+            # 保持中は取得スレッドがフレームを流さないため、結果の画面を一定の間隔で再送する
+            hold = self._active_hold()
+            if hold is not None:
+                self._send_hold(hold)
+                time.sleep(
+                    max(0.0, min(hold["next_send"], hold["until"]) - time.monotonic())
+                )
+                continue
+            item = self.render_queue.get(timeout=0.5)
+            if item is None:
+                continue
+            frame, captured_at, frame_id = item
+            tracing.bind_frame(frame_id)
+            self._trace_queue_wait("render_queue_wait", captured_at)
+            if self._active_hold() is not None:
+                # 待っている間に保持が始まった場合、保持の前に取得したフレームは捨てる
+                continue
+            # 配信の上限フレームレートを超える分は描画もエンコードもしない
+            if not self.processor.encoder.should_emit():
+                continue
+            started_at = time.monotonic()
+            try:
+                if self.server_overlays:
+                    frame = self.processor.render(frame, self._current_overlays())
+                part = self.processor.encoder.encode(frame)
+                if part is not None:
+                    self.broadcaster.publish(part)
+                self.scheduler.record("render", time.monotonic() - started_at)
+            except Exception as e:
+                self.logger.error(
+                    "Render stage failed.",
+                    extra={"error": str(e), "traceback": traceback.format_exc()},
+                )
+
+    def _send_frozen_event(self, frozen: Dict):
+        """
+        静止した時点の解析結果のイベントを再送する (イベントは最初の1回だけ組み立てる)
+        """
+        if self._frozen_event is None or self._frozen_event[0] is not frozen:
+            frame = frozen["frame"]
+            self._frozen_event = (
+                frozen,
+                build_result_event(
+                    frozen["overlays"],
+                    "REGISTRATION_FROZEN",
+                    (frame.shape[1], frame.shape[0]),
+                    True,
+                ),
+            )
+        self.events.publish(self._frozen_event[1])
+
+    @staticmethod
+    def _trace_queue_wait(name: str, captured_at: float):
+        """
+        取得してから後段のスレッドが取り出すまでの待ち時間をトレースに記録する
+        """
+        waited = max(0.0, time.monotonic() - captured_at)
+        tracing.record_span(name, time.perf_counter() - waited, waited)
+
+    def _active_hold(self) -> Optional[Dict]:
+        """
+        保持中の結果の画面を返す (保持期間の終了やモードの変更で保持をやめる)
+        """
+        with self._result_lock:
+            hold = self._hold
+            if hold is None:
+                return None
+            if (
+                time.monotonic() >= hold["until"]
+                or hold["mode"] != self.processor.app_state.mode
+            ):
+                self._hold = None
+                return None
+            return hold
+
+    def _send_hold(self, hold: Dict):
+        """
+        結果の画面を最初の1回だけ描画・エンコードし、以降はそのバイト列を再送する
+        """
+        now = time.monotonic()
+        if now < hold["next_send"]:
+            return
+        hold["next_send"] = now + self.hold_interval
+        try:
+            if hold["part"] is None:
+                frame = hold["frame"]
+                if self.server_overlays:
+                    frame = self.processor.render(frame, hold["overlays"])
+                hold["part"] = self.processor.encoder.encode(frame)
+            if hold["part"] is not None:
+                self.broadcaster.publish(hold["part"])
+        except Exception as e:
+            self.logger.error(
+                "Render stage failed.",
+                extra={"error": str(e), "traceback": traceback.format_exc()},
+            )
+
+    def _current_overlays(self) -> List[Dict]:
+        """
+        描画に使う解析結果を返す
+
+        モードが変わった後の結果や、max_result_ageより古い結果は描画しない
+        """
+        result = self.latest_result()
+        if result is None:
+            return []
+        if result["mode"] != self.processor.app_state.mode:
+            return []
+        if time.monotonic() - result["analyzed_at"] > self.max_result_age:
+            return []
+        return result["overlays"]
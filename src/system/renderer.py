@@ -5,6 +5,7 @@ import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 
 from ..utils.logger import setup_logger
+from ..utils.metrics import stage_timer
 
 
 class FrameRenderer:
@@ -34,15 +35,19 @@ class FrameRenderer:
         """
         ヘルパー関数: Pillowを使って日本語を描画する。
         """
-        if not self.font:
-            # フォールバックとしてOpenCVのデフォルトフォントで描画
-            cv2.putText(image, text, position, cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2)
-            return image
+        with stage_timer("text_render"):
+            if not self.font:
+                # フォールバックとしてOpenCVのデフォルトフォントで描画
+                cv2.putText(
+                    image, text, position, cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2
+                )
+                return image
 
-        img_pil = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-        draw = ImageDraw.Draw(img_pil)
-        draw.text(position, text, font=self.font, fill=color)
-        return cv2.cvtColor(np.array(img_pil), cv2.COLOR_RGB2BGR)
+            # 日本語の描画は画像全体をPillowとの間で変換するため、描画の中で最も重い
+            img_pil = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+            draw = ImageDraw.Draw(img_pil)
+            draw.text(position, text, font=self.font, fill=color)
+            return cv2.cvtColor(np.array(img_pil), cv2.COLOR_RGB2BGR)
 
     def draw_guide_box(self, frame, rect, color):
         """
@@ -0,0 +1,72 @@
+import json
+from typing import Dict, List, Optional, Sequence
+
+
+def bgr_to_hex(color: Sequence[int]) -> str:
+    """
+    OpenCVのBGRの色をCSSの"#rrggbb"に変換する
+    """
+    blue, green, red = (int(c) for c in color[:3])
+    return f"#{red:02x}{green:02x}{blue:02x}"
+
+
+def overlay_to_event(overlay: Dict) -> Dict:
+    """
+    StreamProcessor.analyzeが返す描画要素を、ブラウザで描画できる形式に変換する
+
+    Args:
+        overlay (Dict): "guide"または"face"の描画要素
+
+    Returns:
+        Dict: 座標を名前付きにし、色をCSSの形式にした描画要素
+    """
+    if overlay["type"] == "guide":
+        x, y, width, height = (int(v) for v in overlay["rect"])
+        return {
+            "type": "guide",
+            "rect": {"x": x, "y": y, "width": width, "height": height},
+            "color": bgr_to_hex(overlay["color"]),
+        }
+
+    # 縮小して検出した座標はnumpyの整数の場合があるため、JSONにできる型にする
+    top, right, bottom, left = (int(v) for v in overlay["location"])
+    return {
+        "type": "face",
+        "box": {"top": top, "right": right, "bottom": bottom, "left": left},
+        "trackId": overlay.get("track_id"),
+        "name": overlay.get("name"),
+        "message": overlay["message"],
+        "color": bgr_to_hex(overlay["color"]),
+    }
+
+
+def build_result_event(
+    overlays: List[Dict],
+    mode: str,
+    frame_size: Sequence[int],
+    is_frame_captured: bool,
+    hold_seconds: Optional[float] = None,
+) -> bytes:
+    """
+    1回分の解析結果をServer-Sent Eventsの1イベントにする
+
+    Args:
+        overlays (List[Dict]): 解析結果の描画要素のリスト
+        mode (str): 解析後のアプリケーションのモード
+        frame_size (Sequence[int]): 解析したフレームの(幅, 高さ)
+                                    ブラウザは表示サイズとの比で座標を拡大・縮小する
+        is_frame_captured (bool): 登録用のフレームをキャプチャ済みか
+        hold_seconds (Optional[float]): 認証結果を表示し続ける秒数 (結果が確定した場合のみ)
+
+    Returns:
+        bytes: "data: ...\\n\\n"の形式のイベント
+    """
+    payload = {
+        "mode": mode,
+        "isFrameCaptured": is_frame_captured,
+        "frameSize": {"width": frame_size[0], "height": frame_size[1]},
+        "overlays": [overlay_to_event(overlay) for overlay in overlays],
+        "holdSeconds": hold_seconds,
+    }
+    data = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+    return b"data: " + data.encode("utf-8") + b"\n\n"
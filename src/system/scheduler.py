@@ -0,0 +1,191 @@
+import threading
+import time
+from typing import Dict, Optional, Sequence
+
+from ..utils.logger import setup_logger
+
+# 顔検出に使う縮小率の候補 (解析が遅い場合は右に、速い場合は左に移動する)
+DETECTION_SCALES = (1.0, 0.75, 0.5, 0.35, 0.25)
+
+
+class AdaptiveScheduler:
+    """
+    各ステージの処理時間を計測し、解析の頻度と顔検出の縮小率を調整するクラス
+
+    解析1回の処理時間(指数移動平均)が latency_budget を超えた場合は検出画像を縮小し、
+    元の解像度に近づけても予算に収まる場合は戻す。解析の間隔は、解析が1コアの
+    max_cpu_share を超えて使わないように、また max_analysis_fps を超えないように空ける
+    撮影から max_frame_age 秒以上経ったフレームは解析せずに捨てる
+    """
+
+    def __init__(
+        self,
+        latency_budget: float = 0.3,
+        max_analysis_fps: float = 10.0,
+        max_cpu_share: float = 0.7,
+        max_frame_age: float = 0.5,
+        smoothing: float = 0.3,
+        cooldown_samples: int = 5,
+        scales: Sequence[float] = DETECTION_SCALES,
+    ):
+        """
+        AdaptiveSchedulerのコンストラクタ
+
+        Args:
+            latency_budget (float): 解析1回あたりの目標処理時間(秒)
+            max_analysis_fps (float): 解析の上限頻度(回/秒)
+            max_cpu_share (float): 解析スレッドが使う時間の上限の割合 (0-1)
+                                   残りは取得・描画のステージに残しておく
+            max_frame_age (float): 解析する価値のあるフレームの撮影からの経過時間(秒)
+            smoothing (float): 処理時間の指数移動平均の係数
+            cooldown_samples (int): 縮小率を変えた後、次に変えるまでに計測する解析の回数
+            scales (Sequence[float]): 顔検出の縮小率の候補 (大きい順)
+        """
+        self.logger = setup_logger(__name__)
+        self.latency_budget = latency_budget
+        self.min_interval = 1.0 / max_analysis_fps
+        self.max_cpu_share = max_cpu_share
+        self.max_frame_age = max_frame_age
+        self.smoothing = smoothing
+        self.cooldown_samples = cooldown_samples
+        self.scales = tuple(scales)
+
+        self._lock = threading.Lock()
+        self._scale_index = 0
+        self._samples_since_change = 0
+        # ステージ名 -> 処理時間の指数移動平均(秒)
+        self._latencies: Dict[str, float] = {}
+        self._last_analysis_start: Optional[float] = None
+        self._last_analysis_end: Optional[float] = None
+        # 直前の解析の処理時間を記録したステージ名 (解析の間隔の計算に使う)
+        self._last_analysis_stage = "analysis"
+        self._analysis_rate: Optional[float] = None
+        self.dropped_stale = 0
+
+    @property
+    def detection_scale(self) -> float:
+        """
+        現在の顔検出の縮小率
+        """
+        return self.scales[self._scale_index]
+
+    def wait_time(self, now: Optional[float] = None) -> float:
+        """
+        次の解析を開始してよい時刻までの秒数を返す (すぐに開始してよい場合は0)
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self._last_analysis_start is None:
+                return 0.0
+            latency = self._latencies.get(self._last_analysis_stage, 0.0)
+            # 解析の占有率をmax_cpu_share以下に抑えるための休止時間
+            idle = latency * (1.0 - self.max_cpu_share) / self.max_cpu_share
+            next_start = max(
+                self._last_analysis_start + self.min_interval,
+                self._last_analysis_end + idle,
+            )
+        return max(0.0, next_start - now)
+
+    def is_stale(self, captured_at: float, now: Optional[float] = None) -> bool:
+        """
+        フレームが古すぎて解析する価値がないかを判定する (古い場合は破棄数に数える)
+        """
+        now = time.monotonic() if now is None else now
+        if now - captured_at <= self.max_frame_age:
+            return False
+        with self._lock:
+            self.dropped_stale += 1
+        return True
+
+    def record(self, stage: str, seconds: float):
+        """
+        ステージの1回分の処理時間を記録する
+
+        Args:
+            stage (str): ステージ名 ("capture", "analysis", "render" など)
+            seconds (float): 処理時間(秒)
+        """
+        with self._lock:
+            previous = self._latencies.get(stage)
+            self._latencies[stage] = (
+                seconds
+                if previous is None
+                else previous + self.smoothing * (seconds - previous)
+            )
+
+    def record_analysis(
+        self, started_at: float, finished_at: float, scaled: bool = True
+    ):
+        """
+        解析1回分の開始・終了時刻を記録し、必要であれば縮小率を変更する
+
+        Args:
+            started_at (float): 解析の開始時刻
+            finished_at (float): 解析の終了時刻
+            scaled (bool): detection_scaleを使って解析したか
+                           Falseの場合 (登録時など常に元の解像度で解析する場合) は、
+                           処理時間を"full_resolution_analysis"として別に記録し、
+                           縮小率の判定には使わない
+        """
+        stage = "analysis" if scaled else "full_resolution_analysis"
+        self.record(stage, finished_at - started_at)
+        with self._lock:
+            if self._last_analysis_start is not None:
+                interval = started_at - self._last_analysis_start
+                if interval > 0:
+                    rate = 1.0 / interval
+                    self._analysis_rate = (
+                        rate
+                        if self._analysis_rate is None
+                        else self._analysis_rate
+                        + self.smoothing * (rate - self._analysis_rate)
+                    )
+            self._last_analysis_start = started_at
+            self._last_analysis_end = finished_at
+            self._last_analysis_stage = stage
+            if not scaled:
+                return
+            self._samples_since_change += 1
+            if self._samples_since_change < self.cooldown_samples:
+                return
+
+            latency = self._latencies["analysis"]
+            previous_index = self._scale_index
+            index = previous_index
+            if latency > self.latency_budget and index < len(self.scales) - 1:
+                index += 1
+            elif (
+                index > 0
+                and latency * (self.scales[index - 1] / self.scales[index]) ** 2
+                < self.latency_budget * 0.8
+            ):
+                # 元の解像度に近づけても予算に余裕が残る場合だけ戻す
+                index -= 1
+            if index == previous_index:
+                return
+            self._scale_index = index
+            self._samples_since_change = 0
+            # 検出の処理時間は画素数にほぼ比例するため、移動平均を変更後の予測値に置き換える
+            ratio = self.scales[index] / self.scales[previous_index]
+            self._latencies["analysis"] = latency * ratio * ratio
+
+        self.logger.info(
+            "Detection scale changed.",
+            extra={"detection_scale": self.scales[index], "analysis_latency": latency},
+        )
+
+    def operating_point(self) -> Dict:
+        """
+        現在の動作点 (縮小率, 各ステージの処理時間, 解析頻度, 破棄数) を返す
+        """
+        with self._lock:
+            return {
+                "detection_scale": self.scales[self._scale_index],
+                "latency_ms": {
+                    stage: round(seconds * 1000, 1)
+                    for stage, seconds in self._latencies.items()
+                },
+                "analysis_fps": round(self._analysis_rate or 0.0, 2),
+                "latency_budget_ms": round(self.latency_budget * 1000, 1),
+                "dropped_stale_frames": self.dropped_stale,
+            }
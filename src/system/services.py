@@ -1,17 +1,39 @@
 # src/system/services.py
 
 import datetime
+import os
+import threading
+import traceback
 import uuid
-from typing import Dict, List
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
 
 import cv2
 import numpy as np
 
-import face_recognition
-
 from ..utils.logger import setup_logger
+from ..utils.metrics import REGISTRY, stage_timer
 from .data_manager import DataManager
 from .face_processor import FaceProcessor
+from .gallery import Gallery, GallerySnapshot, as_query_matrix, group_min
+from .index import build_index, is_exact_backend
+from .match_cache import NegativeMatchCache
+from .shared_gallery import SharedGalleryStore
+
+# GalleryRegistryが複数のテナントのサービスを持つため、テナントごとに記録する
+# (テナントを使わない場合は"default")
+GALLERY_SIZE = REGISTRY.gauge(
+    "face_auth_gallery_encodings",
+    "Encodings in the published gallery snapshot.",
+    ("tenant",),
+)
+GALLERY_USERS = REGISTRY.gauge(
+    "face_auth_gallery_users", "Users in the published gallery snapshot.", ("tenant",)
+)
+NEGATIVE_CACHE_HITS = REGISTRY.counter(
+    "face_auth_negative_cache_hits_total",
+    "Queries answered as Unknown by the negative match cache.",
+)
 
 
 class RegistrationService:
@@ -21,18 +43,31 @@ class RegistrationService:
     DataManagerを利用して、ユーザー情報の登録と画像データの保存を行う
     """
 
-    def __init__(self, data_manager: DataManager):
+    def __init__(
+        self,
+        data_manager: DataManager,
+        face_processor: Optional[FaceProcessor] = None,
+    ):
         """
         RegistrationServiceのコンストラクタ
 
         Args:
             data_manager (DataManager): データ永続化を担当するDataManagerのインスタンス
+            face_processor (Optional[FaceProcessor]): 顔位置の検出に使ったFaceProcessor
+                                                      顔位置キャッシュの保存に使う
         """
         self.data_manager = data_manager
+        self.face_processor = face_processor
         self.logger = setup_logger(__name__)
         self.logger.info("RegistrationService initialized.")
 
-    def register_new_user(self, name: str, images: List[np.ndarray]) -> str:
+    def register_new_user(
+        self,
+        name: str,
+        images: List[np.ndarray],
+        face_locations: Optional[List[Tuple[int, int, int, int]]] = None,
+        face_encodings: Optional[List[np.ndarray]] = None,
+    ) -> str:
         """
         新しいユーザーをシステムに登録する
 
@@ -41,6 +76,12 @@ class RegistrationService:
         Args:
             name (str): 登録するユーザーの名前。
             images (List[np.ndarray]): 登録する顔画像のリスト (OpenCV形式)
+            face_locations (Optional[List[Tuple[int, int, int, int]]]):
+                撮影時に検出済みの各画像の顔の位置
+                指定された場合、エンコーディング再構築時の顔検出を省略できる
+            face_encodings (Optional[List[np.ndarray]]):
+                撮影時に計算済みの各画像の顔のエンコーディング (face_locationsと併せて指定する)
+                指定された場合、エンコーディング再構築時のエンコードも省略できる
 
         Returns:
             str: 生成された新しいユーザーの一意なID (UUID)
@@ -67,7 +108,16 @@ class RegistrationService:
         self.logger.info(f"Appended new user to metadata for user_id: {user_id}")
 
         # 顔画像を保存(dataset/ユーザーID/.jpg)
-        self.data_manager.save_images_for_user(user_id, images)
+        detector_settings = None
+        if face_locations is not None and self.face_processor is not None:
+            detector_settings = self.face_processor.detector_settings
+        self.data_manager.save_images_for_user(
+            user_id,
+            images,
+            face_locations=face_locations,
+            detector_settings=detector_settings,
+            face_encodings=face_encodings,
+        )
 
         self.logger.info(
             f"Successfully registered new user '{name}' with ID '{user_id}'."
@@ -80,29 +130,67 @@ class EncodingService:
     データセット全体の顔エンコード処理を担当するクラス
     """
 
-    def __init__(self, data_manager: DataManager, face_processor: FaceProcessor):
+    def __init__(
+        self,
+        data_manager: DataManager,
+        face_processor: FaceProcessor,
+        prototypes_per_user: Optional[int] = None,
+        duplicate_tolerance: float = 0.25,
+    ):
         """
         EncodingServiceのコンストラクタ
 
         Args:
             data_manager (DataManager): データ永続化を担当するDataManagerのインスタンス
             face_processor (FaceProcessor): 顔処理を担当するFaceProcessorのインスタンス
+            prototypes_per_user (Optional[int]): 1ユーザーあたりに残す代表エンコーディング数
+                                                 Noneの場合は圧縮しない
+            duplicate_tolerance (float): この距離未満のエンコーディングを重複とみなす
         """
         self.data_manager = data_manager
         self.face_processor = face_processor
+        self.prototypes_per_user = prototypes_per_user
+        self.duplicate_tolerance = duplicate_tolerance
         self.logger = setup_logger(__name__)
         self.logger.info("EncodingService initialized.")
 
     def build_encodings_from_dataset(self):
         """
         データセット内の画像を処理し、エンコーディングを構築・保存する
+
+        prototypes_per_userが指定されている場合は、保存前にギャラリーを圧縮する
         """
         self.logger.info("Starting to build encodings from dataset")
 
+        all_known_encodings, all_known_user_ids = self.collect_encodings()
+
+        if not all_known_encodings:
+            self.logger.error("No valid encodings were generated. Aborting save.")
+            return
+
+        if self.prototypes_per_user is not None:
+            all_known_encodings, all_known_user_ids = self.compact_encodings(
+                all_known_encodings, all_known_user_ids
+            )
+
+        # 全ての有効のエンコーディングをファイルに保存
+        self.data_manager.save_encodings(
+            encodings=all_known_encodings, user_ids=all_known_user_ids
+        )
+        self.logger.info("Successfully built and saved all valid encodings.")
+
+    def collect_encodings(self) -> Tuple[List[np.ndarray], List[str]]:
+        """
+        データセット内の全ユーザーの画像からエンコーディングを抽出する
+
+        Returns:
+            Tuple[List[np.ndarray], List[str]]: エンコーディングのリストと、
+                                               各エンコーディングに対応するユーザーIDのリスト
+        """
         metadata = self.data_manager.read_metadata()
         if not metadata:
             self.logger.warning("Metadata is empty. No users to encode.")
-            return
+            return [], []
 
         all_known_encodings = []
         all_known_user_ids = []
@@ -119,14 +207,58 @@ class EncodingService:
                 self.logger.warning(f"No images found for user {user_name}. Skipping.")
                 continue
 
+            # 登録時/前回の構築時に保存した顔位置は、検出器の設定が同じ場合のみ再利用する
+            face_cache = self.data_manager.load_face_cache(user_id)
+            detector_settings = self.face_processor.detector_settings
+            if face_cache.get("detector") != detector_settings:
+                face_cache = {"detector": detector_settings, "faces": {}}
+            cache_updated = False
+
             for image_path in image_paths:
+                filename = os.path.basename(image_path)
+                signature = self.data_manager.get_image_signature(image_path)
+                cached = face_cache["faces"].get(filename)
+                if cached is not None and cached.get("signature") != signature:
+                    cached = None
+
+                locations = None if cached is None else cached["locations"]
+                if locations is not None and len(locations) != 1:
+                    # 顔が1つでないことが分かっている画像は読み込まない
+                    self.logger.warning(
+                        f"Cached face count is {len(locations)}. Skipping: {image_path}"
+                    )
+                    continue
+
+                cached_encodings = None if cached is None else cached.get("encodings")
+                if cached_encodings is not None and len(cached_encodings) == 1:
+                    # 登録時に保存したエンコーディングは、画像を読み込まずにそのまま使う
+                    all_known_encodings.append(np.asarray(cached_encodings[0]))
+                    all_known_user_ids.append(user_id)
+                    continue
+
                 image = cv2.imread(image_path)
                 if image is None:
                     self.logger.error(f"Failed to read image: {image_path}")
                     continue
 
-                # FaceProcessorを使って、画像内の全ての顔エンコーディングを取得
-                encodings = self.face_processor.extract_encodings(image)
+                if locations is not None:
+                    # キャッシュ済みの顔位置からエンコーディングのみを計算
+                    encodings = self.face_processor.encode_faces(
+                        image, [tuple(locations[0])]
+                    )
+                else:
+                    # FaceProcessorを使って、画像内の全ての顔を検出・エンコード
+                    detected_faces = self.face_processor.detect_and_encode_faces(
+                        image, source="enrollment"
+                    )
+                    encodings = [face["encoding"] for face in detected_faces]
+                    face_cache["faces"][filename] = {
+                        "signature": signature,
+                        "locations": [
+                            list(face["location"]) for face in detected_faces
+                        ],
+                    }
+                    cache_updated = True
 
                 # 顔が1つだけ検出された場合のみ、処理を続行する
                 if len(encodings) == 1:
@@ -141,15 +273,111 @@ class EncodingService:
                         f"No face detected in image. Skipping: {image_path}"
                     )
 
-        if not all_known_encodings:
-            self.logger.error("No valid encodings were generated. Aborting save.")
-            return
+            if cache_updated:
+                self.data_manager.save_face_cache(user_id, face_cache)
 
-        # 全ての有効のエンコーディングをファイルに保存
-        self.data_manager.save_encodings(
-            encodings=all_known_encodings, user_ids=all_known_user_ids
+        return all_known_encodings, all_known_user_ids
+
+    def compact_encodings(
+        self,
+        encodings: List[np.ndarray],
+        user_ids: List[str],
+        prototypes_per_user: Optional[int] = None,
+    ) -> Tuple[List[np.ndarray], List[str]]:
+        """
+        ユーザーごとのエンコーディングを少数の代表(メドイド)に圧縮する
+
+        まず距離がduplicate_tolerance未満のほぼ重複したエンコーディングを取り除き、
+        残りが代表数を超える場合はk-medoidsで代表を選ぶ
+        代表は実在するエンコーディングなので、認証時の閾値の意味は変わらない
+
+        Args:
+            encodings (List[np.ndarray]): 128次元の顔エンコーディングのリスト
+            user_ids (List[str]): 各エンコーディングに対応するユーザーIDのリスト
+            prototypes_per_user (Optional[int]): 1ユーザーあたりの代表数
+                                                 Noneの場合はコンストラクタの値を使う
+
+        Returns:
+            Tuple[List[np.ndarray], List[str]]: 圧縮後のエンコーディングとユーザーIDのリスト
+        """
+        k = prototypes_per_user or self.prototypes_per_user
+        if not k or k < 1:
+            raise ValueError("prototypes_per_user must be a positive integer.")
+
+        # ユーザーごとにエンコーディングをまとめる (登録順を維持)
+        grouped: Dict[str, List[np.ndarray]] = {}
+        for encoding, user_id in zip(encodings, user_ids):
+            grouped.setdefault(user_id, []).append(encoding)
+
+        compacted_encodings = []
+        compacted_user_ids = []
+        for user_id, user_encodings in grouped.items():
+            prototypes = self._select_prototypes(np.asarray(user_encodings), k)
+            compacted_encodings.extend(prototypes)
+            compacted_user_ids.extend([user_id] * len(prototypes))
+
+        self.logger.info(
+            f"Compacted gallery from {len(encodings)} to "
+            f"{len(compacted_encodings)} encodings.",
+            extra={
+                "user_count": len(grouped),
+                "prototypes_per_user": k,
+                "duplicate_tolerance": self.duplicate_tolerance,
+            },
         )
-        self.logger.info("Successfully built and saved all valid encodings.")
+        return compacted_encodings, compacted_user_ids
+
+    def _select_prototypes(
+        self, encodings: np.ndarray, k: int, max_iterations: int = 10
+    ) -> List[np.ndarray]:
+        """
+        1ユーザー分のエンコーディングから重複を除き、k個のメドイドを選ぶ
+
+        Args:
+            encodings (np.ndarray): (N, 128)のエンコーディング行列
+            k (int): 選択する代表数
+            max_iterations (int): k-medoidsの最大反復回数
+
+        Returns:
+            List[np.ndarray]: 代表エンコーディングのリスト
+        """
+        # 全ペア間のユークリッド距離
+        diff = encodings[:, np.newaxis, :] - encodings[np.newaxis, :, :]
+        distances = np.linalg.norm(diff, axis=2)
+
+        # ほぼ重複したエンコーディングを貪欲に除外する
+        kept = []
+        for i in range(len(encodings)):
+            if all(distances[i, j] >= self.duplicate_tolerance for j in kept):
+                kept.append(i)
+        kept = np.asarray(kept)
+        if len(kept) <= k:
+            return [encodings[i] for i in kept]
+
+        distances = distances[np.ix_(kept, kept)]
+
+        # 初期値: 全体のメドイドから始め、最も遠い点を順に追加する
+        medoids = [int(np.argmin(distances.sum(axis=1)))]
+        while len(medoids) < k:
+            nearest = distances[:, medoids].min(axis=1)
+            medoids.append(int(np.argmax(nearest)))
+
+        # 割り当てとメドイドの更新を収束するまで繰り返す
+        for _ in range(max_iterations):
+            assignment = np.argmin(distances[:, medoids], axis=1)
+            new_medoids = []
+            for cluster in range(k):
+                members = np.flatnonzero(assignment == cluster)
+                if members.size == 0:
+                    new_medoids.append(medoids[cluster])
+                    continue
+                within = distances[np.ix_(members, members)].sum(axis=1)
+                new_medoids.append(int(members[np.argmin(within)]))
+            if new_medoids == medoids:
+                break
+            medoids = new_medoids
+
+        return [encodings[kept[i]] for i in medoids]
 
 
 class AuthenticationService:
@@ -162,6 +390,13 @@ class AuthenticationService:
         data_manager: DataManager,
         face_processor: FaceProcessor,
         tolerance: float = 0.6,
+        index_backend: str = "exact",
+        index_params: Optional[Dict] = None,
+        shared_gallery: Optional[SharedGalleryStore] = None,
+        shared_gallery_poll: float = 1.0,
+        negative_cache_size: int = 128,
+        negative_cache_ttl: float = 10.0,
+        tenant_id: str = "default",
     ):
         """
         AuthenticationServiceのコンストラクタ
@@ -172,66 +407,404 @@ class AuthenticationService:
             data_manager (DataManager): データ永続化を担当するインスタンス
             face_processor (FaceProcessor): 顔処理アルゴリズムを担当するインスタンス
             tolerance (float): 顔の類似度の閾値
+            index_backend (str): 照合に使う探索インデックス ("exact", "ivf", "sharded")
+            index_params (Optional[Dict]): 探索インデックスのパラメータ
+                                           例: {"n_lists": 1024, "n_probe": 16}
+                                               {"n_shards": 8, "shard_backend": "exact"}
+            shared_gallery (Optional[SharedGalleryStore]): 指定された場合、pickleを
+                読み込む代わりに共有メモリに公開されたギャラリーをアタッチする
+            shared_gallery_poll (float): 共有ギャラリーの新しいバージョンを確認する間隔(秒)
+            negative_cache_size (int): 最近Unknownと判定したエンコーディングを保持する数
+                                       0の場合はキャッシュを使わない
+                                       近似インデックス(IVFなど)では最近傍を見落とした
+                                       Unknownの判定がttlの間使い回され、照合できるはずの
+                                       人物もUnknownになるため、厳密な探索の場合だけ使う
+            negative_cache_ttl (float): Unknownのキャッシュの有効期間(秒)
+            tenant_id (str): ギャラリーの大きさのメトリクスに付けるテナントID
         """
         self.data_manager = data_manager
         self.face_processor = face_processor
         self.tolerance = tolerance
+        self.index_backend = index_backend
+        self.index_params = index_params or {}
+        self.tenant_id = tenant_id
         self.logger = setup_logger(__name__)
 
-        self.known_encodings = []
-        self.known_user_ids = []
-        self.user_id_to_name_map = {}
-
-        self._load_knowledge()
+        # 登録されていない来訪者が映り続ける間、毎フレームのギャラリー全体の照合を省略する
+        # キャッシュはスナップショットのバージョンが変わると破棄される
+        # 判定の正しさは最近傍までの距離が正確であることに依存するため、厳密な探索の場合だけ使う
+        self.negative_cache = None
+        if negative_cache_size > 0:
+            if is_exact_backend(index_backend, self.index_params):
+                self.negative_cache = NegativeMatchCache(
+                    tolerance, capacity=negative_cache_size, ttl=negative_cache_ttl
+                )
+            else:
+                self.logger.info(
+                    "Negative match cache disabled for approximate index.",
+                    extra={"index_backend": index_backend},
+                )
+
+        # 照合に必要なデータは不変のスナップショットとして1つの属性にまとめて保持する
+        # 読み取り側は呼び出しごとに一度だけ参照を取得するのでロックは不要
+        self.shared_gallery = shared_gallery
+        self._shared_version = None
+        self._reload_lock = threading.Lock()
+        # closeで共有ギャラリーの監視スレッドを止めるためのイベント
+        self._closed = threading.Event()
+        self._version = 0
+        self._snapshot = self._build_snapshot()
+        self._record_gallery_size(self._snapshot)
+
+        if self.shared_gallery is not None:
+            # 公開側が新しいバージョンを公開したら、バックグラウンドで差し替える
+            threading.Thread(
+                target=self._watch_shared_gallery,
+                args=(shared_gallery_poll,),
+                name="shared-gallery-watch",
+                daemon=True,
+            ).start()
         self.logger.info("AuthenticationService initialized.")
 
-    def _load_knowledge(self):
+    @property
+    def snapshot(self) -> GallerySnapshot:
+        """
+        現在公開されているギャラリーのスナップショット
         """
-        DataManagerを介して、認証に必要なデータをロードする
+        return self._snapshot
+
+    @property
+    def gallery(self) -> Gallery:
+        return self._snapshot.gallery
+
+    @property
+    def index(self):
+        return self._snapshot.index
+
+    @property
+    def user_id_to_name_map(self) -> Mapping[str, str]:
+        return self._snapshot.user_id_to_name_map
+
+    def _build_snapshot(self) -> GallerySnapshot:
+        """
+        DataManagerを介して認証に必要なデータをロードし、新しいスナップショットを構築する
+
+        エンコーディングは照合用のGallery行列に一度だけ変換し、探索インデックスを構築する
         """
+        # 共有メモリに公開されたギャラリーがあれば、コピーせずにアタッチする
+        attached = None
+        if self.shared_gallery is not None:
+            attached = self.shared_gallery.attach()
+            if attached is None:
+                # アタッチできなかったバージョンを記録し、監視スレッドが同じバージョンを
+                # 毎回読み込み直さないようにする (新しいバージョンが公開されたら再試行する)
+                manifest = self.shared_gallery.read_manifest()
+                self._shared_version = manifest["version"] if manifest else None
+                self.logger.warning(
+                    "Shared gallery is not available. Loading encodings file instead.",
+                    extra={"shared_version": self._shared_version},
+                )
+
         # 顔のエンコーディングをロード
-        encoding_data = self.data_manager.load_encodings()
-        if encoding_data:
-            self.known_encodings = encoding_data.get("encodings", [])
-            self.known_user_ids = encoding_data.get("user_ids", [])
-            self.logger.info(f"Loaded {len(self.known_encodings)} known encodings.")
+        encoding_data = None if attached else self.data_manager.load_encodings()
+        if attached:
+            gallery, self._shared_version = attached
+            self.logger.info(
+                f"Attached shared gallery with {len(gallery)} known encodings.",
+                extra={"shared_version": self._shared_version},
+            )
+        elif encoding_data:
+            gallery = Gallery.from_encodings(
+                encoding_data.get("encodings", []), encoding_data.get("user_ids", [])
+            )
+            self.logger.info(
+                f"Loaded {len(gallery)} known encodings.",
+                extra={"gallery_bytes": gallery.nbytes},
+            )
         else:
+            gallery = Gallery.from_encodings([], [])
             self.logger.warning(
                 "Could not load encodings. Authentication will not work."
             )
+        index = build_index(gallery, self.index_backend, self.index_params)
 
         # ユーザーIDと名前の対応辞書を作成
         metadata = self.data_manager.read_metadata()
-        self.user_id_to_name_map = {user["user_id"]: user["name"] for user in metadata}
+        user_id_to_name_map = {user["user_id"]: user["name"] for user in metadata}
         self.logger.info(
-            f"Loaded {len(self.user_id_to_name_map)} user metadata mappings.",
+            f"Loaded {len(user_id_to_name_map)} user metadata mappings.",
             extra={
-                "user_count": len(self.user_id_to_name_map),
+                "user_count": len(user_id_to_name_map),
             },
         )
 
-    def authenticate_face(self, face_data: dict) -> list:
+        self._version += 1
+        return GallerySnapshot(
+            gallery=gallery,
+            index=index,
+            user_id_to_name_map=MappingProxyType(user_id_to_name_map),
+            version=self._version,
+        )
+
+    def reload_knowledge(self, wait: bool = False) -> threading.Thread:
+        """
+        認証に必要なデータを読み込み直し、新しいスナップショットを公開する
+
+        新しいスナップショットはバックグラウンドのスレッドで構築し、完成後に
+        1回の参照の差し替えで公開する。構築中も照合は古いスナップショットで継続される
+
+        Args:
+            wait (bool): Trueの場合、公開が完了するまで待つ
+
+        Returns:
+            threading.Thread: 再読み込みを実行しているスレッド
+        """
+        thread = threading.Thread(
+            target=self._reload, name="gallery-reload", daemon=True
+        )
+        thread.start()
+        if wait:
+            thread.join()
+        return thread
+
+    def _watch_shared_gallery(self, interval: float):
+        """
+        共有ギャラリーのマニフェストを定期的に確認し、バージョンが変わったら再読み込みする
+        (closeが呼ばれたら終了する)
+        """
+        while not self._closed.wait(interval):
+            manifest = self.shared_gallery.read_manifest()
+            if manifest is not None and manifest["version"] != self._shared_version:
+                self._reload()
+
+    def close(self):
+        """
+        共有ギャラリーの監視を停止し、ギャラリーの大きさのメトリクスを削除する
+
+        監視スレッドはサービスへの参照を持つため、使わなくなったサービス
+        (GalleryRegistryから破棄したテナントなど) はcloseを呼ぶとメモリから解放される
+        照合は閉じた後も現在のスナップショットで続けられる
+        """
+        self._closed.set()
+        GALLERY_SIZE.remove(tenant=self.tenant_id)
+        GALLERY_USERS.remove(tenant=self.tenant_id)
+
+    def _reload(self):
+        """
+        スナップショットを再構築して公開する (再読み込みは同時に1つだけ実行する)
+        """
+        with self._reload_lock:
+            try:
+                snapshot = self._build_snapshot()
+            except Exception as e:
+                self.logger.error(
+                    "Failed to reload knowledge. Keeping the current snapshot.",
+                    extra={
+                        "error": str(e),
+                        "traceback": traceback.format_exc(),
+                    },
+                )
+                return
+            self._snapshot = snapshot
+        self._record_gallery_size(snapshot)
+        self.logger.info(
+            "Published new gallery snapshot.",
+            extra={"version": snapshot.version, "gallery_size": len(snapshot.gallery)},
+        )
+
+    def _record_gallery_size(self, snapshot: GallerySnapshot):
+        # 閉じた後に完了した再読み込みで、削除したメトリクスを戻さない
+        if self._closed.is_set():
+            return
+        GALLERY_SIZE.set(len(snapshot.gallery), tenant=self.tenant_id)
+        GALLERY_USERS.set(snapshot.gallery.num_users, tenant=self.tenant_id)
+
+    def match_batch(self, encodings: Sequence[np.ndarray]) -> List[Dict]:
+        """
+        複数の顔エンコーディングをまとめてギャラリーと照合する
+
+        全てのクエリを探索インデックスにまとめて渡し、クエリごとに最も近い登録者を返す
+        厳密インデックスの場合は、全てのクエリとギャラリーとの距離を1回の行列積で計算する
+
+        Args:
+            encodings (Sequence[np.ndarray]): 128次元の顔エンコーディングのリスト
+
+        Returns:
+            List[Dict]: 各エンコーディングに対応する照合結果のリスト
+                        例: [{"user_id": "...", "name": "...", "distance": 0.42}]
+                        閾値を超えた場合、user_idはNone, nameは"Unknown"となる
+        """
+        if len(encodings) == 0:
+            return []
+
+        snapshot = self._snapshot
+        gallery = snapshot.gallery
+        if len(gallery) == 0:
+            return [
+                {"user_id": None, "name": "Unknown", "distance": float("inf")}
+                for _ in range(len(encodings))
+            ]
+
+        # キャッシュ済みのUnknownに近いクエリは、距離の下限を返して照合を省略する
+        queries = as_query_matrix(encodings)
+        lower_bounds, pending = self._screen_unknowns(queries, snapshot.version)
+        results = [
+            {"user_id": None, "name": "Unknown", "distance": float(bound)}
+            for bound in lower_bounds
+        ]
+        if len(pending) == 0:
+            return results
+
+        with stage_timer("matching"):
+            best_distances, best_rows = snapshot.index.search(queries[pending], k=1)
+        for i, row, distance in zip(pending, best_rows[:, 0], best_distances[:, 0]):
+            user_id = None
+            name = "Unknown"
+            if row >= 0 and distance <= self.tolerance:
+                user_id = gallery.user_ids[gallery.labels[row]]
+                name = snapshot.user_id_to_name_map.get(user_id, "Unknown")
+            elif row >= 0:
+                self._remember_unknown(queries[i], distance, snapshot.version)
+            results[i] = {"user_id": user_id, "name": name, "distance": float(distance)}
+        return results
+
+    def rank_users(self, encodings: Sequence[np.ndarray], top_k: int = 2) -> List[Dict]:
+        """
+        複数の顔エンコーディングについて、距離の近い上位k人の登録者を返す
+
+        1人の登録者が複数のエンコーディングを持つため、探索インデックスから
+        上位k人分を必ず含む行数の候補を取り出し、整数ラベルごとの最小距離に集約する
+
+        Args:
+            encodings (Sequence[np.ndarray]): 128次元の顔エンコーディングのリスト
+            top_k (int): 返す登録者の人数
+
+        Returns:
+            List[Dict]: 各エンコーディングに対応する結果のリスト
+                        例: [{"candidates": [{"user_id": "...", "name": "...",
+                                              "distance": 0.38}, ...],
+                              "margin": 0.12}]
+                        marginは1位と2位の距離の差 (2位がいない場合はinf)
+        """
+        if len(encodings) == 0:
+            return []
+
+        snapshot = self._snapshot
+        gallery = snapshot.gallery
+        if len(gallery) == 0:
+            return [
+                {"candidates": [], "margin": float("inf")}
+                for _ in range(len(encodings))
+            ]
+
+        # キャッシュ済みのUnknownに近いクエリは候補なしとして照合を省略する
+        queries = as_query_matrix(encodings)
+        _, pending = self._screen_unknowns(queries, snapshot.version)
+        results = [
+            {"candidates": [], "margin": float("inf")} for _ in range(len(queries))
+        ]
+        if len(pending) == 0:
+            return results
+
+        # 上位k人の最良の行は、必ず距離の近い順に top_k * (1人あたりの最大行数) 件に含まれる
+        num_rows = min(len(gallery), top_k * gallery.max_rows_per_user)
+        with stage_timer("matching"):
+            distances, rows = snapshot.index.search(queries[pending], k=num_rows)
+            labels = np.where(rows >= 0, gallery.labels[rows], gallery.num_users)
+            # 候補の行だけを登録者ごとに集約する (距離の小さい順に並ぶ)
+            user_distances, user_labels = group_min(
+                distances, labels, gallery.num_users
+            )
+            top_distances = user_distances[:, :top_k]
+            top_labels = user_labels[:, :top_k]
+
+        for i, distances_row, labels_row in zip(pending, top_distances, top_labels):
+            candidates = []
+            for distance, label in zip(distances_row, labels_row):
+                if label < 0 or not np.isfinite(distance):
+                    continue
+                user_id = gallery.user_ids[label]
+                candidates.append(
+                    {
+                        "user_id": user_id,
+                        "name": snapshot.user_id_to_name_map.get(user_id, "Unknown"),
+                        "distance": float(distance),
+                    }
+                )
+            margin = float("inf")
+            if len(candidates) >= 2:
+                margin = candidates[1]["distance"] - candidates[0]["distance"]
+            if candidates and candidates[0]["distance"] > self.tolerance:
+                self._remember_unknown(
+                    queries[i], candidates[0]["distance"], snapshot.version
+                )
+            results[i] = {"candidates": candidates, "margin": margin}
+        return results
+
+    def _screen_unknowns(
+        self, queries: np.ndarray, version: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Unknownのキャッシュで判定できるクエリを除外する
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: 各クエリの最近傍距離の下限と、
+                                           ギャラリーとの照合が必要なクエリの番号
+        """
+        if self.negative_cache is None:
+            return (
+                np.full(len(queries), -np.inf, dtype=np.float32),
+                np.arange(len(queries)),
+            )
+        lower_bounds = self.negative_cache.lookup(queries, version)
+        pending = np.flatnonzero(~(lower_bounds > self.tolerance))
+        if len(pending) < len(queries):
+            NEGATIVE_CACHE_HITS.inc(len(queries) - len(pending))
+        return lower_bounds, pending
+
+    def _remember_unknown(self, encoding: np.ndarray, distance: float, version: int):
+        if self.negative_cache is not None:
+            self.negative_cache.add(encoding, float(distance), version)
+
+    def authenticate_face(self, face_data: dict, top_k: Optional[int] = None) -> list:
         """
         単一の顔データを受け取り認証する
 
         Args:
             face_data (dict): 顔情報を含む辞書
+            top_k (Optional[int]): 指定された場合、上位k人の候補("candidates")と
+                                   1位と2位の距離の差("margin")も結果に含める
 
         Returns:
             list: 認証結果を含む辞書のリスト
         """
-        face_encoding = face_data["encoding"]
-        box_location = face_data["location"]
+        if top_k is None:
+            match = self.match_batch([face_data["encoding"]])[0]
+            return [
+                {
+                    "name": match["name"],
+                    "box": face_data["location"],
+                    "distance": match["distance"],
+                }
+            ]
+
+        ranking = self.rank_users([face_data["encoding"]], top_k=top_k)[0]
+        candidates = ranking["candidates"]
         name = "Unknown"
-        face_distances = face_recognition.face_distance(
-            self.known_encodings, face_encoding
-        )
-        if len(face_distances) > 0:
-            best_match_index = np.argmin(face_distances)
-            if face_distances[best_match_index] <= self.tolerance:
-                user_id = self.known_user_ids[best_match_index]
-                name = self.user_id_to_name_map.get(user_id, "Unknown")
-        return [{"name": name, "box": box_location}]
+        distance = float("inf")
+        if candidates:
+            distance = candidates[0]["distance"]
+            if distance <= self.tolerance:
+                name = candidates[0]["name"]
+        return [
+            {
+                "name": name,
+                "box": face_data["location"],
+                "distance": distance,
+                "candidates": candidates,
+                "margin": ranking["margin"],
+            }
+        ]
 
     def authenticate_frame(self, frame: np.ndarray) -> List[Dict]:
         """
@@ -243,36 +816,21 @@ class AuthenticationService:
         Returns:
             List[Dict]: 認証結果を含む辞書のリスト
         """
-        if not self.known_encodings:
+        if len(self._snapshot.gallery) == 0:
             return []
 
         # フレームから顔の位置とエンコーディングを検出
         detected_faces = self.face_processor.detect_and_encode_faces(frame)
 
-        name = "Unknown"
-        recognized_faces = []
-        # 抽出された顔情報を使って、認証
-        for face_data in detected_faces:
-            face_encoding = face_data["encoding"]
-            box_location = face_data["location"]
-
-            # 検出された顔と、学習済みの全ての顔との距離を計算
-            face_distances = face_recognition.face_distance(
-                self.known_encodings, face_encoding
-            )
-
-            if len(face_distances) > 0:
-                # 最も距離が短い顔を探す
-                best_match_index = np.argmin(face_distances)
-                min_distance = face_distances[best_match_index]
-
-                # その最短距離が閾値以下であれば、認証成功と判断
-                if min_distance <= self.tolerance:
-                    user_id = self.known_user_ids[best_match_index]
-                    name = self.user_id_to_name_map.get(user_id, "Unknown")
+        # 検出された全ての顔を、学習済みの全ての顔とまとめて照合
+        matches = self.match_batch([face["encoding"] for face in detected_faces])
 
-            recognized_faces.append({"name": name, "box": box_location})
+        recognized_faces = [
+            {"name": match["name"], "box": face_data["location"]}
+            for face_data, match in zip(detected_faces, matches)
+        ]
         self.logger.info(
-            f"Authenticated {len(recognized_faces)} faces.", extra={"name": name}
+            f"Authenticated {len(recognized_faces)} faces.",
+            extra={"names": [face["name"] for face in recognized_faces]},
         )
         return recognized_faces
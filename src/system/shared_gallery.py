@@ -0,0 +1,282 @@
+import fcntl
+import json
+import os
+import struct
+import tempfile
+import traceback
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from ..utils.logger import setup_logger
+from .gallery import ENCODING_DIM, Gallery
+
+# --- 共有メモリのレイアウト ---
+# ヘッダー(マジック, バージョン, 行数, ユーザーID一覧のJSONのバイト数)の後に
+# エンコーディング行列(float32), ノルムの2乗(float32), ラベル(int32), ユーザーIDのJSONを並べる
+SEGMENT_MAGIC = b"FGS1"
+SEGMENT_HEADER = struct.Struct("!4sIQQ")
+DATA_OFFSET = 64
+
+DEFAULT_MANIFEST_PATH = os.path.join(tempfile.gettempdir(), "face_gallery.json")
+
+
+def _open_segment(name: str, create: bool = False, size: int = 0):
+    """
+    リソーストラッカーに登録せずに共有メモリを開く
+
+    トラッカーに登録されると、開いたプロセスの終了時にセグメントが削除されてしまうため
+    セグメントの削除は公開側がバージョン切り替え時に明示的に行う
+    """
+    try:
+        return shared_memory.SharedMemory(
+            name=name, create=create, size=size, track=False
+        )
+    except TypeError:
+        # Python 3.12以前はtrack引数がないため、登録を取り消す
+        segment = shared_memory.SharedMemory(name=name, create=create, size=size)
+        resource_tracker.unregister(segment._name, "shared_memory")
+        return segment
+
+
+class SharedGalleryStore:
+    """
+    ギャラリーを共有メモリに公開し、複数のワーカープロセスから読み取り専用で参照するクラス
+
+    ギャラリーはバージョンごとに別のセグメントとして公開し、現在のバージョンを
+    マニフェストファイルで示す。各ワーカーはセグメントをアタッチするだけなので、
+    ワーカー数が増えてもギャラリーのメモリは1つ分のままとなる
+
+    読み取り専用なのはattachが返すnumpyの配列だけで、セグメント自体は
+    (multiprocessing.shared_memoryの制約により) 読み書き可能でマップされる
+    ワーカーのバグでsegment.bufに書き込むと、同じバージョンを参照する全プロセスの
+    ギャラリーが書き換わる
+    """
+
+    def __init__(
+        self,
+        manifest_path: str = DEFAULT_MANIFEST_PATH,
+        segment_prefix: str = "face_gallery",
+    ):
+        """
+        SharedGalleryStoreのコンストラクタ
+
+        Args:
+            manifest_path (str): 現在のバージョンとセグメント名を記録するファイルのパス
+            segment_prefix (str): 共有メモリのセグメント名の接頭辞
+        """
+        self.logger = setup_logger(__name__)
+        self.manifest_path = manifest_path
+        self.segment_prefix = segment_prefix
+
+    def read_manifest(self) -> Optional[Dict]:
+        """
+        マニフェストを読み込む (公開されていない場合はNone)
+        """
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            self.logger.warning(
+                "Failed to read shared gallery manifest.",
+                extra={"manifest_path": self.manifest_path, "error": str(e)},
+            )
+            return None
+
+    def publish(self, gallery: Gallery, keep_versions: int = 1) -> int:
+        """
+        ギャラリーを新しいバージョンのセグメントとして公開する
+
+        公開後、keep_versions個より古いセグメントは削除する
+        (アタッチ済みのワーカーはマップを閉じるまでそのまま参照できる)
+        複数のプロセスが同時に公開しても同じバージョンを使わないよう、マニフェストの
+        読み込みから書き換えまではロックファイルで排他する
+
+        Args:
+            gallery (Gallery): 公開するギャラリー
+            keep_versions (int): 現在のバージョン以外に残す古いバージョンの数
+
+        Returns:
+            int: 公開したバージョン
+        """
+        with self._manifest_lock():
+            manifest = self.read_manifest() or {"version": 0, "segments": []}
+            version, name, size = self._create_segment(gallery, manifest["version"] + 1)
+
+            # 現在のバージョンを差し替えてから、古いセグメントを削除する
+            segments = manifest.get("segments", []) + [name]
+            stale, segments = (
+                segments[: -(keep_versions + 1)],
+                segments[-(keep_versions + 1) :],
+            )
+            self._write_manifest(
+                {"version": version, "segment": name, "segments": segments}
+            )
+        for stale_name in stale:
+            self._unlink(stale_name)
+
+        self.logger.info(
+            "Published shared gallery.",
+            extra={
+                "version": version,
+                "segment": name,
+                "rows": len(gallery),
+                "bytes": size,
+            },
+        )
+        return version
+
+    def _create_segment(self, gallery: Gallery, version: int) -> Tuple[int, str, int]:
+        """
+        version以降で未使用のバージョンのセグメントを作成し、ギャラリーを書き込む
+
+        公開の途中でプロセスが終了した場合などは、マニフェストにないセグメントが
+        残っていることがあるため、その場合は次のバージョンを使う
+
+        Returns:
+            Tuple[int, str, int]: 使用したバージョン, セグメント名, セグメントのバイト数
+        """
+        n_rows = len(gallery)
+        user_ids = json.dumps(gallery.user_ids, ensure_ascii=False).encode("utf-8")
+        matrix_bytes = n_rows * ENCODING_DIM * 4
+        size = DATA_OFFSET + matrix_bytes + n_rows * 4 * 2 + len(user_ids)
+
+        while True:
+            name = f"{self.segment_prefix}_v{version}"
+            try:
+                segment = _open_segment(name, create=True, size=max(size, 1))
+                break
+            except FileExistsError:
+                self.logger.warning(
+                    "Shared gallery segment already exists. Trying next version.",
+                    extra={"segment": name, "version": version},
+                )
+                version += 1
+
+        try:
+            SEGMENT_HEADER.pack_into(
+                segment.buf, 0, SEGMENT_MAGIC, version, n_rows, len(user_ids)
+            )
+            views = _segment_views(segment.buf, n_rows, len(user_ids))
+            views["matrix"][:] = gallery.matrix
+            views["squared_norms"][:] = gallery.squared_norms
+            views["labels"][:] = gallery.labels
+            views["user_ids"][:] = np.frombuffer(user_ids, dtype=np.uint8)
+            del views
+        finally:
+            segment.close()
+        return version, name, size
+
+    def attach(self, retries: int = 3) -> Optional[Tuple[Gallery, int]]:
+        """
+        現在公開されているギャラリーを読み取り専用でアタッチする
+        (書き込みを禁止するのはnumpyの配列だけで、セグメントは読み書き可能でマップされる)
+
+        Args:
+            retries (int): マニフェストを読んだ直後にセグメントが差し替えられた場合の再試行回数
+
+        Returns:
+            Optional[Tuple[Gallery, int]]: 共有メモリ上の配列を参照するGalleryとそのバージョン
+                                           公開されていない場合、またはマニフェストが
+                                           存在しないセグメントを指している場合はNone
+        """
+        for attempt in range(retries + 1):
+            manifest = self.read_manifest()
+            if manifest is None:
+                return None
+            try:
+                segment = _open_segment(manifest["segment"])
+                break
+            except FileNotFoundError:
+                if attempt == retries:
+                    # 再起動で/dev/shmが消去され、マニフェストだけが残った場合など
+                    # 公開されていない場合と同じく扱う
+                    self.logger.warning(
+                        "Shared gallery segment not found. Treating as not published.",
+                        extra={
+                            "manifest_path": self.manifest_path,
+                            "segment": manifest["segment"],
+                            "version": manifest.get("version"),
+                        },
+                    )
+                    return None
+        magic, version, n_rows, user_ids_len = SEGMENT_HEADER.unpack_from(
+            segment.buf, 0
+        )
+        if magic != SEGMENT_MAGIC:
+            segment.close()
+            raise ValueError(f"Invalid shared gallery segment: {manifest['segment']}")
+
+        views = _segment_views(segment.buf, n_rows, user_ids_len)
+        for key in ("matrix", "squared_norms", "labels"):
+            views[key].flags.writeable = False
+        user_ids = json.loads(bytes(views["user_ids"]).decode("utf-8"))
+
+        gallery = Gallery(
+            views["matrix"],
+            views["labels"],
+            user_ids,
+            squared_norms=views["squared_norms"],
+            buffer_owner=segment,
+        )
+        return gallery, version
+
+    @contextmanager
+    def _manifest_lock(self):
+        """
+        マニフェストを更新する間、他のプロセスの公開を待たせるロック
+        """
+        with open(f"{self.manifest_path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write_manifest(self, manifest: Dict):
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _unlink(self, name: str):
+        try:
+            # unlink()はトラッカーへの登録解除も行うため、ここでは通常どおり開く
+            segment = shared_memory.SharedMemory(name=name)
+            segment.close()
+            segment.unlink()
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self.logger.warning(
+                "Failed to unlink shared gallery segment.",
+                extra={
+                    "segment": name,
+                    "error": str(e),
+                    "traceback": traceback.format_exc(),
+                },
+            )
+
+
+def _segment_views(buffer, n_rows: int, user_ids_len: int) -> Dict[str, np.ndarray]:
+    """
+    セグメントのバッファ上に各配列のビューを作成する (コピーはしない)
+    """
+    offset = DATA_OFFSET
+    matrix = np.ndarray((n_rows, ENCODING_DIM), np.float32, buffer, offset)
+    offset += matrix.nbytes
+    squared_norms = np.ndarray((n_rows,), np.float32, buffer, offset)
+    offset += squared_norms.nbytes
+    labels = np.ndarray((n_rows,), np.int32, buffer, offset)
+    offset += labels.nbytes
+    user_ids = np.ndarray((user_ids_len,), np.uint8, buffer, offset)
+    return {
+        "matrix": matrix,
+        "squared_norms": squared_norms,
+        "labels": labels,
+        "user_ids": user_ids,
+    }
@@ -0,0 +1,136 @@
+import hashlib
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, Optional, Sequence
+
+import cv2
+import numpy as np
+
+from ..utils.logger import setup_logger
+from .broadcast import FrameBroadcaster
+from .mjpeg import part_payload
+
+# 縮小版として返せる画像の幅 (任意の幅を許すと、要求ごとに縮小とキャッシュが増えるため)
+SNAPSHOT_WIDTHS = (160, 320, 640)
+
+
+class SnapshotService:
+    """
+    配信中の最新フレームを静止画(JPEG)として返すクラス
+
+    処理パイプラインがエンコード済みのフレームをそのまま返すため、新たに解析や
+    エンコードは行わない。縮小版は新しいフレームで最初に要求された時に1回だけ作り、
+    同じフレームの間はキャッシュを返す。ETagとLast-Modifiedを付けるため、
+    変化がなければ監視側は本体を受け取らずに済む
+
+    ETagはフレームの番号ではなく内容のハッシュから作る。結果の保持中や映像の停止中は
+    同じフレームが再公開され番号だけが進むが、内容が同じ間はETagとLast-Modifiedを
+    変えずに304を返せるようにする
+    """
+
+    def __init__(
+        self,
+        broadcaster: FrameBroadcaster,
+        widths: Sequence[int] = SNAPSHOT_WIDTHS,
+        quality: int = 80,
+    ):
+        """
+        SnapshotServiceのコンストラクタ
+
+        Args:
+            broadcaster (FrameBroadcaster): 処理パイプラインがフレームを公開するインスタンス
+            widths (Sequence[int]): 縮小版として返せる画像の幅
+            quality (int): 縮小版のJPEGの画質 (0-100)
+        """
+        self.logger = setup_logger(__name__)
+        self.broadcaster = broadcaster
+        self.widths = tuple(widths)
+        self._encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)]
+        self._lock = threading.Lock()
+        # 最後に確認したフレームと、その内容のハッシュ・最初に公開された時刻
+        self._part: Optional[bytes] = None
+        self._digest: Optional[str] = None
+        self._modified_at: Optional[float] = None
+        # 幅 (元の大きさは0) -> 静止画
+        self._variants: Dict[int, Dict] = {}
+
+    def get(self, width: Optional[int] = None) -> Optional[Dict]:
+        """
+        最新のフレームの静止画を返す
+
+        Args:
+            width (Optional[int]): 縮小版の幅 (widthsのいずれか), Noneの場合は配信と同じ大きさ
+
+        Returns:
+            Optional[Dict]: "body" (JPEGのバイト列), "etag", "last_modified" を含む辞書
+                            まだフレームが公開されていない場合はNone
+        """
+        if width is not None and width not in self.widths:
+            raise ValueError(f"Unsupported snapshot width: {width}")
+        _, part, published_at = self.broadcaster.latest()
+        if part is None:
+            return None
+
+        key = width or 0
+        with self._lock:
+            if part is not self._part:
+                # 再公開された同じフレームはハッシュを計算し直さない
+                self._part = part
+                digest = hashlib.blake2b(part, digest_size=16).hexdigest()
+                if digest != self._digest:
+                    self._digest = digest
+                    self._modified_at = published_at
+                    self._variants = {}
+            snapshot = self._variants.get(key)
+            if snapshot is None:
+                body = part_payload(part)
+                if width is not None:
+                    body = self._downscale(body, width)
+                snapshot = {
+                    "body": body,
+                    "etag": f'"{self._digest}-{key}"',
+                    "last_modified": formatdate(int(self._modified_at), usegmt=True),
+                    "published_at": self._modified_at,
+                }
+                self._variants[key] = snapshot
+        return snapshot
+
+    def _downscale(self, jpeg: bytes, width: int) -> bytes:
+        """
+        JPEGを指定された幅に縮小する (元の方が小さい場合はそのまま返す)
+        """
+        frame = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if frame is None or frame.shape[1] <= width:
+            return jpeg
+        height = max(1, int(round(frame.shape[0] * width / frame.shape[1])))
+        small = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+        success, buffer = cv2.imencode(".jpg", small, self._encode_params)
+        if not success:
+            self.logger.warning("Failed to encode snapshot.", extra={"width": width})
+            return jpeg
+        return buffer.tobytes()
+
+
+def is_not_modified(
+    snapshot: Dict,
+    if_none_match: Optional[str],
+    if_modified_since: Optional[str],
+) -> bool:
+    """
+    条件付きリクエストに対して304 Not Modifiedを返せるかを判定する
+
+    If-None-Matchがある場合はETagだけで判定し、ない場合はIf-Modified-Sinceで判定する
+    """
+    if if_none_match:
+        # 弱いETag (W/"...") も同じフレームを指す
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        tags = [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+        return "*" in tags or snapshot["etag"] in tags
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        # Last-Modifiedは秒単位のため、同じ秒に公開したフレームは変更なしとみなす
+        return int(snapshot["published_at"]) <= since
+    return False
@@ -1,7 +1,13 @@
 import time
+from typing import Dict, List, Optional
 
 import cv2
 
+from ..utils.metrics import stage_timer
+from .decision import NEED_MORE, SequentialDecider
+from .mjpeg import MJPEGEncoder
+from .tracker import FaceTracker
+
 
 class StreamProcessor:
     """
@@ -9,7 +15,18 @@ class StreamProcessor:
     """
 
     def __init__(
-        self, camera, face_processor, auth_service, renderer, app_state, config
+        self,
+        camera,
+        face_processor,
+        auth_service,
+        renderer,
+        app_state,
+        config,
+        tracker=None,
+        decider=None,
+        encoder=None,
+        authenticator=None,
+        frozen_fps: float = 2.0,
     ):
         """
         StreamProcessorを初期化する
@@ -20,6 +37,13 @@ class StreamProcessor:
             auth_service (AuthenticationService): 認証サービスインスタンス
             renderer (Renderer): 描画プロセッサインスタンス
             app_state (AppState): アプリ状態インスタンス
+            tracker (FaceTracker): 顔のトラッキングを行うインスタンス
+            decider (SequentialDecider): 複数フレームで認証を判定するインスタンス
+            encoder (MJPEGEncoder): 配信用の解像度・画質でエンコードするインスタンス
+            authenticator (AsyncAuthenticator): 指定された場合、照合を別スレッドで実行し
+                                                完了を待たずに次のフレームを解析する
+            frozen_fps (float): 登録用に静止している間、キャッシュした画面を再送する
+                                フレームレート
         """
         self.camera = camera
         self.face_processor = face_processor
@@ -27,62 +51,190 @@ class StreamProcessor:
         self.renderer = renderer
         self.app_state = app_state
         self.config = config
+        self.tracker = tracker or FaceTracker()
+        self.decider = decider or SequentialDecider(tolerance=auth_service.tolerance)
+        self.encoder = encoder or MJPEGEncoder()
+        self.authenticator = authenticator
+        self.frozen_interval = 1.0 / frozen_fps
+        # 登録用に静止した時点の解析結果 (フレーム, 描画要素, エンコード済みのパート)
+        self._frozen: Optional[Dict] = None
 
     def generate(self):
         """
         ビデオフレームを生成するジェネレータ関数
+
+        取得・解析・描画を1フレームずつ順番に行う (並列に処理する場合はStreamPipelineを使う)
         """
         while True:
-            if (self.app_state.mode == "REGISTRATION_FROZEN") and (
-                self.app_state.captured_frame is not None
-            ):
-                frame = self.app_state.captured_frame.copy()
-            else:
-                frame = self.camera.get_frame()
-                if frame is None:
-                    time.sleep(0.1)
-                    continue
+            # 静止中はキャッシュした画面をゆっくり再送するだけで、解析もエンコードもしない
+            part = self.frozen_part()
+            if part is not None:
+                yield part
+                time.sleep(self.frozen_interval)
+                continue
+
+            frame = self.capture()
+            if frame is None:
+                time.sleep(0.1)
+                continue
+
+            # 現在のモードに応じてフレームを解析・描画
+            overlays = self.analyze(frame)
+            frame = self.render(frame, overlays)
+            part = self.encoder.encode(frame)
+            if part is not None:
+                yield part
+
+    def capture(self):
+        """
+        表示・解析の対象となるフレームを取得する
+
+        登録用に静止している間は、キャプチャ済みのフレームを返す
 
-            # 現在のモードに応じてフレームを処理・描画
+        Returns:
+            Optional[numpy.ndarray]: フレーム, 取得に失敗した場合はNone
+        """
+        if (self.app_state.mode == "REGISTRATION_FROZEN") and (
+            self.app_state.captured_frame is not None
+        ):
+            return self.app_state.captured_frame.copy()
+        return self.camera.get_frame()
+
+    def frozen_capture(self) -> Optional[Dict]:
+        """
+        登録用に静止している間、静止した時点の解析結果を返す (静止していない場合はNone)
+
+        Returns:
+            Optional[Dict]: "frame", "overlays", "parts" (エンコード済みのパート) を含む辞書
+        """
+        frozen = self._frozen
+        if (
+            self.app_state.mode != "REGISTRATION_FROZEN"
+            or frozen is None
+            or frozen["frame"] is not self.app_state.captured_frame
+        ):
+            return None
+        return frozen
+
+    def frozen_part(self, draw_overlays: bool = True) -> Optional[bytes]:
+        """
+        静止したフレームを最初の1回だけ描画・エンコードし、以降はそのパートを返す
+
+        Args:
+            draw_overlays (bool): 解析結果をフレームに描画するか
+
+        Returns:
+            Optional[bytes]: multipartの1パート, 静止していない場合はNone
+        """
+        frozen = self.frozen_capture()
+        if frozen is None:
+            return None
+        part = frozen["parts"].get(draw_overlays)
+        if part is None:
+            frame = frozen["frame"].copy()
+            if draw_overlays:
+                frame = self.render(frame, frozen["overlays"])
+            part = self.encoder.encode(frame)
+            frozen["parts"][draw_overlays] = part
+        return part
+
+    def analyze(self, frame, detection_scale: float = 1.0) -> List[Dict]:
+        """
+        現在のモードに応じてフレームを解析し、描画する要素のリストを返す
+
+        フレーム自体には描画しないため、結果を別の(より新しい)フレームに描画できる
+
+        Args:
+            frame (numpy.ndarray): 入力フレーム
+            detection_scale (float): 認証時の顔検出に使う画像の縮小率
+                                     (登録時は保存する顔位置の精度のため常に元の解像度)
+
+        Returns:
+            List[Dict]: 描画要素のリスト
+                        例: [{"type": "guide", "rect": (x, y, w, h), "color": (...)},
+                             {"type": "face", "location": (t, r, b, l),
+                              "track_id": 3, "name": "...",
+                              "message": "...", "color": (...)}]
+                        (track_idとnameは認証時のみ, nameは判定の確定後のみ)
+        """
+        # 静止したフレームは変化しないため、静止した時点の解析結果を返す
+        frozen = self.frozen_capture()
+        if frozen is not None:
+            return frozen["overlays"]
+
+        with stage_timer("analysis"):
             if self.app_state.mode == "AUTHENTICATING":
-                frame = self._handle_authentication_frame(frame)
-            elif self.app_state.mode in [
-                "REGISTRATION_SEARCHING",
-                "REGISTRATION_FROZEN",
-            ]:
-                frame = self._handle_registration_frame(frame)
-
-            # フレームをJPEGにエンコードしてyield
-            _, buffer = cv2.imencode(".jpg", frame)
-            yield (
-                b"--frame\r\n"
-                b"Content-Type: image/jpeg\r\n\r\n" + buffer.tobytes() + b"\r\n"
-            )
+                return self._analyze_authentication_frame(frame, detection_scale)
+            if self.app_state.mode in ["REGISTRATION_SEARCHING", "REGISTRATION_FROZEN"]:
+                return self._analyze_registration_frame(frame)
+            return []
 
-    def _handle_authentication_frame(self, frame) -> cv2.Mat:
+    def render(self, frame, overlays: List[Dict]) -> cv2.Mat:
         """
-        認証モード時のフレーム処理
+        解析結果の描画要素をフレームに描画する
+
+        Args:
+            frame (numpy.ndarray): 描画先のフレーム
+            overlays (List[Dict]): analyzeが返した描画要素のリスト
+
+        Returns:
+            numpy.ndarray: 描画済みのフレーム
+        """
+        with stage_timer("render"):
+            for overlay in overlays:
+                if overlay["type"] == "guide":
+                    frame = self.renderer.draw_guide_box(
+                        frame, overlay["rect"], overlay["color"]
+                    )
+                elif overlay["type"] == "face":
+                    frame = self.renderer.draw_face_box(
+                        frame, overlay["location"], overlay["message"], overlay["color"]
+                    )
+        return frame
+
+    def _analyze_authentication_frame(
+        self, frame, detection_scale: float = 1.0
+    ) -> List[Dict]:
+        """
+        認証モード時のフレーム解析
 
         Args:
             frame (numpy.ndarray): 入力フレーム
+            detection_scale (float): 顔検出に使う画像の縮小率
 
         Returns:
-            numpy.ndarray: 処理済みのフレーム
+            List[Dict]: 描画要素のリスト
         """
-        detected_faces = self.face_processor.detect_and_encode_faces(frame)
+        detected_faces = self.face_processor.detect_and_encode_faces(
+            frame, detection_scale=detection_scale
+        )
+
+        # 人物ごとに判定を蓄積するため、フレーム間で顔を対応付ける
+        track_ids = self.tracker.update([f["location"] for f in detected_faces])
+        self.decider.prune(self.tracker.active_track_ids)
+        if self.authenticator is not None:
+            self.authenticator.prune(self.tracker.active_track_ids)
 
         # デフォルトのガイド枠を描画
-        frame = self.renderer.draw_guide_box(
-            frame, self.config["GUIDE_BOX_RECT"], (128, 128, 128)
-        )
+        overlays = [
+            {
+                "type": "guide",
+                "rect": self.config["GUIDE_BOX_RECT"],
+                "color": (128, 128, 128),
+            }
+        ]
 
         if not detected_faces:
-            return frame
+            return overlays
 
-        largest_face = max(
-            detected_faces,
-            key=lambda f: self.config["get_face_properties"](f["location"])[1],
+        largest_index = max(
+            range(len(detected_faces)),
+            key=lambda i: self.config["get_face_properties"](
+                detected_faces[i]["location"]
+            )[1],
         )
+        largest_face = detected_faces[largest_index]
+        track_id = track_ids[largest_index]
         face_box_coords, face_area = self.config["get_face_properties"](
             largest_face["location"]
         )
@@ -95,41 +247,79 @@ class StreamProcessor:
             distance <= self.config["POSITION_THRESHOLD"]
             and size_ratio >= self.config["SIZE_THRESHOLD"]
         ):
-            # 認証処理へ (ここでは描画のみ)
-            auth_result = self.auth_service.authenticate_face(largest_face)
-            name = auth_result[0]["name"]
-            color = (0, 255, 0) if name != "Unknown" else (0, 0, 255)
-            frame = self.renderer.draw_face_box(
-                frame, largest_face["location"], f"結果: {name}", color
-            )
+            # 判定が確定済みの人物は照合を省略し、未確定なら1フレーム分の証拠を追加する
+            decision = self.decider.get_decision(track_id)
+            decided_now = False
+            if decision is None:
+                auth_result = self._authenticate(track_id, largest_face)
+                if auth_result is None:
+                    # 照合が完了していない間は照合中として表示する
+                    decision = {"decision": NEED_MORE}
+                else:
+                    decision = self.decider.update(track_id, auth_result[0])
+                    decided_now = decision["decision"] != NEED_MORE
+
+            name = None
+            if decision["decision"] == NEED_MORE:
+                color = (255, 255, 255)
+                message = "認証中..."
+            else:
+                name = decision["name"]
+                color = (0, 255, 0) if name != "Unknown" else (0, 0, 255)
+                message = f"結果: {name}"
         else:
-            # 条件不足のフィードバック
+            # 条件不足のフィードバック (枠から外れた人物の実行中の照合は取り消す)
+            if self.authenticator is not None:
+                self.authenticator.cancel(track_id)
             color = (0, 255, 255)
             message = (
                 "顔を枠の中央に"
                 if distance > self.config["POSITION_THRESHOLD"]
                 else "近づいてください"
             )
-            frame = self.renderer.draw_face_box(
-                frame, largest_face["location"], message, color
-            )
+            name = None
+            decided_now = False
+        overlays.append(
+            {
+                "type": "face",
+                "location": largest_face["location"],
+                "track_id": track_id,
+                "name": name,
+                "message": message,
+                "color": color,
+                # このフレームで判定が確定した場合、結果の画面を保持する
+                "hold": decided_now,
+            }
+        )
+        return overlays
 
-        return frame
+    def _authenticate(self, track_id: int, face_data: Dict) -> Optional[List[Dict]]:
+        """
+        顔を照合する (非同期の場合は、完了していなければ投入だけしてNoneを返す)
+        """
+        if self.authenticator is None:
+            return self.auth_service.authenticate_face(face_data, top_k=2)
+        auth_result = self.authenticator.poll(track_id)
+        if auth_result is None and not self.authenticator.is_pending(track_id):
+            self.authenticator.submit(track_id, face_data, top_k=2)
+        return auth_result
 
-    def _handle_registration_frame(self, frame) -> cv2.Mat:
+    def _analyze_registration_frame(self, frame) -> List[Dict]:
         """
-        登録モード時のフレーム処理
+        登録モード時のフレーム解析
 
         Args:
             frame (numpy.ndarray): 入力フレーム
 
         Returns:
-            numpy.ndarray: 処理済みのフレーム
+            List[Dict]: 描画要素のリスト
         """
         detected_faces = self.face_processor.detect_and_encode_faces(frame)
         if not detected_faces:
             self.app_state.captured_frame = None
-            return frame
+            self.app_state.captured_location = None
+            self.app_state.captured_encoding = None
+            return []
 
         largest_face = max(
             detected_faces,
@@ -150,6 +340,9 @@ class StreamProcessor:
         ):
             self.app_state.mode = "REGISTRATION_FROZEN"
             self.app_state.captured_frame = frame.copy()
+            self.app_state.captured_location = largest_face["location"]
+            # 登録時にエンコーディングを計算し直さないよう、検出時のものを保持する
+            self.app_state.captured_encoding = largest_face["encoding"]
 
         if self.app_state.mode == "REGISTRATION_FROZEN":
             color = (0, 255, 0)
@@ -162,6 +355,18 @@ class StreamProcessor:
                 else "近づいてください"
             )
 
-        return self.renderer.draw_face_box(
-            frame, largest_face["location"], message, color
-        )
+        overlays = [
+            {
+                "type": "face",
+                "location": largest_face["location"],
+                "message": message,
+                "color": color,
+            }
+        ]
+        if self.app_state.mode == "REGISTRATION_FROZEN":
+            self._frozen = {
+                "frame": self.app_state.captured_frame,
+                "overlays": overlays,
+                "parts": {},
+            }
+        return overlays
@@ -0,0 +1,95 @@
+from typing import Dict, List, Tuple
+
+from ..utils.logger import setup_logger
+
+Location = Tuple[int, int, int, int]
+
+
+def box_iou(a: Location, b: Location) -> float:
+    """
+    2つの顔位置 (top, right, bottom, left) のIoUを計算する
+    """
+    top = max(a[0], b[0])
+    right = min(a[1], b[1])
+    bottom = min(a[2], b[2])
+    left = max(a[3], b[3])
+    intersection = max(0, right - left) * max(0, bottom - top)
+    area_a = (a[1] - a[3]) * (a[2] - a[0])
+    area_b = (b[1] - b[3]) * (b[2] - b[0])
+    union = area_a + area_b - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+class FaceTracker:
+    """
+    フレーム間で顔の位置を対応付け、同じ人物に同じトラックIDを割り当てるクラス
+
+    前フレームの顔位置とのIoUが最も大きいものを同一人物とみなす
+    """
+
+    def __init__(self, iou_threshold: float = 0.3, max_missed_frames: int = 5):
+        """
+        FaceTrackerのコンストラクタ
+
+        Args:
+            iou_threshold (float): 同一人物とみなすIoUの下限
+            max_missed_frames (int): 検出されないフレームがこの数を超えたトラックを破棄する
+        """
+        self.logger = setup_logger(__name__)
+        self.iou_threshold = iou_threshold
+        self.max_missed_frames = max_missed_frames
+        self._tracks: Dict[int, Dict] = {}
+        self._next_track_id = 1
+
+    @property
+    def active_track_ids(self) -> List[int]:
+        """
+        現在追跡中のトラックIDのリスト
+        """
+        return list(self._tracks)
+
+    def update(self, locations: List[Location]) -> List[int]:
+        """
+        現在のフレームで検出された顔位置にトラックIDを割り当てる
+
+        Args:
+            locations (List[Location]): 検出された顔位置のリスト
+
+        Returns:
+            List[int]: 各顔位置に対応するトラックIDのリスト
+        """
+        # IoUの大きい組み合わせから順に貪欲に対応付ける
+        pairs = sorted(
+            (
+                (box_iou(location, track["location"]), i, track_id)
+                for i, location in enumerate(locations)
+                for track_id, track in self._tracks.items()
+            ),
+            reverse=True,
+        )
+        track_ids = [None] * len(locations)
+        matched_tracks = set()
+        for iou, i, track_id in pairs:
+            if iou < self.iou_threshold:
+                break
+            if track_ids[i] is not None or track_id in matched_tracks:
+                continue
+            track_ids[i] = track_id
+            matched_tracks.add(track_id)
+
+        for i, location in enumerate(locations):
+            if track_ids[i] is None:
+                track_ids[i] = self._next_track_id
+                self._next_track_id += 1
+            self._tracks[track_ids[i]] = {"location": location, "missed": 0}
+
+        # 見失ったトラックを数え、一定フレーム見えなければ破棄する
+        for track_id in list(self._tracks):
+            if track_id in track_ids:
+                continue
+            self._tracks[track_id]["missed"] += 1
+            if self._tracks[track_id]["missed"] > self.max_missed_frames:
+                del self._tracks[track_id]
+                self.logger.debug(f"Track {track_id} expired.")
+
+        return track_ids
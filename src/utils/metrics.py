@@ -0,0 +1,393 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from . import tracing
+
+# Prometheusのテキスト形式のContent-Type
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 処理時間のヒストグラムのバケットの上限 (秒)
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    return repr(float(value))
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    pairs = (f'{name}="{_escape_label_value(value)}"' for name, value in labels)
+    return "{" + ",".join(pairs) + "}"
+
+
+class _Metric:
+    """
+    ラベルの値ごとにサンプルを持つメトリクスの基底クラス
+    """
+
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        """
+        _Metricクラスのコンストラクタ
+
+        Args:
+            name (str): メトリクス名
+            documentation (str): HELPに出力する説明
+            labelnames (Sequence[str]): ラベル名の一覧
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"Metric {self.name} expects labels {self.labelnames}, "
+                f"got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...]) -> List[Tuple[str, str]]:
+        return list(zip(self.labelnames, key))
+
+    def samples(self) -> Iterator[Tuple[str, List[Tuple[str, str]], float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class _ValueMetric(_Metric):
+    """
+    カウンタとゲージの値を保持するクラス
+
+    サンプルは出力時にコールバックから読むこともできる。他のオブジェクトが既に持っている
+    値 (キューの長さなど) を、その処理に手を加えずに公開するために使う
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._functions: Dict[Tuple[str, ...], Callable[[], float]] = {}
+
+    def set_function(self, function: Callable[[], float], **labels):
+        """
+        メトリクスを出力するたびにfunction()からサンプルの値を読むようにする
+
+        Args:
+            function (Callable[[], float]): サンプルの値を返す関数
+            **labels: ラベルの値
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._functions[key] = function
+            self._values.pop(key, None)
+
+    def remove_function(self, function: Callable[[], float], **labels):
+        """
+        function()が登録されたままの場合に、そこからサンプルの値を読むのをやめる
+
+        Args:
+            function (Callable[[], float]): set_functionで登録した関数
+            **labels: ラベルの値
+        """
+        key = self._key(labels)
+        with self._lock:
+            if self._functions.get(key) is function:
+                del self._functions[key]
+
+    def remove(self, **labels):
+        """
+        ラベルの値のサンプルを削除する (値とコールバックのどちらも削除する)
+
+        Args:
+            **labels: ラベルの値
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values.pop(key, None)
+            self._functions.pop(key, None)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, function in functions.items():
+            try:
+                values[key] = float(function())
+            except Exception:
+                # コールバックが失敗しても、他のメトリクスの出力は止めない
+                continue
+        for key in sorted(values):
+            yield self.name, self._labels(key), values[key]
+
+
+class Counter(_ValueMetric):
+    """
+    単調に増加する回数 (ドロップしたフレーム数など)
+    """
+
+    type_name = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        """
+        カウンタを増やす
+
+        Args:
+            amount (float): 増やす量
+            **labels: ラベルの値
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_ValueMetric):
+    """
+    増減する値 (キューの長さやギャラリーの人数など)
+    """
+
+    type_name = "gauge"
+
+    def set(self, value: float, **labels):
+        """
+        ゲージの値を設定する
+
+        Args:
+            value (float): 設定する値
+            **labels: ラベルの値
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+
+class Histogram(_Metric):
+    """
+    観測した値 (秒単位の処理時間) の分布を固定のバケットで集計するクラス
+    """
+
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        """
+        Histogramクラスのコンストラクタ
+
+        Args:
+            name (str): メトリクス名
+            documentation (str): HELPに出力する説明
+            labelnames (Sequence[str]): ラベル名の一覧
+            buckets (Sequence[float]): バケットの上限 (+Infは自動で追加する)
+        """
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # ラベルの値 -> [バケットごとの回数 (最後が+Inf), 合計]
+        self._data: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        """
+        値を1つ観測する
+
+        Args:
+            value (float): 観測した値
+            **labels: ラベルの値
+        """
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            data = self._data.get(key)
+            if data is None:
+                data = self._data[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            data[0][index] += 1
+            data[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        withブロック内の経過時間を観測するコンテキストマネージャ
+
+        Args:
+            **labels: ラベルの値
+        """
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def samples(self):
+        with self._lock:
+            data = {
+                key: (list(counts), total)
+                for key, (counts, total) in self._data.items()
+            }
+        for key in sorted(data):
+            counts, total = data[key]
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield (
+                    self.name + "_bucket",
+                    labels + [("le", _format_value(bound))],
+                    cumulative,
+                )
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, cumulative
+
+
+class MetricsRegistry:
+    """
+    メトリクスを保持し、Prometheusのテキスト形式で出力するクラス
+
+    既に登録されている名前で登録すると既存のメトリクスを返すため、
+    各モジュールはインポート時にメトリクスを宣言できる
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric_class, name: str, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(name, *args, **kwargs)
+            elif not isinstance(metric, metric_class):
+                raise ValueError(f"Metric {name} is already registered as another type")
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        """
+        カウンタを登録する
+
+        Args:
+            name (str): メトリクス名
+            documentation (str): HELPに出力する説明
+            labelnames (Sequence[str]): ラベル名の一覧
+
+        Returns:
+            Counter: 登録した (または登録済みの) カウンタ
+        """
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        """
+        ゲージを登録する
+
+        Args:
+            name (str): メトリクス名
+            documentation (str): HELPに出力する説明
+            labelnames (Sequence[str]): ラベル名の一覧
+
+        Returns:
+            Gauge: 登録した (または登録済みの) ゲージ
+        """
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        """
+        ヒストグラムを登録する
+
+        Args:
+            name (str): メトリクス名
+            documentation (str): HELPに出力する説明
+            labelnames (Sequence[str]): ラベル名の一覧
+            buckets (Sequence[float]): バケットの上限
+
+        Returns:
+            Histogram: 登録した (または登録済みの) ヒストグラム
+        """
+        return self._register(Histogram, name, documentation, labelnames, buckets)
+
+    def render(self) -> str:
+        """
+        全てのメトリクスをPrometheusのテキスト形式で出力する
+
+        Returns:
+            str: Prometheusのテキスト形式の文字列
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+# ストリーミング処理のステージ ("capture", "detection", "matching"など) ごとの処理時間
+STAGE_SECONDS = REGISTRY.histogram(
+    "face_auth_stage_seconds", "Time spent in each processing stage.", ("stage",)
+)
+
+
+@contextmanager
+def stage_timer(stage: str, timings: Optional[Dict[str, float]] = None):
+    """
+    ブロック内の処理時間をステージの処理時間として記録するコンテキストマネージャ
+
+    フレームのトレースが有効で現在のフレームがサンプリング対象の場合は、同じ計測値を
+    スパンとしても書き出す
+
+    Args:
+        stage (str): ステージ名
+        timings (Optional[Dict[str, float]]): リクエストごとの処理時間を返す場合に、
+                                              ステージ名 -> 秒を加算する辞書
+    """
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started_at
+        STAGE_SECONDS.observe(duration, stage=stage)
+        tracing.record_span(stage, started_at, duration)
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + duration
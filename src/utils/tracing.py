@@ -0,0 +1,292 @@
+import gc
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+
+class FrameTracer:
+    """
+    フレームごとのステージの処理時間をChromeのトレースイベント形式で記録するクラス
+
+    キャプチャしたフレームごとにIDを振り、サンプリング対象のフレームだけを記録する。
+    フレームを処理するスレッドはそのIDを紐付け、そのスレッドで計測したステージは
+    フレームIDを付けた完了 ("X") イベントとして書き出す。ガベージコレクションは
+    中断されたスレッドのイベントとして記録する
+
+    イベントはメモリに保持し、flush_interval秒ごとに現在のファイルを書き直す。
+    ファイルのイベント数がmax_eventsに達すると<path>.1, <path>.2, ...にローテーションし
+    (backup_count個まで保持)、稼働中の端末でもトレースの容量が増え続けないようにする。
+    各ファイルはchrome://tracingやPerfettoで読み込める完全なJSONになる
+    """
+
+    def __init__(
+        self,
+        path: str,
+        sample_rate: float = 0.05,
+        max_events: int = 100000,
+        backup_count: int = 3,
+        flush_interval: float = 5.0,
+    ):
+        """
+        FrameTracerクラスのコンストラクタ
+
+        Args:
+            path (str): 書き出すトレースファイルのパス
+            sample_rate (float): 記録するフレームの割合 (0-1)
+            max_events (int): ローテーションするまでの1ファイルのイベント数
+            backup_count (int): 保持するローテーション済みファイルの数
+            flush_interval (float): 現在のファイルを書き出す間隔 (秒)
+        """
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_events = max_events
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+
+        # どちらのロックを保持している間にもガベージコレクション (とそのイベントの記録) が
+        # 始まる可能性があるため、再入可能なロックにする
+        self._lock = threading.RLock()
+        self._write_lock = threading.RLock()
+        self._local = threading.local()
+        self._origin = time.perf_counter()
+        self._pid = os.getpid()
+        self._frame_counter = 0
+        self._events: List[Dict] = []
+        self._named_threads = set()
+        self._dirty = False
+        self._gc_started: Dict[int, float] = {}
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        gc.callbacks.append(self._on_gc)
+        self._stop_event = threading.Event()
+        self._writer = threading.Thread(
+            target=self._flush_loop, name="trace-writer", daemon=True
+        )
+        self._writer.start()
+
+    def start_frame(self) -> Optional[int]:
+        """
+        次のフレームIDを割り当て、呼び出し元のスレッドに紐付ける
+
+        Returns:
+            Optional[int]: サンプリング対象の場合はフレームID、対象外の場合はNone
+        """
+        with self._lock:
+            self._frame_counter += 1
+            frame_id = self._frame_counter
+        # 等間隔にサンプリングする: frame_id * rateが整数をまたいだフレームを記録する
+        if int(frame_id * self.sample_rate) == int((frame_id - 1) * self.sample_rate):
+            frame_id = None
+        self.bind_frame(frame_id)
+        return frame_id
+
+    def bind_frame(self, frame_id: Optional[int]):
+        """
+        呼び出し元のスレッドが処理するフレームを設定する
+
+        Args:
+            frame_id (Optional[int]): フレームID (Noneの場合は記録しない)
+        """
+        self._local.frame_id = frame_id
+
+    def current_frame(self) -> Optional[int]:
+        """
+        呼び出し元のスレッドに紐付いているフレームIDを返す
+
+        Returns:
+            Optional[int]: フレームID (紐付いていない場合はNone)
+        """
+        return getattr(self._local, "frame_id", None)
+
+    def record_span(self, name: str, started_at: float, duration: float):
+        """
+        呼び出し元のスレッドがサンプリング対象のフレームに紐付いている場合にスパンを記録する
+
+        Args:
+            name (str): スパン名 (ステージ名)
+            started_at (float): time.perf_counter()で計測した開始時刻
+            duration (float): 処理時間 (秒)
+        """
+        frame_id = self.current_frame()
+        if frame_id is None:
+            return
+        self._append(
+            {
+                "name": name,
+                "cat": "stage",
+                "ph": "X",
+                "ts": (started_at - self._origin) * 1e6,
+                "dur": duration * 1e6,
+                "args": {"frame": frame_id},
+            }
+        )
+
+    @contextmanager
+    def span(self, name: str):
+        """
+        withブロックを紐付いているフレームのスパンとして記録するコンテキストマネージャ
+
+        Args:
+            name (str): スパン名
+        """
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_span(name, started_at, time.perf_counter() - started_at)
+
+    def _on_gc(self, phase: str, info: Dict):
+        thread_id = threading.get_ident()
+        if phase == "start":
+            self._gc_started[thread_id] = time.perf_counter()
+            return
+        started_at = self._gc_started.pop(thread_id, None)
+        if started_at is None:
+            return
+        self._append(
+            {
+                "name": f"gc gen{info.get('generation')}",
+                "cat": "gc",
+                "ph": "X",
+                "ts": (started_at - self._origin) * 1e6,
+                "dur": (time.perf_counter() - started_at) * 1e6,
+                "args": {
+                    "collected": info.get("collected"),
+                    "frame": self.current_frame(),
+                },
+            }
+        )
+
+    def _append(self, event: Dict):
+        thread = threading.current_thread()
+        event["pid"] = self._pid
+        event["tid"] = thread.ident
+        rotated = None
+        with self._lock:
+            if thread.ident not in self._named_threads:
+                # スレッド名はメタデータイベントで、ファイルごとに出力する
+                self._named_threads.add(thread.ident)
+                self._events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": self._pid,
+                        "tid": thread.ident,
+                        "args": {"name": thread.name},
+                    }
+                )
+            self._events.append(event)
+            self._dirty = True
+            if len(self._events) >= self.max_events:
+                rotated = self._events
+                self._events = []
+                self._named_threads = set()
+                self._dirty = False
+        if rotated is not None:
+            with self._write_lock:
+                self._write(rotated)
+                self._rotate()
+
+    def _rotate(self):
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def _write(self, events: List[Dict]):
+        # 書き込み途中のファイルを読まれないよう、一時ファイルに書いてから置き換える
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        os.replace(temporary_path, self.path)
+
+    def flush(self):
+        """
+        現在のファイルのイベントを書き出す
+        """
+        with self._write_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                events = list(self._events)
+                self._dirty = False
+            self._write(events)
+
+    def _flush_loop(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """
+        記録を停止し、残りのイベントを書き出す
+        """
+        if self._on_gc in gc.callbacks:
+            gc.callbacks.remove(self._on_gc)
+        self._stop_event.set()
+        self.flush()
+
+
+# トレースは任意で、configure_tracing()を呼ぶまでは何も記録しない
+_tracer: Optional[FrameTracer] = None
+
+
+def configure_tracing(path: str, sample_rate: float = 0.05, **kwargs) -> FrameTracer:
+    """
+    プロセスのフレームのトレースを有効にする (既存のトレーサーは置き換える)
+
+    Args:
+        path (str): 書き出すトレースファイルのパス
+        sample_rate (float): 記録するフレームの割合 (0-1)
+        **kwargs: FrameTracerに渡すその他の引数
+
+    Returns:
+        FrameTracer: 有効にしたトレーサー
+    """
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+    _tracer = FrameTracer(path, sample_rate=sample_rate, **kwargs)
+    return _tracer
+
+
+def get_tracer() -> Optional[FrameTracer]:
+    """
+    有効なトレーサーを返す
+
+    Returns:
+        Optional[FrameTracer]: トレーサー (トレースが無効の場合はNone)
+    """
+    return _tracer
+
+
+def start_frame() -> Optional[int]:
+    """
+    呼び出し元のスレッドで新しいフレームを開始する
+
+    Returns:
+        Optional[int]: フレームID (トレースが無効かサンプリング対象外の場合はNone)
+    """
+    return _tracer.start_frame() if _tracer is not None else None
+
+
+def bind_frame(frame_id: Optional[int]):
+    if _tracer is not None:
+        _tracer.bind_frame(frame_id)
+
+
+def current_frame() -> Optional[int]:
+    return _tracer.current_frame() if _tracer is not None else None
+
+
+def record_span(name: str, started_at: float, duration: float):
+    if _tracer is not None:
+        _tracer.record_span(name, started_at, duration)
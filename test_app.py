@@ -1,336 +1,80 @@
-import os
-import time
-import traceback
-
-import cv2
-import numpy as np
-from flask import Flask, Response, jsonify, render_template, request
-from PIL import Image, ImageDraw, ImageFont
-
-from src.system.camera import Camera, SimulatedCamera
-from src.system.data_manager import DataManager
-from src.system.face_processor import FaceProcessor
-from src.system.services import (
-    AuthenticationService,
-    EncodingService,
-    RegistrationService,
+from flask import (
+    Flask,
+    Response,
+    jsonify,
+    render_template,
+    request,
+    stream_with_context,
 )
-from src.utils.logger import setup_logger
 
-# --- アプリケーション設定 ---
-USE_REAL_CAMERA = True
-REGISTRATION_PASSWORD = "704lIlac"  # 登録モードに入るためのパスワード
-
-app = Flask(__name__)
-logger = setup_logger(__name__)
-
-
-# --- グローバル変数 (アプリケーションの状態管理) ---
-class AppState:
-    def __init__(self):
-        self.mode = "AUTHENTICATING"
-        self.captured_frame = None
-        self.last_auth_result = {}
-
-
-app_state = AppState()
-
-# --- グローバルなサービスの初期化 ---
-data_manager = DataManager()
-face_processor = FaceProcessor()
-auth_service = AuthenticationService(data_manager, face_processor, tolerance=0.55)
-registration_service = RegistrationService(data_manager)
-encoding_service = EncodingService(data_manager, face_processor)
-
-# カメラの初期化
-try:
-    camera = Camera() if USE_REAL_CAMERA else SimulatedCamera()
-except Exception as e:
-    # カメラが初期化できない場合はアプリケーションを終了
-    logger.error(
-        f"Error initializing camera: {e}",
-        extra={
-            "error": str(e),
-            "traceback": traceback.format_exc(),
-        },
-    )
-    exit()
-
-# --- UIとロジックに関する定数 ---
-FRAME_WIDTH, FRAME_HEIGHT = 1280, 720
-GUIDE_BOX_WIDTH, GUIDE_BOX_HEIGHT = 350, 450
-GUIDE_BOX_RECT = (
-    (FRAME_WIDTH - GUIDE_BOX_WIDTH) // 2,
-    (FRAME_HEIGHT - GUIDE_BOX_HEIGHT) // 2,
-    GUIDE_BOX_WIDTH,
-    GUIDE_BOX_HEIGHT,
+from src.system.app_context import (
+    CLIENT_OVERLAYS,
+    MAX_BATCH_UPLOAD_BYTES,
+    REGISTRATION_PASSWORD,
+    TAR_CONTENT_TYPES,
+    USE_REAL_CAMERA,
+    AppContext,
 )
-POSITION_THRESHOLD, SIZE_THRESHOLD = 50, 0.5
-FONT_PATH = "ipaexg.ttf"
-if not os.path.exists(FONT_PATH):
-    logger.warning(
-        "Warning: Font file not found. Japanese text may not display correctly.",
-        extra={
-            "font_path": FONT_PATH,
-        },
-    )
-    FONT_PATH = ""
-
-
-# --- ヘルパー関数 ---
-def get_box_center(box):
-    """
-    矩形の中心を計算する
-    """
-    x, y, w, h = box
-    return x + w // 2, y + h // 2
-
-
-def get_box_area(box):
-    """
-    矩形の面積を計算する
-    """
-    _, _, w, h = box
-    return w * h
-
-
-def get_face_properties(location):
-    """
-    顔の位置とサイズを計算する
-    """
-    top, right, bottom, left = location
-    w = right - left
-    h = bottom - top
-    area = w * h
-    return (left, top, w, h), area
-
-
-def calculate_face_metrics(face_box, face_area):
-    """
-    顔の位置と大きさを計算し、その指標を返す
-    """
-    guide_center = get_box_center(GUIDE_BOX_RECT)
-    face_center = get_box_center(face_box)
-
-    distance = np.linalg.norm(np.array(guide_center) - np.array(face_center))
-    size_ratio = face_area / get_box_area(GUIDE_BOX_RECT)
-
-    return distance, size_ratio
+from src.system.batch_auth import iter_tar_images
+from src.system.snapshot import is_not_modified
+from src.utils.metrics import CONTENT_TYPE, REGISTRY
 
+app = Flask(__name__)
 
-def draw_japanese_text(image, text, position, font_path, font_size, color):
-    """
-    Pillowを使って、OpenCVの画像に日本語を描画する
-    """
-    if not font_path:
-        # font_pathが指定されていない場合はデフォルトのフォントを使用
-        cv2.putText(
-            image, text, position, cv2.FONT_HERSHEY_SIMPLEX, font_size / 30, color, 2
-        )
-        return image
-    try:
-        font = ImageFont.truetype(font_path, font_size)
-        img_pil = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-        draw = ImageDraw.Draw(img_pil)
-        draw.text(position, text, font=font, fill=color)
-        return cv2.cvtColor(np.array(img_pil), cv2.COLOR_RGB2BGR)
-    except Exception:
-        logger.warning(
-            "Could not load font file. Falling back to default font.",
-            extra={
-                "font_path": font_path,
-            },
-        )
-        cv2.putText(
-            image, text, position, cv2.FONT_HERSHEY_SIMPLEX, font_size / 30, color, 2
-        )
-        return image
+# サービスと状態はASGI版(asgi_app.py)と同じAppContextで構築する
+context = AppContext(use_real_camera=USE_REAL_CAMERA)
+app_state = context.app_state
+stream_pipeline = context.stream_pipeline
+snapshot_service = context.snapshot_service
 
 
-# --- ビデオストリーミングのメインロジック ---
-def generate_frames():
-    """
-    カメラからフレームを取得し、認証処理を行い、ストリーミングする
-    """
-    while True:
-        # 現在のモードがフリーズ状態の場合、保持しているフレームを使い続ける
-        if (app_state.mode == "REGISTRATION_FROZEN") and (
-            app_state.captured_frame is not None
-        ):
-            frame = app_state.captured_frame.copy()
-        else:
-            frame = camera.get_frame()
-            if frame is None:
-                logger.warning("Failed to capture frame from camera.")
-                time.sleep(0.1)
-                # TODO: エラーメッセージを返す,リトライ機構, 再接続処理
-                continue
-
-        if app_state.mode == "AUTHENTICATING":
-            # --- 認証モードのロジック ---
-            handle_authentication_frame(frame)
-            pass
-        elif app_state.mode in ["REGISTRATION_SEARCHING", "REGISTRATION_FROZEN"]:
-            # --- 登録モードのロジック ---
-            handle_registration_frame(frame)
-
-        _, buffer = cv2.imencode(".jpg", frame)
-        yield (
-            b"--frame\r\n"
-            b"Content-Type: image/jpeg\r\n\r\n" + buffer.tobytes() + b"\r\n"
-        )
+# --- APIエンドポイント ---
+@app.route("/")
+def index():
+    return render_template("index.html", client_overlays=CLIENT_OVERLAYS)
 
 
-def handle_authentication_frame(frame):
-    """
-    認証モード時のフレーム処理と描画を行う
-    """
-    detected_faces = face_processor.detect_and_encode_faces(frame)
-    default_color = (128, 128, 128)
-    gx, gy, gw, gh = GUIDE_BOX_RECT
-    cv2.rectangle(frame, (gx, gy), (gx + gw, gy + gh), default_color, 3)
-
-    if not detected_faces:
-        # 顔が検出されなかった場合
-        pass
-    else:
-        largest_face = max(
-            detected_faces, key=lambda f: get_face_properties(f["location"])[1]
-        )
-        face_box_coords, face_area = get_face_properties(largest_face["location"])
-        left, top, w, h = face_box_coords
-        distance, size_ratio = calculate_face_metrics(face_box_coords, face_area)
-        # 認証処理事前チェック（顔の位置と大きさを確認）
-        if distance <= POSITION_THRESHOLD and size_ratio >= SIZE_THRESHOLD:
-            logger.info(
-                "Face detected and ready for authentication.",
-                extra={
-                    "distance": distance,
-                    "size_ratio": size_ratio,
-                },
-            )
-            # 認証処理の前に先に対象フレームを返しておく
-            auth_color = (255, 255, 255)
-            auth_message = "認証中..."
-            processing_frame = frame.copy()
-            cv2.rectangle(
-                processing_frame, (left, top), (left + w, top + h), auth_color, 3
-            )
-            processing_frame = draw_japanese_text(
-                processing_frame,
-                auth_message,
-                (left, top - 40),
-                FONT_PATH,
-                30,
-                auth_color,
-            )
-            _, buffer = cv2.imencode(".jpg", processing_frame)
-            yield (
-                b"--frame\r\n"
-                b"Content-Type: image/jpeg\r\n\r\n" + buffer.tobytes() + b"\r\n"
-            )
-            # 認証処理
-            logger.info("Starting face authentication.")
-            auth_result = auth_service.authenticate_face(largest_face)
-            logger.info(
-                "Face authentication completed.",
-                extra={
-                    "user_name": auth_result[0]["name"],
-                },
-            )
-            name = auth_result[0]["name"]
-
-            result_color = (0, 255, 0) if name != "Unknown" else (0, 0, 255)
-            result_frame = frame.copy()
-            cv2.rectangle(
-                result_frame, (left, top), (left + w, top + h), result_color, 3
-            )
-            result_frame = draw_japanese_text(
-                result_frame,
-                f"結果: {name}",
-                (left, top - 40),
-                FONT_PATH,
-                30,
-                result_color,
-            )
-
-            end_time = time.time() + 3
-            while time.time() < end_time:
-                _, buffer = cv2.imencode(".jpg", result_frame)
-                yield (
-                    b"--frame\r\n"
-                    b"Content-Type: image/jpeg\r\n\r\n" + buffer.tobytes() + b"\r\n"
-                )
-            return
-
-        else:
-            # 認証処理事前チェックに引っかからなかった場合フィードバックを描画
-            feedback_color = (0, 255, 255)
-            feedback_message = (
-                "顔を枠の中央に"
-                if distance > POSITION_THRESHOLD
-                else "近づいてください"
-            )
-            cv2.rectangle(frame, (left, top), (left + w, top + h), feedback_color, 3)
-            frame = draw_japanese_text(
-                frame,
-                feedback_message,
-                (left, top - 40),
-                FONT_PATH,
-                30,
-                feedback_color,
-            )
-
-
-def handle_registration_frame(frame):
-    """
-    登録モード時のフレーム処理と描画を行う
-    """
-    detected_faces = face_processor.detect_and_encode_faces(frame)
-    if not detected_faces:
-        app_state.captured_frame = None
-        return
-
-    largest_face = max(
-        detected_faces, key=lambda f: get_face_properties(f["location"])[1]
+@app.route("/video_feed")
+def video_feed():
+    return Response(
+        stream_pipeline.generate(),
+        mimetype="multipart/x-mixed-replace; boundary=frame",
     )
-    face_box, face_area = get_face_properties(largest_face["location"])
-    left, top, w, h = face_box
 
-    distance, size_ratio = calculate_face_metrics(face_box, face_area)
 
-    if (
-        app_state.mode == "REGISTRATION_SEARCHING"
-        and distance <= POSITION_THRESHOLD
-        and size_ratio >= SIZE_THRESHOLD
+@app.route("/snapshot.jpg")
+def snapshot():
+    """配信中の最新フレームを静止画で返す (?width=160|320|640 で縮小版)"""
+    width = request.args.get("width", type=int)
+    if width is not None and width not in snapshot_service.widths:
+        return jsonify({"status": "error", "message": "Unsupported width."}), 400
+
+    stream_pipeline.start()
+    image = snapshot_service.get(width)
+    if image is None:
+        return Response(status=503, headers={"Retry-After": "1"})
+
+    headers = {
+        "ETag": image["etag"],
+        "Last-Modified": image["last_modified"],
+        "Cache-Control": "no-cache",
+    }
+    if is_not_modified(
+        image,
+        request.headers.get("If-None-Match"),
+        request.headers.get("If-Modified-Since"),
     ):
-        app_state.mode = "REGISTRATION_FROZEN"
-        app_state.captured_frame = frame.copy()
-        logger.info("Frame captured for registration.")
-
-    if app_state.mode == "REGISTRATION_FROZEN":
-        guide_color = (0, 255, 0)
-        feedback_message = "この顔で登録します"
-    else:  # REGISTRATION_SEARCHING
-        guide_color = (0, 255, 255)
-        feedback_message = (
-            "顔を枠の中央に" if distance > POSITION_THRESHOLD else "近づいてください"
-        )
-
-    cv2.rectangle(frame, (left, top), (left + w, top + h), guide_color, 3)
-    draw_japanese_text(frame, feedback_message, (left, top - 40), guide_color)
-
-
-# --- APIエンドポイント ---
-@app.route("/")
-def index():
-    return render_template("index.html")
+        return Response(status=304, headers=headers)
+    return Response(image["body"], mimetype="image/jpeg", headers=headers)
 
 
-@app.route("/video_feed")
-def video_feed():
+@app.route("/events")
+def events():
+    """解析結果(モード, 顔の枠, 名前, トラックID)をServer-Sent Eventsで配信する"""
     return Response(
-        generate_frames(), mimetype="multipart/x-mixed-replace; boundary=frame"
+        stream_pipeline.event_stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
     )
 
 
@@ -346,40 +90,100 @@ def check_password():
 @app.route("/start_registration", methods=["POST"])
 def start_registration():
     """登録モードを開始する"""
-    app_state.mode = "REGISTRATION_SEARCHING"
-    logger.info("Mode changed to REGISTRATION_SEARCHING")
+    context.change_mode("REGISTRATION_SEARCHING")
     return jsonify({"status": "ok"})
 
 
 @app.route("/recapture", methods=["POST"])
 def recapture():
     """キャプチャしたフレームを破棄し、再撮影モードに戻す"""
-    app_state.mode = "REGISTRATION_SEARCHING"
-    app_state.captured_frame = None
-    logger.info("Recapturing. Mode changed to REGISTRATION_SEARCHING")
+    context.change_mode("REGISTRATION_SEARCHING", discard_capture=True)
     return jsonify({"status": "ok"})
 
 
 @app.route("/cancel_registration", methods=["POST"])
 def cancel_registration():
     """登録をキャンセルし、認証モードに戻る"""
-    app_state.mode = "AUTHENTICATING"
-    app_state.captured_frame = None
-    logger.info("Registration cancelled. Mode changed to AUTHENTICATING")
+    context.change_mode("AUTHENTICATING", discard_capture=True)
     return jsonify({"status": "ok"})
 
 
 @app.route("/status")
 def status():
     """フロントエンドに現在のアプリケーション状態を返す"""
-    return jsonify(
-        {
-            "mode": app_state.mode,
-            "isFrameCaptured": app_state.captured_frame is not None,
-        }
+    return jsonify(context.get_status())
+
+
+@app.route("/metrics")
+def metrics():
+    """各ステージの処理時間, 破棄したフレーム数, キューの長さ, ギャラリーの大きさを返す"""
+    return Response(REGISTRY.render(), mimetype=CONTENT_TYPE)
+
+
+def batch_response(auth_service=None):
+    """
+    リクエストの画像を認証し、結果をNDJSONで返すレスポンスを作る
+
+    multipart/form-dataの"images"フィールド、またはtar (gzip圧縮も可) のリクエスト本体を
+    受け付ける
+    """
+    if (request.content_length or 0) > MAX_BATCH_UPLOAD_BYTES:
+        return (
+            jsonify({"status": "error", "message": "リクエストが大きすぎます。"}),
+            413,
+        )
+    if request.mimetype in TAR_CONTENT_TYPES:
+        # tarは受信しながら読み出し、届いた画像から処理を始める
+        images = iter_tar_images(request.stream)
+    else:
+        files = request.files.getlist("images")
+        if not files:
+            return jsonify({"status": "error", "message": "画像がありません。"}), 400
+        images = ((f.filename, f.read()) for f in files)
+
+    return Response(
+        stream_with_context(context.batch_result_lines(images, auth_service)),
+        mimetype="application/x-ndjson",
     )
 
 
+@app.route("/authenticate_batch", methods=["POST"])
+def authenticate_batch():
+    """
+    アップロードされた複数の画像を認証する
+
+    multipart/form-dataの"images"フィールド、またはtar (gzip圧縮も可) のリクエスト本体を
+    受け付け、画像ごとの結果(顔の位置, 名前, 距離, ステージごとの処理時間)を
+    完了した順にNDJSONで返す
+    """
+    return batch_response()
+
+
+@app.route("/tenants")
+def tenants():
+    """テナントの一覧と、読み込み済みのテナントのメモリ使用量を返す"""
+    stats = context.tenant_stats()
+    if stats is None:
+        return jsonify({"status": "error", "message": "テナントは無効です。"}), 404
+    return jsonify(stats)
+
+
+@app.route("/tenants/<tenant_id>/authenticate_batch", methods=["POST"])
+def authenticate_tenant_batch(tenant_id):
+    """
+    アップロードされた複数の画像を、テナントのギャラリーと照合する
+
+    リクエストとレスポンスの形式は/authenticate_batchと同じ
+    """
+    try:
+        auth_service = context.tenant_service(tenant_id)
+    except ValueError:
+        return jsonify({"status": "error", "message": "テナントIDが不正です。"}), 400
+    except KeyError:
+        return jsonify({"status": "error", "message": "テナントがありません。"}), 404
+    return batch_response(auth_service)
+
+
 @app.route("/submit_registration", methods=["POST"])
 def submit_registration():
     """ユーザー名を受け取り、登録を実行する"""
@@ -395,13 +199,7 @@ def submit_registration():
             400,
         )
 
-    registration_service.register_new_user(
-        name=user_name, images=[app_state.captured_frame]
-    )
-    encoding_service.build_encodings_from_dataset()
-    auth_service.reload_knowledge()
-
-    cancel_registration()  # 状態をリセットして認証モードに戻る
+    context.register_captured_user(user_name)
     return jsonify({"status": "ok", "message": f"{user_name}さんを登録しました。"})
 
 